@@ -1,8 +1,46 @@
 import json
 from simstream import PikaAsyncConsumer
 
+settings = {}
+
+with open("../settings.json", 'r') as f:
+    settings = json.load(f)
+
 def recv_log(body):
     try:
         logs = json.loads(body.decode())
-        for log in logs:
-            print(log)
\ No newline at end of file
+        if logs is not None:
+            for log in logs:
+                print(log)
+    except json.decoder.JSONDecodeError as e:
+        print("[Error]: Could not decode %s" % (body))
+    except UnicodeError as e:
+        print("[Error]: Could not decode from bytes to string: %s" % (e.reason))
+
+def recv_rmsd(body):
+    try:
+        lines = json.loads(body.decode())
+        if lines is not None:
+            for line in lines:
+                print(line[0])
+    except json.decoder.JSONDecodeError as e:
+        print("[Error]: Could not decode %s" % (body))
+    except UnicodeError as e:
+        print("[Error]: Could not decode from bytes to string: %s" % (e.reason))
+    except IndexError as e:
+        print("[Error]: List is empty")
+
+# One connection and channel serve both streams, each with its own handler
+consumer = PikaAsyncConsumer(settings["url"],
+                             settings["exchange"],
+                             "openmm.log",
+                             message_handler=recv_log,
+                             routing_key="openmm.log",
+                             exchange_type=settings["exchange_type"])
+consumer.add_binding("openmm.rmsd", "openmm.rmsd", recv_rmsd)
+
+if __name__ == "__main__":
+    try:
+        consumer.start()
+    except KeyboardInterrupt:
+        consumer.stop()
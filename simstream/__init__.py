@@ -4,11 +4,23 @@ Utilties for collecting and distributing system data.
 Author: Jeff Kinnison (jkinniso@nd.edu)
 """
 
-__all__ = ['simstream', 'datareporter', 'datacollector',
-           'pikaasyncconsumer', 'pikaproducer']
+__all__ = ['simstream', 'aggregate', 'asyncioconsumer', 'backoff', 'batch', 'changefilter',
+           'chunking', 'codec', 'compression', 'connectionpool', 'datareporter', 'datacollector',
+           'flushpolicy', 'pikaasyncconsumer', 'pikaasyncpublisher', 'pikaproducer',
+           'ringbuffer', 'routing', 'scheduler', 'shmtransport', 'spool', 'timeseries']
 
 from .simstream import SimStream
+from .aggregate import Aggregator
+from .asyncioconsumer import AsyncioConsumer
+from .changefilter import ChangeFilter
+from .connectionpool import ConnectionPool
 from .datareporter import DataReporter, CollectorExistsException, CollectorDoesNotExistException
 from .datacollector import DataCollector
+from .flushpolicy import FlushPolicy
 from .pikaasyncconsumer import PikaAsyncConsumer
 from .pikaproducer import PikaProducer
+from .ringbuffer import RingBuffer
+from .routing import RoutingTable
+from .scheduler import CollectionScheduler
+from .shmtransport import SharedMemoryConsumer, SharedMemoryProducer
+from .timeseries import TimeSeriesCodec
@@ -0,0 +1,243 @@
+"""
+Utilities for summarizing collected data before it is published.
+
+An Aggregator sits between a collector's callback and its buffer. It
+folds every point into running statistics for the current time window
+and emits one summary point when the window closes, so a collector can
+sample at a fine resolution while publishing only compact summaries.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from bisect import bisect_right, insort
+import math
+import numbers
+import time
+
+
+STATISTICS = ("count", "min", "max", "mean", "last")
+
+
+class P2Quantile(object):
+    """Streaming estimate of one quantile in constant time and space.
+
+    Implements the P-square algorithm of Jain and Chlamtac, which tracks
+    five markers whose heights are adjusted with piecewise-parabolic
+    interpolation as points arrive.
+
+    Instance variables:
+    p -- the quantile being estimated, between 0 and 1
+
+    Public methods:
+    add -- fold in a new value
+    value -- get the current estimate
+    """
+
+    def __init__(self, p):
+        """
+        Arguments:
+        p -- the quantile to estimate, between 0 and 1
+        """
+        self.p = p
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        """
+        Fold a value into the estimate.
+
+        Arguments:
+        x -- the new value
+        """
+        heights = self._heights
+        if len(heights) < 5:
+            insort(heights, x)
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = bisect_right(heights, x) - 1
+        for i in range(k + 1, 5):
+            self._positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        n = self._positions
+        for i in (1, 2, 3):
+            d = self._desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                q = heights[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (heights[i + 1] - heights[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - d) * (heights[i] - heights[i - 1]) / (n[i] - n[i - 1]))
+                if not heights[i - 1] < q < heights[i + 1]: # Fall back to linear
+                    q = heights[i] + d * (heights[i + d] - heights[i]) / (n[i + d] - n[i])
+                heights[i] = q
+                n[i] += d
+
+    def value(self):
+        """
+        Get the current estimate, or None if no values were added.
+        """
+        if not self._heights:
+            return None
+        if len(self._heights) < 5:
+            return self._heights[int(round(self.p * (len(self._heights) - 1)))]
+        return self._heights[2]
+
+
+class _FieldSummary(object):
+    """Running statistics for one field within one window."""
+
+    def __init__(self, quantiles):
+        self.count = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.total = 0.0
+        self.last = None
+        self.numeric = True
+        self.sketches = [P2Quantile(q) for q in quantiles]
+
+    def add(self, value):
+        self.last = value
+        if self.numeric and (isinstance(value, bool) or not isinstance(value, numbers.Real)):
+            self.numeric = False # Only 'last' is meaningful from here on
+        if not self.numeric:
+            return
+        self.count += 1
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.total += value
+        for sketch in self.sketches:
+            sketch.add(value)
+
+    def statistics(self, names):
+        if not self.numeric:
+            return {"last": self.last} if "last" in names else {}
+        values = {"count": self.count, "min": self.minimum, "max": self.maximum,
+                  "mean": self.total / self.count, "last": self.last}
+        result = {name: values[name] for name in names}
+        for sketch in self.sketches:
+            result["p%g" % (sketch.p * 100)] = sketch.value()
+        return result
+
+
+class Aggregator(object):
+    """Summarizes a collector's points over fixed time windows.
+
+    Windows are aligned to multiples of window seconds since the epoch. A
+    window closes when the first point of a later window arrives (or when
+    close() is called), and its summary becomes a single data point:
+    {'t': window start, 'n': points in the window, <statistics>}. Numeric
+    points are summarized under the statistic names ('min', 'mean', ...);
+    dict points are summarized per field as '<field>_<statistic>'. Fields
+    that are not numeric keep only their last value. Lists returned by a
+    callback are treated as several points.
+
+    Each collector needs its own Aggregator.
+
+    Instance variables:
+    window -- the window length in seconds
+    statistics -- the statistics to publish, a subset of STATISTICS
+    quantiles -- the quantiles to estimate with P-square sketches, e.g.
+                 (0.5, 0.99), published as 'p50', 'p99'
+
+    Public methods:
+    add -- fold in a point, returning the summaries of any closed window
+    close -- close the current window and return its summary
+    """
+
+    def __init__(self, window, statistics=STATISTICS, quantiles=()):
+        """
+        Arguments:
+        window -- the window length in seconds
+
+        Keyword arguments:
+        statistics -- the statistics to publish (default STATISTICS)
+        quantiles -- the quantiles to estimate (default ())
+
+        Raises:
+        ValueError if window is not positive, a statistic is unknown, or a
+        quantile is not between 0 and 1
+        """
+        if window <= 0:
+            raise ValueError("Aggregation window must be positive")
+        for name in statistics:
+            if name not in STATISTICS:
+                raise ValueError("Unknown statistic %s" % (name))
+        for q in quantiles:
+            if not 0 < q < 1:
+                raise ValueError("Quantiles must be between 0 and 1")
+        self.window = window
+        self.statistics = tuple(statistics)
+        self.quantiles = tuple(quantiles)
+        self._start = None
+        self._count = 0
+        self._fields = None  # None for scalars, otherwise field -> _FieldSummary
+        self._scalar = None
+
+    def add(self, point, now=None):
+        """
+        Fold a point into the current window.
+
+        Arguments:
+        point -- the collected data point
+
+        Keyword arguments:
+        now -- the point's time.time() timestamp (default now)
+
+        Returns:
+        a list holding the summary of the window that closed, if any
+        """
+        now = time.time() if now is None else now
+        start = math.floor(now / self.window) * self.window
+        closed = []
+        if self._start is not None and start != self._start:
+            closed.append(self.close())
+        if self._start is None:
+            self._start = start
+
+        for item in (point if isinstance(point, list) else [point]):
+            self._count += 1
+            if isinstance(item, dict):
+                if self._fields is None:
+                    self._fields = {}
+                for key, value in item.items():
+                    if key not in self._fields:
+                        self._fields[key] = _FieldSummary(self.quantiles)
+                    self._fields[key].add(value)
+            else:
+                if self._scalar is None:
+                    self._scalar = _FieldSummary(self.quantiles)
+                self._scalar.add(item)
+        return closed
+
+    def close(self):
+        """
+        Close the current window.
+
+        Returns:
+        the window's summary, or None if no points were added
+        """
+        if self._start is None:
+            return None
+        summary = {"t": self._start, "n": self._count}
+        if self._scalar is not None:
+            summary.update(self._scalar.statistics(self.statistics))
+        for key, field in (self._fields or {}).items():
+            for name, value in field.statistics(self.statistics).items():
+                summary["%s_%s" % (key, name)] = value
+        self._start = None
+        self._count = 0
+        self._fields = None
+        self._scalar = None
+        return summary
@@ -0,0 +1,436 @@
+"""
+Utilities for consuming streamed data from asyncio applications.
+
+An AsyncioConsumer runs on the caller's asyncio event loop instead of a
+pika ioloop of its own, so one process can serve many streams without a
+thread per consumer. Consumers on the same loop and broker share one
+connection, each with its own channel.
+
+    async with AsyncioConsumer(url, "simstream", "memory") as consumer:
+        async for deliveries in consumer:
+            for delivery in deliveries:
+                print(delivery.routing_key, delivery.body)
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import asyncio
+from collections import deque
+import time
+
+import pika
+
+try:
+    from pika.adapters.asyncio_connection import AsyncioConnection
+except ImportError: # pika < 0.11
+    AsyncioConnection = None
+
+from . import chunking
+from .backoff import Backoff
+from .pikaasyncconsumer import _HANDLED, _UNREADABLE, _handle_batch
+
+
+class _SharedConnection(object):
+    """One AsyncioConnection shared by every consumer on an event loop that
+    uses the same broker. It reconnects with backoff until the last
+    consumer detaches, and reopens each consumer's channel."""
+
+    def __init__(self, url, loop):
+        self.url = url
+        self.loop = loop
+        self.connection = None
+        self.connects = 0
+        self.consumers = set()
+        self.backoff = Backoff()
+        self.is_open = False
+        self._closing = False
+        self._connect()
+
+    def attach(self, consumer):
+        """
+        Add a consumer, opening its channel if the connection is up.
+
+        Arguments:
+        consumer -- the AsyncioConsumer to serve
+        """
+        self.consumers.add(consumer)
+        if self.is_open:
+            consumer._open_channel(self.connection)
+
+    def detach(self, consumer):
+        """
+        Remove a consumer, closing the connection after the last one.
+
+        Arguments:
+        consumer -- the AsyncioConsumer to stop serving
+        """
+        self.consumers.discard(consumer)
+        if not self.consumers:
+            self._closing = True
+            _connections.pop((self.loop, self.url), None)
+            if self.connection is not None and self.is_open:
+                self.connection.close()
+
+    def _connect(self):
+        if self._closing:
+            return
+        self.connection = AsyncioConnection(parameters=pika.URLParameters(self.url),
+                                            on_open_callback=self._on_open,
+                                            on_open_error_callback=self._on_open_error,
+                                            on_close_callback=self._on_close,
+                                            custom_ioloop=self.loop)
+
+    def _on_open(self, connection):
+        if self._closing: # The last consumer detached while connecting
+            connection.close()
+            return
+        self.is_open = True
+        self.connects += 1
+        self.backoff.succeeded()
+        for consumer in list(self.consumers):
+            consumer._open_channel(connection)
+
+    def _on_open_error(self, connection, error=None):
+        self._on_close(connection)
+
+    def _on_close(self, connection, *unused_reason):
+        self.is_open = False
+        for consumer in list(self.consumers):
+            consumer._on_channel_lost()
+        if not self._closing:
+            self.loop.call_later(self.backoff.failed(), self._connect)
+
+
+_connections = {} # (event loop, url) -> _SharedConnection
+
+
+def _shared_connection(url, loop):
+    """
+    Get the connection serving a broker URL on an event loop, opening it on
+    first use.
+
+    Arguments:
+    url -- the url of the RabbitMQ server
+    loop -- the running event loop
+    """
+    key = (loop, url)
+    if key not in _connections:
+        _connections[key] = _SharedConnection(url, loop)
+    return _connections[key]
+
+
+class AsyncioConsumer(object):
+    """Delivers messages to asyncio code as batches via async iteration.
+
+    Each iteration returns a list of Delivery tuples (see
+    simstream.pikaasyncconsumer) holding up to batch_size messages. The
+    messages of a batch are acknowledged when the next batch is requested
+    or the consumer is closed, so a message is only lost if it was
+    handled. If the body of an async for loop raises inside an async with
+    block, the current batch is requeued instead.
+
+    Backpressure is cooperative: the server delivers at most max_buffered
+    messages that have not been acknowledged, so a slow reader stops
+    deliveries to its queue rather than growing the buffer, while other
+    consumers on the loop keep receiving.
+
+    Messages that cannot be decompressed or decoded are rejected without
+    requeueing and are never returned. Chunked messages are reassembled;
+    their chunks are acknowledged with the batch they arrive in, so that
+    a message with more chunks than max_buffered can complete.
+
+    Instance variables:
+    stats -- a dict of counters: 'received', 'acked' and 'rejected'
+
+    Public methods:
+    start -- connect and begin consuming
+    close -- acknowledge the current batch and stop consuming
+    """
+
+    def __init__(self, rabbitmq_url, exchange_name, queue_name, exchange_type="direct",
+                 routing_key="#", decode=False, expand_batches=False, batch_size=100,
+                 batch_interval=0.05, max_buffered=1000, chunk_timeout=30.0,
+                 chunk_memory=64 * 2**20):
+        """
+        Arguments:
+        rabbitmq_url -- URL to RabbitMQ server
+        exchange_name -- name of RabbitMQ exchange to join
+        queue_name -- name of RabbitMQ queue to join
+
+        Keyword arguments:
+        exchange_type -- one of 'direct', 'topic', 'fanout', 'headers'
+                         (default 'direct')
+        routing_key -- the routing key that this consumer listens for
+                       (default '#', receives all messages)
+        decode -- if True, decode each message with the codec announced in
+                  its content_type (see simstream.codec) (default False)
+        expand_batches -- if True, decode each message and expand columnar
+                          batches into rows (default False)
+        batch_size -- the most messages returned by one iteration
+                      (default 100)
+        batch_interval -- the most seconds an iteration waits for a
+                          partial batch to fill once a message is
+                          available (default 0.05)
+        max_buffered -- the most messages delivered but not yet
+                        acknowledged, used as the channel's prefetch count
+                        (default 1000)
+        chunk_timeout -- seconds a chunked message (see simstream.chunking)
+                         waits for its next chunk before it is dropped
+                         (default 30.0)
+        chunk_memory -- the most bytes held for incomplete chunked
+                        messages (default 64 MiB)
+
+        Raises:
+        ValueError if batch_size is not positive or exceeds max_buffered
+        RuntimeError if the installed pika has no asyncio adapter
+        """
+        if AsyncioConnection is None:
+            raise RuntimeError("AsyncioConsumer requires pika >= 0.11")
+        if not 0 < batch_size <= max_buffered:
+            raise ValueError("batch_size must be positive and at most max_buffered")
+        self._url = rabbitmq_url
+        self._exchange = exchange_name
+        self._exchange_type = exchange_type
+        self._queue = queue_name
+        self._routing_key = routing_key
+        self._decode = decode or expand_batches
+        self._expand_batches = expand_batches
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._max_buffered = max_buffered
+        self.stats = {"received": 0, "acked": 0, "rejected": 0}
+        self.reassembler = chunking.Reassembler(timeout=chunk_timeout, max_bytes=chunk_memory)
+
+        self._shared = None
+        self._channel = None
+        self._consumer_tag = None
+        self._buffer = deque()  # Received messages not yet returned
+        self._current = []      # Delivery tags of the last batch returned
+        self._epoch = 0         # Incremented whenever delivery tags are invalidated
+        self._current_epoch = 0
+        self._ready = None
+        self._consuming = None
+        self._closed = False
+
+    async def start(self):
+        """
+        Connect to the broker, if not yet connected, and wait until the
+        consumer is registered with its queue.
+        """
+        if self._closed:
+            raise RuntimeError("Consumer is closed")
+        if self._shared is None:
+            self._ready = asyncio.Event()
+            self._consuming = asyncio.Event()
+            self._shared = _shared_connection(self._url, asyncio.get_running_loop())
+            self._shared.attach(self)
+        await self._consuming.wait()
+
+    async def close(self, requeue=False):
+        """
+        Settle the current batch and stop consuming. Messages received but
+        not yet returned are redelivered by the server.
+
+        Keyword arguments:
+        requeue -- if True, requeue the current batch instead of
+                   acknowledging it (default False)
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if requeue:
+            self._requeue_current()
+        else:
+            self._ack_current()
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+        self._buffer.clear()
+        if self._shared is not None:
+            self._shared.detach(self)
+            self._ready.set()
+            self._consuming.set()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close(requeue=exc_type is not None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Acknowledge the previous batch and wait for the next one.
+        """
+        if self._shared is None and not self._closed:
+            await self.start()
+        self._ack_current()
+        while True:
+            while not self._buffer:
+                if self._closed:
+                    raise StopAsyncIteration
+                self._ready.clear()
+                await self._ready.wait()
+
+            deadline = time.monotonic() + self._batch_interval
+            while len(self._buffer) < self._batch_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._ready.clear()
+                try:
+                    await asyncio.wait_for(self._ready.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if not self._buffer: # The channel was lost while waiting
+                continue
+
+            count = min(self._batch_size, len(self._buffer))
+            messages, chunk_tags = self._reassemble(self._buffer.popleft()
+                                                    for _ in range(count))
+            deliveries = []
+            outcomes = _handle_batch(deliveries.extend, messages, self._decode,
+                                     self._expand_batches)
+            for message, outcome in zip(messages, outcomes):
+                if outcome == _UNREADABLE and message[-1] is not None:
+                    self._reject(message[-1])
+            handled = [message[-1] for message, outcome in zip(messages, outcomes)
+                       if outcome == _HANDLED and message[-1] is not None]
+            self._current = sorted(chunk_tags + handled)
+            self._current_epoch = self._epoch
+            if deliveries:
+                return deliveries
+            self._ack_current() # Only chunks or unreadable messages
+
+    def _reassemble(self, messages):
+        """
+        Pass chunks to the reassembler, replacing them with the messages
+        they complete. Reassembled messages have no delivery tag.
+
+        Arguments:
+        messages -- buffered message tuples, as built by _on_message
+
+        Returns:
+        a tuple of the whole messages and the delivery tags of the chunks
+        """
+        whole = []
+        chunk_tags = []
+        for message in messages:
+            if message[1] != chunking.CONTENT_TYPE:
+                whole.append(message)
+                continue
+            try:
+                reassembled = self.reassembler.add(message[0])
+            except ValueError as e:
+                print("[ERROR] Could not read chunk: %s" % (e))
+                self._reject(message[-1])
+                continue
+            chunk_tags.append(message[-1])
+            if reassembled is not None:
+                whole.append(reassembled + message[3:5] + (None,))
+        return whole, chunk_tags
+
+    def _reject(self, delivery_tag):
+        """
+        Reject an unreadable message without requeueing it.
+
+        Arguments:
+        delivery_tag -- the message's delivery tag
+        """
+        if self._channel is not None:
+            self._channel.basic_nack(delivery_tag=delivery_tag, multiple=False, requeue=False)
+            self.stats["rejected"] += 1
+
+    def _ack_current(self):
+        """
+        Acknowledge the last batch returned with a single multiple ack. It
+        holds the oldest unsettled messages on the channel, since batches
+        are returned in delivery order and unreadable messages are
+        rejected as they are read.
+        """
+        if self._current and self._channel is not None and self._current_epoch == self._epoch:
+            self._channel.basic_ack(delivery_tag=self._current[-1], multiple=True)
+            self.stats["acked"] += len(self._current)
+        self._current = []
+
+    def _requeue_current(self):
+        """
+        Return the last batch returned to the queue.
+        """
+        if self._current and self._channel is not None and self._current_epoch == self._epoch:
+            self._channel.basic_nack(delivery_tag=self._current[-1], multiple=True,
+                                     requeue=True)
+        self._current = []
+
+    def _open_channel(self, connection):
+        """
+        Open this consumer's channel on the shared connection.
+
+        Arguments:
+        connection -- the open AsyncioConnection
+        """
+        if not self._closed:
+            connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        if self._closed:
+            channel.close()
+            return
+        self._channel = channel
+        self._channel.add_on_close_callback(self._on_channel_close)
+        self._channel.exchange_declare(self._on_exchange_declared, self._exchange,
+                                       self._exchange_type)
+
+    def _on_exchange_declared(self, unused_frame):
+        self._channel.queue_declare(self._on_queue_declared, self._queue)
+
+    def _on_queue_declared(self, unused_frame):
+        self._channel.queue_bind(self._on_queue_bound, self._queue, self._exchange,
+                                 self._routing_key)
+
+    def _on_queue_bound(self, unused_frame):
+        self._channel.basic_qos(self._on_qos, prefetch_count=self._max_buffered)
+
+    def _on_qos(self, unused_frame):
+        self._consumer_tag = self._channel.basic_consume(self._on_message, queue=self._queue)
+        self._consuming.set()
+
+    def _on_message(self, channel, method, properties, body):
+        """
+        Buffer a message until the next iteration.
+
+        Arguments:
+        channel -- the channel that routed the message
+        method -- delivery information
+        properties -- message properties
+        body -- the message
+        """
+        timestamp = getattr(properties, "timestamp", None) or time.time()
+        self._buffer.append((body, properties.content_type, properties.content_encoding,
+                             method.routing_key, timestamp, method.delivery_tag))
+        self.stats["received"] += 1
+        self._ready.set()
+
+    def _on_channel_close(self, channel, *unused_reason):
+        """
+        Reopen the channel after the server closed it, unless closing.
+        """
+        if channel is not self._channel:
+            return
+        self._on_channel_lost()
+        if not self._closed and self._shared is not None and self._shared.is_open:
+            self._shared.loop.call_later(self._shared.backoff.failed(), self._open_channel,
+                                         self._shared.connection)
+
+    def _on_channel_lost(self):
+        """
+        Forget the channel and its delivery tags; the server redelivers
+        every message that was not acknowledged.
+        """
+        self._channel = None
+        self._buffer.clear()
+        self._epoch += 1
+        self._consuming.clear()
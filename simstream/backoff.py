@@ -0,0 +1,88 @@
+"""
+Utilities for pacing reconnect attempts.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import random
+import time
+
+
+class Backoff(object):
+    """Exponential backoff with jitter that also measures outages.
+
+    Call failed() whenever a connection attempt fails or a connection is
+    lost; it starts an outage if none is in progress and returns how long
+    to wait before the next attempt. Call succeeded() once connected again
+    to end the outage and reset the delay.
+
+    Instance variables:
+    initial -- the delay in seconds after the first failure
+    maximum -- the largest delay in seconds
+    multiplier -- the factor the delay grows by after each failure
+    jitter -- the fraction of each delay that is randomized, so that many
+              clients do not reconnect in lockstep
+    attempts -- the number of failures in the current outage
+    outages -- the number of outages so far
+    outage_seconds -- the total length of all finished outages
+    last_outage -- the length of the most recent finished outage
+
+    Public methods:
+    failed -- record a failure and get the delay before the next attempt
+    succeeded -- record a successful (re)connection
+    outage -- get the length of the outage in progress
+    """
+
+    def __init__(self, initial=0.5, maximum=30.0, multiplier=2.0, jitter=0.5):
+        """
+        Keyword arguments:
+        initial -- the delay in seconds after the first failure
+                   (default 0.5)
+        maximum -- the largest delay in seconds (default 30.0)
+        multiplier -- the factor the delay grows by after each failure
+                      (default 2.0)
+        jitter -- the fraction of each delay that is randomized, between
+                  0 and 1 (default 0.5)
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.attempts = 0
+        self.outages = 0
+        self.outage_seconds = 0.0
+        self.last_outage = 0.0
+        self._outage_start = None
+
+    def failed(self):
+        """
+        Record a failed attempt or lost connection.
+
+        Returns:
+        the number of seconds to wait before trying again
+        """
+        if self._outage_start is None:
+            self._outage_start = time.monotonic()
+            self.outages += 1
+        delay = min(self.maximum, self.initial * self.multiplier ** self.attempts)
+        self.attempts += 1
+        return delay * (1 - self.jitter * random.random())
+
+    def succeeded(self):
+        """
+        Record a successful connection, ending any outage in progress.
+        """
+        if self._outage_start is not None:
+            self.last_outage = time.monotonic() - self._outage_start
+            self.outage_seconds += self.last_outage
+            self._outage_start = None
+        self.attempts = 0
+
+    def outage(self):
+        """
+        Get the number of seconds the outage in progress has lasted, or 0 if
+        connected.
+        """
+        if self._outage_start is None:
+            return 0.0
+        return time.monotonic() - self._outage_start
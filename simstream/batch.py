@@ -0,0 +1,103 @@
+"""
+Utilities for packing collected data into columnar batches.
+
+A columnar message holds one batch per collector. Collectors whose points
+are dicts send {"n": count, "columns": {field: [values...]}}; any other
+collector sends {"n": count, "values": [values...]}. Numeric columns are
+array.array instances until they are encoded for transport.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from array import array
+
+
+FORMAT = "columnar"
+
+
+def column_batch(drained):
+    """
+    Build a collector's batch from the output of RingBuffer.drain_columns.
+
+    Lists returned by a collector are merged into the batch rather than
+    nested in it.
+
+    Arguments:
+    drained -- a dict of typed columns, a typed array or a list of points
+
+    Returns:
+    the collector's batch dict
+    """
+    if isinstance(drained, dict):
+        n = len(next(iter(drained.values()))) if drained else 0
+        return {"n": n, "columns": drained}
+    if isinstance(drained, array):
+        return {"n": len(drained), "values": drained}
+
+    points = []
+    for point in drained:
+        if isinstance(point, list):
+            points.extend(point)
+        else:
+            points.append(point)
+
+    if points and all(isinstance(point, dict) for point in points):
+        return {"n": len(points), "columns": columns_from_rows(points)}
+    return {"n": len(points), "values": points}
+
+
+def columns_from_rows(rows):
+    """
+    Transpose a list of dicts into a dict of columns. Fields missing from a
+    row are filled with None.
+
+    Arguments:
+    rows -- the list of dicts to transpose
+    """
+    fields = {}
+    for row in rows:
+        for key in row:
+            fields[key] = None
+    return {key: [row.get(key) for row in rows] for key in fields}
+
+
+def pack(batches):
+    """
+    Wrap per-collector batches in a columnar message.
+
+    Arguments:
+    batches -- a dict mapping collector names to batches
+    """
+    return {"format": FORMAT, "collectors": batches}
+
+
+def is_columnar(message):
+    """
+    Check whether a decoded message is a columnar message.
+
+    Arguments:
+    message -- the decoded message
+    """
+    return isinstance(message, dict) and message.get("format") == FORMAT
+
+
+def to_rows(message):
+    """
+    Expand a columnar message into the row format, one list of points per
+    collector.
+
+    Arguments:
+    message -- the decoded columnar message
+
+    Returns:
+    a dict mapping collector names to lists of data points
+    """
+    data = {}
+    for name, batch in message["collectors"].items():
+        if "columns" in batch:
+            fields = list(batch["columns"])
+            columns = [batch["columns"][key] for key in fields]
+            data[name] = [dict(zip(fields, row)) for row in zip(*columns)]
+        else:
+            data[name] = list(batch["values"])
+    return data
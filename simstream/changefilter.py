@@ -0,0 +1,116 @@
+"""
+Utilities for emitting collected data only when it changes.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import numbers
+import time
+
+
+class ChangeFilter(object):
+    """Suppresses data points that repeat the last emitted point.
+
+    A point is emitted if it differs from the last emitted point by more
+    than the deadband, or if heartbeat seconds have passed since the last
+    emission. Numbers are compared against the absolute and relative
+    deadbands. Any other value must be equal to count as unchanged. Dict
+    points change if any compared field changes. Comparing against the
+    last emitted point, rather than the last seen one, keeps slow drifts
+    from hiding inside the deadband.
+
+    Consumers rebuild the full series by holding each emitted value until
+    the next one. The held value is always within the deadband of the
+    true value, and a heartbeat shows that a flat value is still fresh.
+
+    Each collector needs its own ChangeFilter.
+
+    Instance variables:
+    absolute -- the largest absolute change treated as no change, or None
+    relative -- the largest change relative to the last emitted value
+                treated as no change, or None
+    heartbeat -- seconds after which an unchanged point is emitted anyway,
+                 or None to never repeat a point
+    fields -- the dict fields to compare, or None for all (e.g. to ignore
+              a timestamp field)
+    emitted -- the number of points let through
+    suppressed -- the number of points dropped as unchanged
+
+    Public methods:
+    accept -- decide whether a point should be emitted
+    """
+
+    def __init__(self, absolute=None, relative=None, heartbeat=None, fields=None):
+        """
+        Keyword arguments:
+        absolute -- the absolute deadband (default None)
+        relative -- the relative deadband, e.g. 0.01 for 1% (default None)
+        heartbeat -- seconds between emissions of an unchanged point
+                     (default None)
+        fields -- the dict fields to compare, or None for all
+                  (default None)
+        """
+        self.absolute = absolute
+        self.relative = relative
+        self.heartbeat = heartbeat
+        self.fields = fields
+        self.emitted = 0
+        self.suppressed = 0
+        self._last = None
+        self._last_time = None
+
+    def accept(self, point, now=None):
+        """
+        Decide whether to emit a point, remembering it if so.
+
+        Arguments:
+        point -- the data point
+
+        Keyword arguments:
+        now -- the time.monotonic() time of the point (default now)
+
+        Returns:
+        True if the point should be emitted
+        """
+        now = time.monotonic() if now is None else now
+        if (self._last_time is None or self._changed(self._last, point) or
+                (self.heartbeat is not None and now - self._last_time >= self.heartbeat)):
+            self._last = point
+            self._last_time = now
+            self.emitted += 1
+            return True
+        self.suppressed += 1
+        return False
+
+    def _changed(self, last, point):
+        """
+        Check whether a point differs from the last emitted point by more
+        than the deadband.
+
+        Arguments:
+        last -- the last emitted point
+        point -- the new point
+        """
+        if isinstance(point, dict) and isinstance(last, dict):
+            keys = self.fields if self.fields is not None else set(point) | set(last)
+            return any(self._value_changed(last.get(key), point.get(key)) for key in keys)
+        return self._value_changed(last, point)
+
+    def _value_changed(self, last, value):
+        """
+        Check whether one value differs from its last emitted value by more
+        than the deadband.
+
+        Arguments:
+        last -- the last emitted value
+        value -- the new value
+        """
+        if (isinstance(value, numbers.Real) and isinstance(last, numbers.Real) and
+                not isinstance(value, bool) and not isinstance(last, bool)):
+            change = abs(value - last)
+            if self.absolute is not None and change <= self.absolute:
+                return False
+            if self.relative is not None and change <= self.relative * abs(last):
+                return False
+            return change != 0
+        return value != last
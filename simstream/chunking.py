@@ -0,0 +1,181 @@
+"""
+Utilities for sending messages too large for one broker message.
+
+A large message is split into chunks that are published as separate
+messages with the content type CONTENT_TYPE. Each chunk starts with a
+header holding the message's stream id, the chunk's index, the number
+of chunks and the original content type and encoding, so chunks can be
+reassembled in any order and duplicates are ignored.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from collections import OrderedDict
+import struct
+import time
+import uuid
+
+
+CONTENT_TYPE = "application/x-simstream-chunk"
+
+_HEADER = struct.Struct("<16sIIBB") # stream id, index, count, content type and encoding lengths
+_FINISHED_STREAMS = 4096            # Finished stream ids remembered to ignore late chunks
+
+
+def split(body, content_type, content_encoding, chunk_size):
+    """
+    Split a message into chunks if it is larger than chunk_size.
+
+    Arguments:
+    body -- the message body
+    content_type -- the message's content_type
+    content_encoding -- the message's content_encoding
+    chunk_size -- the largest body in bytes sent as a single message
+
+    Returns:
+    a list of (body, content_type, content_encoding) tuples to publish in
+    order; the message itself if it is small enough
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    if chunk_size is None or len(body) <= chunk_size:
+        return [(body, content_type, content_encoding)]
+
+    stream_id = uuid.uuid4().bytes
+    ctype = (content_type or "").encode()
+    encoding = (content_encoding or "").encode()
+    view = memoryview(body)
+    count = (len(body) + chunk_size - 1) // chunk_size
+    return [(b"".join((_HEADER.pack(stream_id, index, count, len(ctype), len(encoding)),
+                       ctype, encoding, view[index * chunk_size:(index + 1) * chunk_size])),
+             CONTENT_TYPE, None)
+            for index in range(count)]
+
+
+class Reassembler(object):
+    """Rebuilds chunked messages on the consumer side.
+
+    Incomplete messages are dropped once timeout seconds pass without a
+    new chunk, and the oldest are dropped whenever the chunks held exceed
+    max_bytes, so lost chunks cannot exhaust memory.
+
+    Instance variables:
+    timeout -- seconds an incomplete message waits for its next chunk
+    max_bytes -- the most chunk bytes held for incomplete messages
+    stats -- a dict of counters: 'reassembled', 'expired' and 'evicted'
+
+    Public methods:
+    add -- add a chunk, returning the message once it is complete
+    expire -- drop incomplete messages that have timed out
+    """
+
+    def __init__(self, timeout=30.0, max_bytes=64 * 2**20):
+        """
+        Keyword arguments:
+        timeout -- seconds an incomplete message waits for its next chunk
+                   (default 30.0)
+        max_bytes -- the most chunk bytes held for incomplete messages
+                     (default 64 MiB)
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.stats = {"reassembled": 0, "expired": 0, "evicted": 0}
+        self._streams = OrderedDict() # stream id -> [last chunk time, count, {index: chunk}]
+        self._finished = OrderedDict() # Recently completed or dropped stream ids
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._streams)
+
+    def add(self, chunk, now=None):
+        """
+        Add a chunk, dropping timed-out messages first.
+
+        Arguments:
+        chunk -- the body of a message with content type CONTENT_TYPE
+
+        Keyword arguments:
+        now -- the time.monotonic() time the chunk arrived (default now)
+
+        Returns:
+        a (body, content_type, content_encoding) tuple once every chunk of
+        the message has arrived, otherwise None
+
+        Raises:
+        ValueError if the chunk is malformed
+        """
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        try:
+            stream_id, index, count, ctype_length, encoding_length = _HEADER.unpack_from(chunk)
+        except struct.error:
+            raise ValueError("Truncated chunk header")
+        if index >= count:
+            raise ValueError("Chunk %d of %d is out of range" % (index, count))
+        start = _HEADER.size + ctype_length + encoding_length
+        fragment = bytes(chunk[start:])
+        if stream_id in self._finished: # A duplicate, or the rest of a dropped message
+            return None
+
+        if stream_id not in self._streams:
+            self._streams[stream_id] = [now, count, {}]
+        stream = self._streams[stream_id]
+        self._streams.move_to_end(stream_id)
+        stream[0] = now
+        if index not in stream[2]: # Ignore redelivered duplicates
+            stream[2][index] = fragment
+            self._bytes += len(fragment)
+        if len(stream[2]) < count:
+            self._evict()
+            return None
+
+        self._drop(stream_id)
+        chunks = stream[2]
+        self.stats["reassembled"] += 1
+        ctype = bytes(chunk[_HEADER.size:_HEADER.size + ctype_length]).decode() or None
+        encoding = bytes(chunk[_HEADER.size + ctype_length:start]).decode() or None
+        return b"".join(chunks[i] for i in range(count)), ctype, encoding
+
+    def expire(self, now=None):
+        """
+        Drop incomplete messages whose last chunk arrived more than timeout
+        seconds ago.
+
+        Keyword arguments:
+        now -- the current time.monotonic() time (default now)
+
+        Returns:
+        the number of messages dropped
+        """
+        now = time.monotonic() if now is None else now
+        expired = 0
+        while self._streams:
+            stream_id, stream = next(iter(self._streams.items()))
+            if now - stream[0] < self.timeout:
+                break
+            self._drop(stream_id)
+            expired += 1
+        self.stats["expired"] += expired
+        return expired
+
+    def _evict(self):
+        """
+        Drop the least recently extended messages until the chunks held fit
+        within max_bytes. A message larger than max_bytes is dropped too.
+        """
+        while self._bytes > self.max_bytes and self._streams:
+            self._drop(next(iter(self._streams)))
+            self.stats["evicted"] += 1
+
+    def _drop(self, stream_id):
+        """
+        Forget a message's chunks, ignoring any that arrive later.
+
+        Arguments:
+        stream_id -- the message's stream id
+        """
+        unused_time, unused_count, chunks = self._streams.pop(stream_id)
+        self._bytes -= sum(len(fragment) for fragment in chunks.values())
+        self._finished[stream_id] = None
+        if len(self._finished) > _FINISHED_STREAMS:
+            self._finished.popitem(last=False)
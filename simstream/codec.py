@@ -0,0 +1,377 @@
+"""
+Utilities for encoding messages for transport.
+
+Codecs are registered by name and by AMQP content type. Producers announce
+the codec they used in the message's content_type so that consumers can
+pick the matching decoder. Binary codecs also start each message with a
+self-describing header (MAGIC followed by a one-byte codec id) so that
+messages can be identified without their AMQP properties.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from array import array
+import json
+import numbers
+import struct
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAGIC = b"SS"
+
+
+class CodecDoesNotExistException(Exception):
+    """Thrown when looking up a codec that has not been registered."""
+    pass
+
+
+class Codec(object):
+    """Base class for message codecs.
+
+    Instance variables:
+    name -- the name used to select the codec
+    content_type -- the AMQP content type announced with each message
+    codec_id -- the header byte identifying the codec, or None if messages
+                carry no header
+
+    Public methods:
+    encode -- serialize data to bytes
+    decode -- deserialize bytes produced by encode, raising ValueError if
+              the message is malformed
+    """
+
+    name = None
+    content_type = None
+    codec_id = None
+
+    def encode(self, data):
+        raise NotImplementedError
+
+    def decode(self, body):
+        raise NotImplementedError
+
+    def header(self):
+        """
+        Get the self-describing header that starts each message.
+        """
+        return MAGIC + bytes([self.codec_id])
+
+
+_codecs = {}
+_content_types = {}
+_codec_ids = {}
+
+
+def register_codec(codec):
+    """
+    Make a codec available by name, content type and codec id.
+
+    Arguments:
+    codec -- the Codec instance to register
+    """
+    _codecs[codec.name] = codec
+    _content_types[codec.content_type] = codec
+    if codec.codec_id is not None:
+        _codec_ids[codec.codec_id] = codec
+
+
+def get_codec(name):
+    """
+    Look up a registered codec by name.
+
+    Arguments:
+    name -- the name of the codec
+
+    Raises:
+    CodecDoesNotExistException if no codec is registered under name
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise CodecDoesNotExistException(name)
+
+
+def detect_codec(body, content_type=None):
+    """
+    Find the codec that produced a message, using the AMQP content type if
+    known, then the message header, and falling back to JSON.
+
+    Arguments:
+    body -- the encoded message
+
+    Keyword arguments:
+    content_type -- the message's AMQP content type (default None)
+    """
+    if content_type in _content_types:
+        return _content_types[content_type]
+    if body[:len(MAGIC)] == MAGIC and len(body) > len(MAGIC):
+        codec_id = body[len(MAGIC)]
+        if codec_id in _codec_ids:
+            return _codec_ids[codec_id]
+    return _codecs["json"]
+
+
+def decode(body, content_type=None):
+    """
+    Decode a message with the codec that produced it.
+
+    Arguments:
+    body -- the encoded message
+
+    Keyword arguments:
+    content_type -- the message's AMQP content type (default None)
+    """
+    return detect_codec(body, content_type).decode(body)
+
+
+def _json_default(obj):
+    """
+    Convert typed arrays (e.g. columns of a columnar batch) to lists for
+    JSON serialization.
+
+    Arguments:
+    obj -- the object json could not serialize
+    """
+    if isinstance(obj, array) or (numpy is not None and isinstance(obj, numpy.ndarray)):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % (obj,))
+
+
+class JSONCodec(Codec):
+    """Plain JSON. Messages carry no header so existing consumers can keep
+    calling json.loads on the body."""
+
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, data):
+        return json.dumps(data, default=_json_default).encode()
+
+    def decode(self, body):
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            body = bytes(body).decode()
+        return json.loads(body)
+
+
+# Binary codec tags
+_NONE = b"N"
+_TRUE = b"T"
+_FALSE = b"F"
+_INT = b"i"
+_BIGINT = b"I"
+_FLOAT = b"f"
+_STR = b"s"
+_BYTES = b"b"
+_LIST = b"l"
+_DICT = b"d"
+_ARRAY = b"a"
+
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+_ARRAY_HEADER = struct.Struct("<cBB")
+
+# (kind, itemsize) -> memoryview format
+_FORMATS = {
+    (b"f", 4): "f", (b"f", 8): "d",
+    (b"i", 1): "b", (b"i", 2): "h", (b"i", 4): "i", (b"i", 8): "q",
+    (b"u", 1): "B", (b"u", 2): "H", (b"u", 4): "I", (b"u", 8): "Q",
+}
+
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+class BinaryCodec(Codec):
+    """Compact, typed binary encoding.
+
+    Scalars, strings, lists and dicts are tagged and length-prefixed. Typed
+    arrays (array.array and 1-D or N-D numeric NumPy arrays) are written as
+    raw little-endian buffers aligned to 8 bytes, so the decoder returns
+    them as views over the message body: NumPy arrays via numpy.frombuffer
+    when NumPy is installed, otherwise memoryview casts.
+    """
+
+    name = "binary"
+    content_type = "application/x-simstream-binary"
+    codec_id = 1
+
+    def encode(self, data):
+        writer = _BinaryWriter(self.header())
+        writer.write(data)
+        return writer.getvalue()
+
+    def decode(self, body):
+        try:
+            value, unused_offset = self._decode(memoryview(body), len(MAGIC) + 1)
+        except (struct.error, IndexError, KeyError) as e:
+            raise ValueError("Malformed binary message: %s" % (e))
+        return value
+
+    def _decode(self, view, offset):
+        tag = view[offset:offset + 1].tobytes()
+        offset += 1
+        if tag == _NONE:
+            return None, offset
+        if tag == _TRUE:
+            return True, offset
+        if tag == _FALSE:
+            return False, offset
+        if tag == _INT:
+            return _I64.unpack_from(view, offset)[0], offset + 8
+        if tag == _FLOAT:
+            return _F64.unpack_from(view, offset)[0], offset + 8
+        if tag in (_STR, _BYTES, _BIGINT):
+            length = _U32.unpack_from(view, offset)[0]
+            offset += 4
+            raw = view[offset:offset + length].tobytes()
+            if tag == _STR:
+                raw = raw.decode()
+            elif tag == _BIGINT:
+                raw = int(raw)
+            return raw, offset + length
+        if tag == _LIST:
+            count = _U32.unpack_from(view, offset)[0]
+            offset += 4
+            items = []
+            for _ in range(count):
+                item, offset = self._decode(view, offset)
+                items.append(item)
+            return items, offset
+        if tag == _DICT:
+            count = _U32.unpack_from(view, offset)[0]
+            offset += 4
+            items = {}
+            for _ in range(count):
+                key, offset = self._decode(view, offset)
+                items[key], offset = self._decode(view, offset)
+            return items, offset
+        if tag == _ARRAY:
+            return self._decode_buffer(view, offset)
+        raise ValueError("Unknown binary codec tag %r at offset %d" % (tag, offset - 1))
+
+    def _decode_buffer(self, view, offset):
+        """
+        Read a typed array as a view over the message body.
+
+        Arguments:
+        view -- a memoryview of the message
+        offset -- the offset just past the array tag
+        """
+        kind, itemsize, ndim = _ARRAY_HEADER.unpack_from(view, offset)
+        offset += _ARRAY_HEADER.size
+        shape = tuple(_U32.unpack_from(view, offset + 4 * i)[0] for i in range(ndim))
+        offset += 4 * ndim
+        nbytes = _U32.unpack_from(view, offset)[0]
+        offset += 4
+        offset += 1 + view[offset]
+        raw = view[offset:offset + nbytes]
+
+        if numpy is not None:
+            dtype = numpy.dtype("<%s%d" % (kind.decode(), itemsize))
+            value = numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+        elif _LITTLE_ENDIAN:
+            fmt = _FORMATS[(kind, itemsize)]
+            value = raw.cast(fmt, shape) if nbytes else raw.cast(fmt)
+        else:
+            value = array(_FORMATS[(kind, itemsize)], raw.tobytes())
+            value.byteswap()
+        return value, offset + nbytes
+
+
+class _BinaryWriter(object):
+    """Accumulates the chunks of one binary-encoded message."""
+
+    def __init__(self, header):
+        self._parts = [header]
+        self._offset = len(header)
+
+    def getvalue(self):
+        return b"".join(self._parts)
+
+    def _append(self, chunk):
+        self._parts.append(chunk)
+        self._offset += len(chunk)
+
+    def write(self, obj):
+        """
+        Append one tagged value.
+
+        Arguments:
+        obj -- the value to encode
+
+        Raises:
+        TypeError if obj has no binary representation
+        """
+        if obj is None:
+            self._append(_NONE)
+        elif obj is True:
+            self._append(_TRUE)
+        elif obj is False:
+            self._append(_FALSE)
+        elif isinstance(obj, numbers.Integral):
+            obj = int(obj)
+            if -2**63 <= obj < 2**63:
+                self._append(_INT + _I64.pack(obj))
+            else:
+                digits = str(obj).encode()
+                self._append(_BIGINT + _U32.pack(len(digits)) + digits)
+        elif isinstance(obj, numbers.Real):
+            self._append(_FLOAT + _F64.pack(float(obj)))
+        elif isinstance(obj, str):
+            raw = obj.encode()
+            self._append(_STR + _U32.pack(len(raw)) + raw)
+        elif isinstance(obj, (bytes, bytearray)):
+            self._append(_BYTES + _U32.pack(len(obj)))
+            self._append(bytes(obj))
+        elif isinstance(obj, array) and obj.typecode != "u":
+            kind = b"f" if obj.typecode in "fd" else (b"u" if obj.typecode.isupper() else b"i")
+            self._write_buffer(kind, obj.itemsize, (len(obj),), obj)
+        elif numpy is not None and isinstance(obj, numpy.ndarray):
+            if obj.dtype.kind in "fiu":
+                contiguous = numpy.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder("<"))
+                self._write_buffer(obj.dtype.kind.encode(), obj.dtype.itemsize,
+                                   contiguous.shape, contiguous)
+            else:
+                self.write(obj.tolist())
+        elif isinstance(obj, dict):
+            self._append(_DICT + _U32.pack(len(obj)))
+            for key in obj:
+                self.write(key)
+                self.write(obj[key])
+        elif isinstance(obj, (list, tuple)):
+            self._append(_LIST + _U32.pack(len(obj)))
+            for item in obj:
+                self.write(item)
+        else:
+            raise TypeError("%r cannot be encoded by the binary codec" % (obj,))
+
+    def _write_buffer(self, kind, itemsize, shape, buf):
+        """
+        Append a typed array as a raw little-endian buffer, padded so that
+        the data starts on an 8-byte boundary of the message.
+
+        Arguments:
+        kind -- b'f', b'i' or b'u'
+        itemsize -- the size of one element in bytes
+        shape -- the array's shape
+        buf -- an object exposing the array's contiguous buffer
+        """
+        if not _LITTLE_ENDIAN and itemsize > 1 and isinstance(buf, array):
+            buf = array(buf.typecode, buf)
+            buf.byteswap()
+        view = memoryview(buf).cast("B")
+
+        header = _ARRAY + _ARRAY_HEADER.pack(kind, itemsize, len(shape))
+        header += b"".join(_U32.pack(n) for n in shape) + _U32.pack(len(view))
+        padding = -(self._offset + len(header) + 1) % 8
+        self._append(header + bytes([padding]) + b"\0" * padding)
+        self._append(view)
+
+
+register_codec(JSONCodec())
+register_codec(BinaryCodec())
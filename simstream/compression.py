@@ -0,0 +1,154 @@
+"""
+Utilities for compressing messages for transport.
+
+Compressors are registered under the name sent in a message's AMQP
+content_encoding, so consumers can decompress transparently.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import lzma
+import zlib
+
+
+class CompressorDoesNotExistException(Exception):
+    """Thrown when looking up a compressor that has not been registered."""
+    pass
+
+
+_compressors = {}
+
+
+def register_compressor(name, compress, decompress):
+    """
+    Make a compression scheme available by name.
+
+    Arguments:
+    name -- the name announced in content_encoding
+    compress -- a function taking bytes and returning compressed bytes
+    decompress -- a function reversing compress
+    """
+    _compressors[name] = (compress, decompress)
+
+
+def get_compressor(name):
+    """
+    Look up the compress and decompress functions for a scheme.
+
+    Arguments:
+    name -- the name of the compression scheme
+
+    Returns:
+    a (compress, decompress) tuple
+
+    Raises:
+    CompressorDoesNotExistException if no scheme is registered under name
+    """
+    try:
+        return _compressors[name]
+    except KeyError:
+        raise CompressorDoesNotExistException(name)
+
+
+def decompress(body, encoding):
+    """
+    Decompress a message body if its content_encoding names a registered
+    scheme; otherwise return it unchanged.
+
+    Arguments:
+    body -- the message body
+    encoding -- the message's content_encoding, or None
+    """
+    if encoding in _compressors:
+        return _compressors[encoding][1](body)
+    return body
+
+
+class Compressor(object):
+    """Compresses messages that are large enough and compress well enough.
+
+    Messages smaller than threshold are sent as-is. Larger messages are
+    compressed and kept only if the compressed size is at most
+    min_ratio times the original. Each time compression is not worth it,
+    the compressor skips twice as many messages (up to max_backoff) before
+    trying again, so incompressible streams stop paying for it.
+
+    Instance variables:
+    encoding -- the registered compression scheme
+    threshold -- the minimum message size in bytes to compress
+    min_ratio -- the largest compressed/original size ratio worth sending
+    bytes_in -- the total size of messages before compression
+    bytes_out -- the total size of messages after compression
+    compressed -- the number of messages sent compressed
+
+    Public methods:
+    compress -- compress a message if worthwhile
+    """
+
+    def __init__(self, encoding, threshold=1024, min_ratio=0.9, max_backoff=64):
+        """
+        Arguments:
+        encoding -- the name of a registered compression scheme
+
+        Keyword arguments:
+        threshold -- the minimum message size in bytes to compress
+                     (default 1024)
+        min_ratio -- the largest compressed/original size ratio worth
+                     sending (default 0.9)
+        max_backoff -- the most messages to skip after an unprofitable
+                       attempt (default 64)
+
+        Raises:
+        CompressorDoesNotExistException if encoding is not registered
+        """
+        self.encoding = encoding
+        self.threshold = threshold
+        self.min_ratio = min_ratio
+        self.max_backoff = max_backoff
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compressed = 0
+        self._compress = get_compressor(encoding)[0]
+        self._backoff = 0
+        self._skip = 0
+
+    def compress(self, body):
+        """
+        Compress a message if it is large enough and compresses well.
+
+        Arguments:
+        body -- the encoded message as bytes
+
+        Returns:
+        a tuple of the body to send and its content_encoding (None if the
+        body was not compressed)
+        """
+        self.bytes_in += len(body)
+        if len(body) < self.threshold or self._should_skip():
+            self.bytes_out += len(body)
+            return body, None
+
+        packed = self._compress(body)
+        if len(packed) > self.min_ratio * len(body):
+            self._backoff = min(max(2 * self._backoff, 1), self.max_backoff)
+            self._skip = self._backoff
+            self.bytes_out += len(body)
+            return body, None
+
+        self._backoff = 0
+        self.compressed += 1
+        self.bytes_out += len(packed)
+        return packed, self.encoding
+
+    def _should_skip(self):
+        """
+        Count down the messages left to skip after an unprofitable attempt.
+        """
+        if self._skip > 0:
+            self._skip -= 1
+            return True
+        return False
+
+
+register_compressor("zlib", zlib.compress, zlib.decompress)
+register_compressor("lzma", lzma.compress, lzma.decompress)
@@ -0,0 +1,218 @@
+"""
+Utilities for sharing broker connections between producers.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from contextlib import contextmanager
+import itertools
+from threading import Lock, RLock, enumerate as enumerate_threads, get_ident
+
+import pika
+from pika.exceptions import AMQPError
+
+
+class _PooledConnection(object):
+    """One BlockingConnection shared by several threads, each with its own
+    channel. BlockingConnection is not thread-safe, so callers hold lock
+    while using it."""
+
+    def __init__(self, url):
+        self.url = url
+        self.lock = RLock()
+        self.connection = None
+        self.connects = 0
+        self._channels = {}  # thread ident -> channel
+        self._exchanges = {} # thread ident -> set of declared exchanges
+
+    def is_healthy(self):
+        """
+        Service heartbeats and check that the connection is still open.
+        """
+        if self.connection is None or not self.connection.is_open:
+            return False
+        try:
+            self.connection.process_data_events(0)
+        except AMQPError:
+            self.close()
+        return self.connection is not None and self.connection.is_open
+
+    def channel(self, exchange=None, exchange_type="direct"):
+        """
+        Get the calling thread's channel, reconnecting if the connection
+        died and declaring the exchange the first time it is used.
+
+        Keyword arguments:
+        exchange -- an exchange to declare on the channel (default None)
+        exchange_type -- the type of the exchange (default 'direct')
+        """
+        if not self.is_healthy():
+            self.close()
+            self.connection = pika.BlockingConnection(pika.URLParameters(self.url))
+            self.connects += 1
+
+        ident = get_ident()
+        channel = self._channels.get(ident)
+        if channel is None or not channel.is_open:
+            self._prune()
+            channel = self.connection.channel()
+            self._channels[ident] = channel
+            self._exchanges[ident] = set()
+        if exchange is not None and exchange not in self._exchanges[ident]:
+            channel.exchange_declare(exchange=exchange, type=exchange_type)
+            self._exchanges[ident].add(exchange)
+        return channel
+
+    def close(self):
+        """
+        Close the connection and forget its channels.
+        """
+        self._channels.clear()
+        self._exchanges.clear()
+        if self.connection is not None:
+            try:
+                if self.connection.is_open:
+                    self.connection.close()
+            except AMQPError:
+                pass
+            self.connection = None
+
+    def _prune(self):
+        """
+        Close the channels of threads that have exited.
+        """
+        alive = set(thread.ident for thread in enumerate_threads())
+        for ident in list(self._channels):
+            if ident not in alive:
+                channel = self._channels.pop(ident)
+                self._exchanges.pop(ident, None)
+                try:
+                    channel.close()
+                except AMQPError:
+                    pass
+
+
+class ConnectionPool(object):
+    """Multiplexes producers over a few connections per broker URL.
+
+    Each thread is assigned one of the URL's connections (round robin) the
+    first time it publishes there, and gets its own channel on that
+    connection. Connections are opened lazily, checked before each use,
+    and replaced if they have died.
+
+    Instance variables:
+    connections_per_url -- the number of connections opened to each URL
+
+    Public methods:
+    channel -- borrow the calling thread's channel to a broker
+    check -- run a health check on every connection
+    close -- close every connection
+    stats -- get the number of connections and reconnects per URL
+    """
+
+    def __init__(self, connections_per_url=1):
+        """
+        Keyword arguments:
+        connections_per_url -- the number of connections opened to each
+                               broker URL (default 1)
+        """
+        self.connections_per_url = connections_per_url
+        self._lock = Lock()
+        self._connections = {} # url -> list of _PooledConnection
+        self._assignments = {} # (url, thread ident) -> _PooledConnection
+        self._counters = {}    # url -> round robin counter
+
+    @contextmanager
+    def channel(self, url, exchange=None, exchange_type="direct"):
+        """
+        Borrow the calling thread's channel to a broker. The connection is
+        locked for the duration of the with block and is reset if an AMQP
+        error escapes it, so that the next caller reconnects.
+
+        Arguments:
+        url -- the url of the RabbitMQ server
+
+        Keyword arguments:
+        exchange -- an exchange to declare before first use (default None)
+        exchange_type -- the type of the exchange (default 'direct')
+        """
+        pooled = self._assign(url)
+        with pooled.lock:
+            try:
+                yield pooled.channel(exchange, exchange_type)
+            except AMQPError:
+                pooled.close()
+                raise
+
+    def check(self):
+        """
+        Service heartbeats on every open connection and close dead ones.
+
+        Returns:
+        a dict mapping each URL to its number of healthy connections
+        """
+        with self._lock:
+            connections = {url: list(pooled) for url, pooled in self._connections.items()}
+        healthy = {}
+        for url, pooled_connections in connections.items():
+            healthy[url] = 0
+            for pooled in pooled_connections:
+                with pooled.lock:
+                    if pooled.is_healthy():
+                        healthy[url] += 1
+                    else:
+                        pooled.close()
+        return healthy
+
+    def close(self):
+        """
+        Close every connection. Later calls to channel() reconnect.
+        """
+        with self._lock:
+            connections = [pooled for url in self._connections for pooled in self._connections[url]]
+        for pooled in connections:
+            with pooled.lock:
+                pooled.close()
+
+    def stats(self):
+        """
+        Get the number of open connections and total connects per URL.
+        """
+        with self._lock:
+            return {url: {"open": sum(1 for pooled in pooled_connections
+                                      if pooled.connection is not None),
+                          "connects": sum(pooled.connects for pooled in pooled_connections)}
+                    for url, pooled_connections in self._connections.items()}
+
+    def _assign(self, url):
+        """
+        Get the connection serving the calling thread for a URL.
+
+        Arguments:
+        url -- the url of the RabbitMQ server
+        """
+        key = (url, get_ident())
+        with self._lock:
+            if key not in self._assignments:
+                if url not in self._connections:
+                    self._connections[url] = [_PooledConnection(url)
+                                              for _ in range(self.connections_per_url)]
+                    self._counters[url] = itertools.count()
+                index = next(self._counters[url]) % self.connections_per_url
+                self._assignments[key] = self._connections[url][index]
+            return self._assignments[key]
+
+
+_pool = None
+_pool_lock = Lock()
+
+
+def get_pool():
+    """
+    Get the process-wide connection pool, creating it on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
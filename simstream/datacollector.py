@@ -4,33 +4,83 @@ Utilties for collecting system data.
 Author: Jeff Kinnison (jkinniso@nd.edu)
 """
 
-from threading import Thread, Event
+import asyncio
+import concurrent.futures
+import inspect
 
-import copy
+from .ringbuffer import RingBuffer
 
-class DataCollector(Thread):
+
+EXECUTORS = ("thread", "process")
+
+
+def _collect_remote(callback, callback_args, postprocessor, postprocessor_args):
+    """
+    Run a callback and postprocessor in a worker process. The result is
+    pickled by the executor to be sent back, so it must be picklable.
+
+    Returns:
+    the postprocessed result of the callback
+    """
+    result = callback(*callback_args)
+    return postprocessor(result, *postprocessor_args) if postprocessor else result
+
+
+def _is_coroutine_callback(callback):
+    """
+    Check whether a callback is a coroutine function or an object whose
+    __call__ is one.
+
+    Arguments:
+    callback -- the callback to check
+    """
+    return (inspect.iscoroutinefunction(callback) or
+            inspect.iscoroutinefunction(getattr(callback, "__call__", None)))
+
+
+
+class DataCollector(object):
     """Collects data by running user-specified routines.
 
-    Inherits from: threading.Thread
+    Collectors do not own a thread. A CollectionScheduler calls run() every
+    interval seconds on a shared worker pool.
 
     Instance variables:
     name -- the name of the collector
     limit -- the maximum number of maintained data points
     interval -- the interval (in seconds) at which data collection is performed
+    buffer -- the RingBuffer holding the most recent limit data points
+    executor -- 'thread' to run the callback on the scheduler's worker
+                threads, 'process' to run it in a worker process
+    timeout -- seconds to wait for a process-executed or coroutine callback
+    is_coroutine -- True if the callback is a coroutine function
+    flush_policy -- a FlushPolicy overriding the reporter's, or None
+    aggregator -- the Aggregator summarizing results, or None
+    change_filter -- the ChangeFilter dropping unchanged points, or None
+    routing_keys -- the keys this collector's data is published to; empty
+                    to use the reporter's keys
+    listener -- a function called with this collector and each new point
 
     Public methods:
     activate -- start collecting data
     add_routing_key -- add a new streaming endpoint
+    busy -- check whether a timed-out run still occupies a worker process
     deactivate -- stop further data collection
     remove_routing_key -- remove a streaming endpoint
-    run -- collect data if active
+    collect -- run the callback and postprocessor and return the result
+    run -- collect one data point if active
+    run_async -- collect one data point on an asyncio event loop if active
     """
     def __init__(self, name, callback, limit=250, interval=10,
-                 postprocessor=None, callback_args=[], postprocessor_args=[]):
+                 postprocessor=None, callback_args=[], postprocessor_args=[],
+                 executor="thread", timeout=None, flush_policy=None,
+                 buffer_policy="drop_oldest", downsample=2, block_timeout=None,
+                 aggregator=None, change_filter=None, routing_keys=None):
         """
         Arguments:
         name -- the name of the collector
-        callback -- the data collection function to run
+        callback -- the data collection function to run; coroutine
+                    functions are supported by run_async only
 
         Keyword arguments:
         limit -- the maximum number of maintained data points (default 250)
@@ -42,17 +92,59 @@ class DataCollector(Thread):
                          (default [])
         postprocessor_args -- the list of arguments to pass to the
                               postprocessor (default [])
+        executor -- 'thread' or 'process'; process-executed callbacks,
+                    postprocessors and their arguments must be picklable
+                    (default 'thread')
+        timeout -- the number of seconds to wait for a process-executed or
+                   coroutine callback before discarding its result; None
+                   waits indefinitely (default None)
+        flush_policy -- a FlushPolicy that overrides the reporter's policy
+                        for this collector (default None)
+        buffer_policy -- what to do when the buffer is full: 'drop_oldest',
+                         'drop_newest', 'block' or 'downsample' (see
+                         RingBuffer) (default 'drop_oldest')
+        downsample -- keep every k-th point when the 'downsample' policy
+                      thins the buffer (default 2)
+        block_timeout -- the most seconds to wait for space under the
+                         'block' policy; None waits indefinitely
+                         (default None)
+        aggregator -- an Aggregator that summarizes results over time
+                      windows so that only the summaries are buffered
+                      (default None)
+        change_filter -- a ChangeFilter that drops points repeating the
+                         last buffered point (default None)
+        routing_keys -- the routing keys this collector's data is published
+                        to; if empty, the reporter's keys are used
+                        (default None)
+
+        Raises:
+        ValueError if executor is not one of 'thread' or 'process', if a
+        coroutine callback is combined with the 'process' executor, or if
+        buffer_policy is unknown
         """
-        super(DataCollector, self).__init__()
+        if executor not in EXECUTORS:
+            raise ValueError("Unknown executor %s" % (executor))
+        if executor == "process" and _is_coroutine_callback(callback):
+            raise ValueError("Coroutine callbacks cannot use the process executor")
         self.name = name if name else "Unknown Resource"
         self.limit = limit
         self.interval = interval
-        self.queue = None
+        self.buffer = RingBuffer(limit, policy=buffer_policy, downsample=downsample,
+                                 timeout=block_timeout)
+        self.executor = executor
+        self.timeout = timeout
+        self.is_coroutine = _is_coroutine_callback(callback)
+        self.flush_policy = flush_policy
+        self.aggregator = aggregator
+        self.change_filter = change_filter
+        self.routing_keys = list(routing_keys) if routing_keys else []
+        self.listener = None
         self._callback = callback
         self._callback_args = callback_args
         self._postprocessor = postprocessor
         self._postprocessor_args = postprocessor_args
         self._active = False
+        self._outstanding = None # Future of a timed-out process run
 
     def activate(self):
         """
@@ -60,56 +152,196 @@ class DataCollector(Thread):
         """
         self._active = True
 
+    def add_routing_key(self, key):
+        """
+        Publish this collector's data to a new endpoint.
+
+        Arguments:
+        key -- the routing key for the new endpoint
+        """
+        if key not in self.routing_keys:
+            self.routing_keys.append(key)
+
+    def busy(self):
+        """
+        Check whether a timed-out process-executed run is still occupying a
+        worker process. Futures cannot be cancelled once running, so the
+        collector is not run again until the worker is free; otherwise slow
+        runs would pile up and starve the other collectors sharing the pool.
+
+        Returns:
+        True if the last timed-out run has not finished
+        """
+        if self._outstanding is None:
+            return False
+        if not self._outstanding.done():
+            return True
+        self._outstanding = None
+        return False
+
+    def collect(self):
+        """
+        Run the callback and postprocessor in the calling thread.
+
+        Returns:
+        the postprocessed result of the callback
+
+        Raises:
+        TypeError if the callback is a coroutine function
+        """
+        if self.is_coroutine:
+            raise TypeError("%s has a coroutine callback and must be run with run_async" % (self.name))
+        result = self._callback(*self._callback_args)
+        return self._postprocessor(result, *self._postprocessor_args) if self._postprocessor else result
+
     def deactivate(self):
         """
         Stop collecting data.
         """
         self._active = False
 
-    def run(self):
+    def run(self, process_pool=None):
         """
         Run the callback and postprocessing subroutines and record result.
 
         Catches generic exceptions because the function being run is not
         known beforehand.
+
+        Keyword arguments:
+        process_pool -- the ProcessPoolExecutor used when executor is
+                        'process' (default None)
+        """
+        if not self._active or self.busy():
+            return
+        try:
+            if self.executor == "process":
+                future = process_pool.submit(_collect_remote,
+                                             self._callback,
+                                             self._callback_args,
+                                             self._postprocessor,
+                                             self._postprocessor_args)
+                try:
+                    result = future.result(timeout=self.timeout)
+                except concurrent.futures.TimeoutError:
+                    if not future.cancel(): # Already running; keep it until it ends
+                        self._outstanding = future
+                    print("[ERROR] %s timed out after %s seconds" % (self.name, self.timeout))
+                    return
+            else:
+                result = self.collect()
+            #print("Found the value ", result, " in ", self.name)
+            self._record(result)
+        except Exception as e:
+            print("[ERROR] %s" % (e))
+
+    async def run_async(self, executor=None, process_pool=None):
+        """
+        Run the callback and postprocessing subroutines on the running event
+        loop and record result.
+
+        Coroutine callbacks are awaited directly. Synchronous callbacks run
+        through loop.run_in_executor on executor, or on process_pool when
+        the collector's executor is 'process'.
+
+        Keyword arguments:
+        executor -- the Executor for synchronous callbacks; None uses the
+                    loop's default executor (default None)
+        process_pool -- the ProcessPoolExecutor used when executor is
+                        'process' (default None)
+        """
+        if not self._active or self.busy():
+            return
+        future = None
+        try:
+            if self.is_coroutine:
+                result = await asyncio.wait_for(self._callback(*self._callback_args),
+                                                self.timeout)
+                if self._postprocessor:
+                    result = self._postprocessor(result, *self._postprocessor_args)
+            elif self.executor == "process":
+                future = process_pool.submit(_collect_remote,
+                                             self._callback,
+                                             self._callback_args,
+                                             self._postprocessor,
+                                             self._postprocessor_args)
+                result = await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+            else:
+                loop = asyncio.get_running_loop()
+                result = await loop.run_in_executor(executor, self.collect)
+            self._record(result)
+        except asyncio.TimeoutError:
+            if future is not None and not future.done(): # Still running in its worker
+                self._outstanding = future
+            print("[ERROR] %s timed out after %s seconds" % (self.name, self.timeout))
+        except Exception as e:
+            print("[ERROR] %s" % (e))
+
+    def remove_routing_key(self, key):
+        """
+        Stop publishing this collector's data to an endpoint.
+
+        Arguments:
+        key -- the routing key for the existing endpoint
         """
-        self._collection_event = Event()
-        self.activate()
-        while self._active and not self._collection_event.wait(timeout=self.interval):
-            try:
-                result = self._callback(*self._callback_args)
-                result = self._postprocessor(result, *self._postprocessor_args) if self._postprocessor else result
-                #print("Found the value ", result, " in ", self.name)
-                data = {self.name: result}
-                self.queue.put(data)
-            except Exception as e:
-                print("[ERROR] %s" % (e))
-
-    def set_queue(self, queue):
-        self.queue = queue
+        try:
+            self.routing_keys.remove(key)
+        except ValueError:
+            pass
 
     def stop(self):
         self.deactivate()
+        if self.aggregator is not None: # Keep the partial window
+            summary = self.aggregator.close()
+            if summary is not None:
+                self._store(summary)
+
+    def _record(self, result):
+        """
+        Store a result, or fold it into the aggregator and store the
+        summary of any window it closes.
+
+        Arguments:
+        result -- the postprocessed result of the callback
+        """
+        if self.aggregator is None:
+            self._store(result)
+        else:
+            for summary in self.aggregator.add(result):
+                self._store(summary)
+
+    def _store(self, result):
+        """
+        Buffer a data point, unless the change filter suppresses it, and
+        notify the listener if it was kept.
+
+        Arguments:
+        result -- the data point
+        """
+        if self.change_filter is not None and not self.change_filter.accept(result):
+            return
+        if self.buffer.put(result) and self.listener is not None:
+            self.listener(self, result)
 
 if __name__ == "__main__":
     import resource
     import time
-    import queue
+
+    from .scheduler import CollectionScheduler
 
     def get_mem():
         data = {"x": time.time(), "y": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
         return data
 
-    q = queue.Queue()
-
     collector = DataCollector("rss", get_mem, interval=1)
-    collector.set_queue(q)
-    collector.start()
+    collector.activate()
+
+    scheduler = CollectionScheduler()
+    scheduler.add(collector)
+    scheduler.start()
 
     time.sleep(10)
 
     collector.stop()
-    collector.join()
+    scheduler.stop()
 
-    while not q.empty():
-        print(q.get(block=False))
+    print(collector.buffer.drain())
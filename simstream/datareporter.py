@@ -4,11 +4,20 @@ Utilties for collecting system data.
 Author: Jeff Kinnison (jkinniso@nd.edu)
 """
 
-from threading import Thread, Event
-import queue
+from threading import Thread, Event, current_thread
+import asyncio
+import time
 
+from . import batch, ringbuffer
 from .datacollector import DataCollector
+from .flushpolicy import FlushPolicy
 from .pikaproducer import PikaProducer
+from .scheduler import AsyncCollectionScheduler, CollectionScheduler
+from .shmtransport import SharedMemoryProducer, is_shm_url
+
+
+# Seconds between replay steps while spooled messages remain
+_REPLAY_TICK = 0.1
 
 
 class CollectorExistsException(Exception):
@@ -28,9 +37,17 @@ class DataReporter(Thread):
 
     Instance variables:
     collectors -- a dict of DataCollectors that are run at interval
+    scheduler -- the CollectionScheduler (or AsyncCollectionScheduler when
+                 concurrency is 'asyncio') that runs every collector
+    flush_policy -- the FlushPolicy applied to collectors without their own
+    batch_format -- 'rows' or 'columnar'
+    flush_triggers -- a dict counting the flushes caused by each trigger
+                      ('points', 'bytes', 'latency', 'interval', 'stop')
 
     Public methods:
     add_collector -- add a new DataCollector to the list
+    buffer_stats -- get each collector's dropped and downsampled counts
+    flush -- publish all buffered data
     run -- start the data collection loop
     join -- end data collection and return control to main thread
     start_collecting -- begin data collection for all collectors
@@ -39,12 +56,116 @@ class DataReporter(Thread):
     stop_collector -- stop a running DataCollector
     """
 
-    def __init__(self, url, exchange, exchange_type="direct", routing_keys=[], collectors=[], interval=60):
+    def __init__(self, url, exchange, exchange_type="direct", routing_keys=[], collectors=[], interval=60,
+                 max_workers=4, process_workers=None, concurrency="thread", flush_policy=None,
+                 batch_format="rows", codec="json", compression=None, asynchronous=False,
+                 confirm=False, pool=None, spool=None, replay_rate=100,
+                 buffer_policy="drop_oldest", downsample=2, chunk_size=None,
+                 shutdown_timeout=10.0):
+        """
+        Arguments:
+        url -- the url of the RabbitMQ server to send to, or a
+               shm://<name>?size=<bytes> url to stream to consumers on the
+               same node through shared memory (see simstream.shmtransport)
+        exchange -- the name of the exchange to send to
+
+        Keyword arguments:
+        exchange_type -- one of 'direct', 'topic', 'fanout', 'headers'
+                         (default 'direct')
+        routing_keys -- the routing keys to publish to (default [])
+        collectors -- a list of add_collector keyword argument dicts
+                      (default [])
+        interval -- the maximum time in seconds between publishes
+                    (default 60)
+        max_workers -- the maximum number of callbacks run concurrently
+                       (default 4)
+        process_workers -- the number of worker processes for collectors
+                           using the 'process' executor (default None)
+        concurrency -- 'thread' to run collectors from a timer thread, or
+                       'asyncio' to run collectors and the publishing loop
+                       on one event loop, which allows coroutine callbacks
+                       (default 'thread')
+        flush_policy -- a FlushPolicy whose size and latency triggers
+                        publish data before interval elapses (default None)
+        batch_format -- 'rows' to publish each collector's data points as
+                        a list, or 'columnar' to publish one column per
+                        field (see simstream.batch) (default 'rows')
+        codec -- the name of the registered codec used to serialize
+                 published data (see simstream.codec); 'timeseries' packs
+                 each numeric collector of a columnar flush into one
+                 compressed block (default 'json')
+        compression -- the name of a registered compression scheme applied
+                       to large messages (see simstream.compression), or
+                       None (default None)
+        asynchronous -- if True, the producer publishes from a background
+                        thread so flushes never wait on the broker
+                        (default False)
+        confirm -- if True, the producer uses publisher confirms and
+                   retries messages the broker did not accept; implies
+                   asynchronous (default False)
+        pool -- a ConnectionPool shared with other reporters, e.g.
+                simstream.connectionpool.get_pool(), or None to give this
+                reporter its own connection (default None)
+        spool -- a Spool (see simstream.spool) that keeps messages on disk
+                 while the broker is unreachable (default None)
+        replay_rate -- the most spooled messages per second to publish
+                       once the broker is reachable again (default 100)
+        buffer_policy -- what collectors do when their buffer fills before
+                         a flush: 'drop_oldest', 'drop_newest', 'block' or
+                         'downsample' (see simstream.ringbuffer)
+                         (default 'drop_oldest')
+        downsample -- keep every k-th point when the 'downsample' policy
+                      thins a buffer (default 2)
+        chunk_size -- split published messages larger than chunk_size
+                      bytes into chunks (see simstream.chunking), or None
+                      (default None)
+        shutdown_timeout -- the most seconds stop() waits for an
+                            asynchronous producer to publish its queue; the
+                            rest is spooled or dropped (default 10.0)
+
+        Raises:
+        ValueError if concurrency is not one of 'thread' or 'asyncio', if
+        batch_format is not one of 'rows' or 'columnar', or if
+        buffer_policy is unknown or is 'block' with concurrency 'asyncio'
+        """
+        if batch_format not in ("rows", batch.FORMAT):
+            raise ValueError("Unknown batch format %s" % (batch_format))
+        if buffer_policy not in ringbuffer.POLICIES:
+            raise ValueError("Unknown buffer policy %s" % (buffer_policy))
         super(DataReporter, self).__init__()
-        self.producer = PikaProducer(url, exchange, exchange_type, routing_keys)
+        if is_shm_url(url):
+            self.producer = SharedMemoryProducer(url, exchange, exchange_type, routing_keys,
+                                                 codec=codec, compression=compression,
+                                                 chunk_size=chunk_size)
+        else:
+            self.producer = PikaProducer(url, exchange, exchange_type, routing_keys,
+                                         codec=codec, compression=compression,
+                                         asynchronous=asynchronous, confirm=confirm,
+                                         pool=pool, spool=spool, chunk_size=chunk_size,
+                                         shutdown_timeout=shutdown_timeout)
         self.collectors = {}
         self.interval = interval
-        self.queue = queue.Queue()
+        self.concurrency = concurrency
+        self.batch_format = batch_format
+        self.flush_policy = flush_policy
+        self.replay_rate = replay_rate
+        self.buffer_policy = buffer_policy
+        self.downsample = downsample
+        self.flush_triggers = dict.fromkeys(FlushPolicy.TRIGGERS + ("stop",), 0)
+        self._point_sizes = {}
+        self._pending_trigger = None
+        self._flush_event = None
+        self._loop = None
+        self._last_replay = time.monotonic()
+        self._replay_credit = 0.0
+        if concurrency == "thread":
+            self.scheduler = CollectionScheduler(max_workers=max_workers,
+                                                 process_workers=process_workers)
+        elif concurrency == "asyncio":
+            self.scheduler = AsyncCollectionScheduler(max_workers=max_workers,
+                                                      process_workers=process_workers)
+        else:
+            raise ValueError("Unknown concurrency %s" % (concurrency))
         for collector in collectors:
             self.add_collector(**collector)
 
@@ -52,12 +173,15 @@ class DataReporter(Thread):
         self._active = True
 
     def add_collector(self, name="unknown", callback=lambda x: x, limit=250, interval=10, postprocessor=None,
-                      callback_args=[], postprocessor_args=[]):
+                      callback_args=[], postprocessor_args=[], executor="thread", timeout=None,
+                      flush_policy=None, buffer_policy=None, downsample=None, block_timeout=None,
+                      aggregator=None, change_filter=None, routing_keys=None):
         """Add a new collector.
 
         Arguments:
         name -- name of the new DataCollector
-        callback -- the data collection callback to run
+        callback -- the data collection callback to run; may be a coroutine
+                    function if the reporter's concurrency is 'asyncio'
 
         Keyword arguments:
         limit -- the number of data points to store (default 100)
@@ -67,58 +191,308 @@ class DataReporter(Thread):
                          (default [])
         postprocessor_args -- a list of arguments to pass to the postprocessor
                               (default [])
+        executor -- 'thread' to run the callback on the scheduler's worker
+                    threads or 'process' to run the callback and
+                    postprocessor in a worker process (default 'thread')
+        timeout -- seconds to wait for a process-executed or coroutine
+                   callback before discarding its result (default None)
+        flush_policy -- a FlushPolicy overriding the reporter's policy for
+                        this collector (default None)
+        buffer_policy -- the full-buffer policy for this collector, or None
+                         to use the reporter's (default None)
+        downsample -- the thinning factor for the 'downsample' policy, or
+                      None to use the reporter's (default None)
+        block_timeout -- the most seconds the collector waits for space
+                         under the 'block' policy before discarding a point;
+                         None waits indefinitely (default None)
+        aggregator -- an Aggregator (see simstream.aggregate) that
+                      publishes per-window summaries instead of every
+                      point; each collector needs its own (default None)
+        change_filter -- a ChangeFilter (see simstream.changefilter) that
+                         publishes points only when they change or a
+                         heartbeat is due; each collector needs its own
+                         (default None)
+        routing_keys -- the routing keys to publish this collector's data
+                        to instead of the reporter's (default None)
 
         Raises:
         CollectorExistsException if a collector named name already exists
+        ValueError if executor is not one of 'thread' or 'process', if
+        callback is a coroutine function and concurrency is not 'asyncio',
+        or if buffer_policy is unknown or is 'block' with concurrency
+        'asyncio'
         """
         if name in self.collectors:
             raise CollectorExistsException
 
-        self.collectors[name] = DataCollector(
+        collector = DataCollector(
             name=name,
             callback=callback,
             limit=limit,
             interval=interval,
             postprocessor=postprocessor,
             callback_args=callback_args,
-            postprocessor_args=postprocessor_args
+            postprocessor_args=postprocessor_args,
+            executor=executor,
+            timeout=timeout,
+            flush_policy=flush_policy,
+            buffer_policy=buffer_policy or self.buffer_policy,
+            downsample=downsample or self.downsample,
+            block_timeout=block_timeout,
+            aggregator=aggregator,
+            change_filter=change_filter,
+            routing_keys=routing_keys
         )
+        if collector.is_coroutine and self.concurrency != "asyncio":
+            raise ValueError("Coroutine callbacks require concurrency='asyncio'")
+        if collector.buffer.policy == "block" and self.concurrency == "asyncio":
+            # A blocked collector would stall the event loop that flushes it
+            raise ValueError("The 'block' buffer policy requires concurrency='thread'")
+        collector.listener = self._on_sample
+        self.collectors[name] = collector
+
+    def buffer_stats(self):
+        """
+        Get each collector's buffer counters.
+
+        Returns:
+        a dict mapping collector names to dicts of 'buffered', 'dropped',
+        'downsampled', 'blocked' and 'suppressed' counts
+        """
+        stats = {}
+        for name in self.collectors:
+            collector = self.collectors[name]
+            buffer = collector.buffer
+            stats[name] = {"buffered": len(buffer),
+                           "dropped": buffer.dropped,
+                           "downsampled": buffer.downsampled,
+                           "blocked": buffer.blocked,
+                           "suppressed": (collector.change_filter.suppressed
+                                          if collector.change_filter is not None else 0)}
+        return stats
 
     def deactivate(self):
         self._active = False
 
     def get_data(self):
-        while True:
-            try:
-                data = self.queue.get(block=False)
-                yield data
-            except queue.Empty:
-                break
-        return
+        """
+        Drain every collector's buffer.
+
+        Lists returned by a collector are merged into the collector's batch
+        rather than nested in it.
+
+        Returns:
+        a dict mapping collector names to lists of data points, or a
+        columnar message (see simstream.batch) if batch_format is
+        'columnar'
+        """
+        if self.batch_format == "columnar":
+            batches = {}
+            for name in self.collectors:
+                collector_batch = batch.column_batch(self.collectors[name].buffer.drain_columns())
+                if collector_batch["n"] > 0:
+                    batches[name] = collector_batch
+            return batch.pack(batches)
+
+        data = {}
+        for name in self.collectors:
+            points = self.collectors[name].buffer.drain()
+            if not points:
+                continue
+            rows = []
+            for point in points:
+                if isinstance(point, list):
+                    rows.extend(point)
+                else:
+                    rows.append(point)
+            data[name] = rows
+        return data
+
+    def flush(self, trigger="interval"):
+        """
+        Publish all buffered data.
+
+        Keyword arguments:
+        trigger -- the flush trigger to count (default 'interval')
+        """
+        self.flush_triggers[trigger] += 1
+        self._next_flush = time.monotonic() + self.interval
+        data = self.get_data()
+        for routing_keys, message in self._route(data):
+            self.send_data(message, routing_keys)
+        print(data)
 
     def run(self):
-        for collector in self.collectors:
-            if self.collectors[collector].queue is not self.queue:
-                self.collectors[collector].set_queue(self.queue)
+        if self.concurrency == "asyncio":
+            self.scheduler.run(self._run_async())
+            return
+
+        self.scheduler.start()
+        self._flush_event = Event()
+        self._next_flush = time.monotonic() + self.interval
+        self._active = True
         self.start_collecting()
-        self._collection_event = Event()
+        while self._active:
+            self._flush_event.wait(timeout=self._time_to_flush())
+            self._flush_event.clear()
+            trigger = self._next_trigger()
+            if self._active and trigger is not None:
+                self.flush(trigger)
+            self._replay()
+
+    async def _run_async(self):
+        """
+        Publish collected data from the scheduler's event loop whenever a
+        flush is triggered. Publishing blocks, so it runs in the loop's
+        executor.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._flush_event = asyncio.Event()
+        self._next_flush = time.monotonic() + self.interval
         self._active = True
-        while self._active and not self._collection_event.wait(timeout=self.interval):
-            data = {}
-            for item in self.get_data():
-                for key in item:
-                    if key in data:
-                        try:
-                            data[key].extend(item[key])
-                        except TypeError as e:
-                            data[key].append(item[key])
-                    else:
-                        data[key] = [item[key]]
-            self.send_data(data)
-            print(data)
-
-    def send_data(self, data):
-        self.producer(data)
+        self.start_collecting()
+        while self._active:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), self._time_to_flush())
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            trigger = self._next_trigger()
+            if self._active and trigger is not None:
+                await self._loop.run_in_executor(None, self.flush, trigger)
+            if self.producer.spool is not None and len(self.producer.spool) > 0:
+                await self._loop.run_in_executor(None, self._replay)
+
+    def _replay(self):
+        """
+        Publish spooled messages at no more than replay_rate per second,
+        allowing bursts of up to one second's worth.
+        """
+        now = time.monotonic()
+        credit = min(self._replay_credit + self.replay_rate * (now - self._last_replay),
+                     self.replay_rate)
+        self._last_replay = now
+        if self.producer.spool is None or len(self.producer.spool) == 0:
+            self._replay_credit = 0.0
+            return
+        limit = int(credit)
+        replayed = self.producer.replay(limit) if limit > 0 else 0
+        self._replay_credit = credit - limit if replayed == limit else 0.0
+
+    def _on_sample(self, collector, point):
+        """
+        Check a collector's size triggers after it stores a new point.
+
+        Arguments:
+        collector -- the DataCollector that stored the point
+        point -- the stored point
+        """
+        policy = collector.flush_policy or self.flush_policy
+        if policy is None or self._flush_event is None:
+            return
+        if collector.name not in self._point_sizes:
+            self._point_sizes[collector.name] = self._estimate_size(point)
+        points = len(collector.buffer)
+        trigger = policy.check(points, points * self._point_sizes[collector.name])
+        if trigger is not None:
+            self._pending_trigger = trigger
+            self._wake()
+        elif points == 1 and policy.max_latency is not None:
+            self._wake() # Rearm the publishing loop with the new deadline
+
+    def _estimate_size(self, point):
+        """
+        Estimate the encoded size of one data point.
+
+        Arguments:
+        point -- the data point
+        """
+        try:
+            return len(self.producer.codec.encode(point))
+        except (TypeError, ValueError):
+            return len(repr(point))
+
+    def _next_trigger(self):
+        """
+        Get the trigger that calls for a flush now, if any.
+        """
+        trigger, self._pending_trigger = self._pending_trigger, None
+        if trigger is not None:
+            return trigger
+        now = time.monotonic()
+        deadline = self._latency_deadline()
+        if deadline is not None and deadline <= now:
+            return "latency"
+        if self._next_flush <= now:
+            return "interval"
+        return None
+
+    def _latency_deadline(self):
+        """
+        Get the earliest time by which a collector's buffer must be flushed.
+        """
+        deadlines = []
+        for name in self.collectors:
+            collector = self.collectors[name]
+            policy = collector.flush_policy or self.flush_policy
+            if policy is not None:
+                deadline = policy.deadline(collector.buffer.oldest)
+                if deadline is not None:
+                    deadlines.append(deadline)
+        return min(deadlines) if deadlines else None
+
+    def _time_to_flush(self):
+        """
+        Get the number of seconds until the next interval or latency flush,
+        or until the next replay step if messages are spooled.
+        """
+        deadline = self._latency_deadline()
+        if deadline is None or deadline > self._next_flush:
+            deadline = self._next_flush
+        timeout = max(deadline - time.monotonic(), 0)
+        if self.producer.spool is not None and len(self.producer.spool) > 0:
+            timeout = min(timeout, _REPLAY_TICK)
+        return timeout
+
+    def _wake(self):
+        """
+        Wake the publishing loop from any thread.
+        """
+        if self._flush_event is None:
+            return
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._flush_event.set)
+            except RuntimeError: # The event loop has already closed
+                pass
+        else:
+            self._flush_event.set()
+
+    def send_data(self, data, routing_keys=None):
+        self.producer(data, routing_keys)
+
+    def _route(self, data):
+        """
+        Split collected data into one message per distinct set of routing
+        keys, so each message is encoded once however many keys share it.
+
+        Arguments:
+        data -- the output of get_data
+
+        Returns:
+        a list of (routing keys, message) tuples; routing keys are None
+        for collectors that use the reporter's keys
+        """
+        columnar = self.batch_format == "columnar"
+        parts = data["collectors"] if columnar else data
+        groups = {}
+        for name in parts:
+            keys = tuple(sorted(set(self.collectors[name].routing_keys)))
+            groups.setdefault(keys, {})[name] = parts[name]
+        if not groups or list(groups) == [()]: # Everything uses the reporter's keys
+            return [(None, data)]
+        return [(list(keys) or None, batch.pack(group) if columnar else group)
+                for keys, group in groups.items()]
 
     def start_collecting(self):
         """
@@ -129,24 +503,34 @@ class DataReporter(Thread):
 
     def start_collector(self, name):
         """
-        Activate the specified collector.
+        Activate the specified collector and hand it to the scheduler.
 
         Arguments:
         name -- the name of the collector to start
 
         Raises:
-        RuntimeError if the collector has already been started.
+        CollectorDoesNotExistException if no collector named name exists
         """
-        try:
-            self.collectors[name].activate()
-            self.collectors[name].start()
-        except RuntimeError as e:
-            print("Error starting collector ", name)
-            print(e)
+        if name not in self.collectors:
+            raise CollectorDoesNotExistException
+
+        self.collectors[name].activate()
+        self.scheduler.add(self.collectors[name])
 
     def stop(self):
+        """
+        Stop collecting and publish whatever is still buffered, including
+        the partial windows of aggregating collectors, before shutting the
+        producer down.
+        """
         self.deactivate()
+        self._wake()
         self.stop_collecting()
+        self.scheduler.stop()
+        if self.is_alive() and current_thread() is not self: # Let an in-progress flush finish
+            Thread.join(self)
+        if any(len(self.collectors[name].buffer) for name in self.collectors):
+            self.flush("stop")
         self.producer.shutdown()
 
     def stop_collecting(self):
@@ -168,44 +552,57 @@ class DataReporter(Thread):
         if name not in self.collectors:
             raise CollectorDoesNotExistException
 
-        try:
-            self.collectors[name].stop()
-            self.collectors[name].join()
-        except RuntimeError as e: # Catch deadlock
-            print(e)
+        self.collectors[name].stop()
+        self.scheduler.remove(name)
 
 
-    def start_streaming(self, routing_key):
+    def start_streaming(self, routing_key, name=None):
         """
         Begin streaming data to a particular recipient.
 
         Arguments:
         routing_key -- the routing key to reach the intended recipient
+
+        Keyword arguments:
+        name -- the collector whose data to stream, or None to stream every
+                collector without its own routing keys (default None)
+
+        Raises:
+        CollectorDoesNotExistException if no collector named name exists
         """
-        self.producer.add_routing_key(routing_key)
+        if name is None:
+            self.producer.add_routing_key(routing_key)
+        elif name not in self.collectors:
+            raise CollectorDoesNotExistException
+        else:
+            self.collectors[name].add_routing_key(routing_key)
 
-    def stop_streaming(self, routing_key):
+    def stop_streaming(self, routing_key, name=None):
         """
         Stop a particular stream.
 
         Arguments:
-        collector_name -- the collector associated with the producer to stop
         routing_key -- the routing key to reach the intended recipient
 
+        Keyword arguments:
+        name -- the collector whose stream to stop, or None for the
+                reporter's streams (default None)
+
         Raises:
-        ProducerDoesNotExistException if no producer named name exists
-        ValueError if the producer is removed by another call to this method
-                   after the for loop begins
+        CollectorDoesNotExistException if no collector named name exists
         """
-        self.producer.remove_routing_key(routing_key)
+        if name is None:
+            self.producer.remove_routing_key(routing_key)
+        elif name not in self.collectors:
+            raise CollectorDoesNotExistException
+        else:
+            self.collectors[name].remove_routing_key(routing_key)
 
 if __name__ == "__main__":
     import resource
     import sys
     import time
 
-    q = queue.Queue()
-
     def get_mem():
         data = {"x": time.time(), "y": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
         return data
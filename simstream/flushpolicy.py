@@ -0,0 +1,72 @@
+"""
+Utilities for deciding when to publish collected data.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+
+class FlushPolicy(object):
+    """Thresholds that trigger publishing buffered data early.
+
+    A DataReporter always publishes at least once per interval. A policy
+    adds size and latency triggers on top of that; whichever threshold is
+    crossed first causes a flush. Unset thresholds never trigger.
+
+    Instance variables:
+    max_points -- flush once this many data points are buffered
+    max_bytes -- flush once the estimated encoded size passes this many bytes
+    max_latency -- flush once the oldest buffered point is this many
+                   seconds old
+
+    Public methods:
+    check -- get the size trigger crossed by a buffer, if any
+    deadline -- get the time by which a buffer must be flushed
+    """
+
+    TRIGGERS = ("points", "bytes", "latency", "interval")
+
+    def __init__(self, max_points=None, max_bytes=None, max_latency=None):
+        """
+        Keyword arguments:
+        max_points -- the number of buffered points that triggers a flush
+                      (default None)
+        max_bytes -- the estimated encoded size in bytes that triggers a
+                     flush (default None)
+        max_latency -- the age in seconds of the oldest buffered point that
+                       triggers a flush (default None)
+        """
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+
+    def check(self, points, nbytes):
+        """
+        Get the size trigger crossed by a buffer.
+
+        Arguments:
+        points -- the number of buffered points
+        nbytes -- the estimated encoded size of the buffered points
+
+        Returns:
+        'points', 'bytes' or None
+        """
+        if self.max_points is not None and points >= self.max_points:
+            return "points"
+        if self.max_bytes is not None and nbytes >= self.max_bytes:
+            return "bytes"
+        return None
+
+    def deadline(self, oldest):
+        """
+        Get the time by which a buffer must be flushed.
+
+        Arguments:
+        oldest -- the time.monotonic() time of the oldest buffered point, or
+                  None if the buffer is empty
+
+        Returns:
+        a time.monotonic() time, or None if there is no latency deadline
+        """
+        if self.max_latency is None or oldest is None:
+            return None
+        return oldest + self.max_latency
@@ -4,16 +4,140 @@ Streaming utility for system and simulation data.
 author: Jeff Kinnison (jkinniso@nd.edu)
 """
 
+from collections import deque, namedtuple
+import concurrent.futures
 import json
+import time
+
 import pika
 
+from . import batch, chunking, codec
+from .compression import decompress
+from .routing import RoutingTable
+
+
+DISPATCH_MODES = ("inline", "thread", "process")
+
+# Outcomes of handling one message
+_HANDLED = "handled"
+_UNREADABLE = "unreadable" # Could not be decompressed or decoded
+_FAILED = "failed"         # The handler raised
+
+Delivery = namedtuple("Delivery", ["body", "routing_key", "timestamp", "delivery_tag"])
+Delivery.__doc__ = """One message passed to a batch handler: its (decoded) body,
+routing key, timestamp (from the message properties, or the time it was
+received) and delivery tag (None for a reassembled chunked message)."""
+
+
+def _handle_message(handler, body, content_type, content_encoding, decode, expand_batches):
+    """
+    Decompress and optionally decode a message, then pass it to a handler.
+    Module-level so that it can run in a worker process.
+
+    Arguments:
+    handler -- the message handler
+    body -- the message
+    content_type -- the message's content_type
+    content_encoding -- the message's content_encoding
+    decode -- whether to decode the message with its codec
+    expand_batches -- whether to expand columnar messages into rows
+
+    Returns:
+    one of _HANDLED, _UNREADABLE or _FAILED
+    """
+    try:
+        body = decompress(body, content_encoding)
+    except Exception as e: # Decompressors raise their own error types
+        print("[ERROR] Could not decompress message: %s" % (e))
+        return _UNREADABLE
+    if decode:
+        try:
+            body = codec.decode(body, content_type)
+            if expand_batches and batch.is_columnar(body):
+                body = batch.to_rows(body)
+        except (ValueError, UnicodeError) as e:
+            print("[ERROR] Could not decode message: %s" % (e))
+            return _UNREADABLE
+    try:
+        handler(body)
+    except Exception as e: # The handler is not known beforehand
+        print("[ERROR] Message handler failed: %s" % (e))
+        return _FAILED
+    return _HANDLED
+
+
+def _handle_batch(handler, messages, decode, expand_batches):
+    """
+    Decompress and optionally decode a batch of messages, then pass the
+    readable ones to a handler as a list of Deliveries. JSON messages are
+    decoded together with a single json.loads call. Module-level so that
+    it can run in a worker process.
+
+    Arguments:
+    handler -- the batch handler
+    messages -- a list of (body, content_type, content_encoding,
+                routing_key, timestamp, delivery_tag) tuples
+    decode -- whether to decode the messages with their codecs
+    expand_batches -- whether to expand columnar messages into rows
+
+    Returns:
+    a list of outcomes, one per message
+    """
+    outcomes = [_HANDLED] * len(messages)
+    bodies = [None] * len(messages)
+    for i, message in enumerate(messages):
+        try:
+            bodies[i] = decompress(message[0], message[2])
+        except Exception as e: # Decompressors raise their own error types
+            print("[ERROR] Could not decompress message: %s" % (e))
+            outcomes[i] = _UNREADABLE
+
+    if decode:
+        readable = [i for i in range(len(messages)) if outcomes[i] == _HANDLED]
+        json_codec = codec.get_codec("json")
+        as_json = [i for i in readable
+                   if codec.detect_codec(bodies[i], messages[i][1]) is json_codec]
+        try:
+            decoded = json.loads(b"[" + b",".join(bytes(bodies[i]) for i in as_json) + b"]")
+        except (ValueError, TypeError, UnicodeError): # Find the bad messages one at a time
+            as_json = []
+        else:
+            for i, value in zip(as_json, decoded):
+                bodies[i] = value
+        as_json = set(as_json)
+        for i in readable:
+            try:
+                if i not in as_json:
+                    bodies[i] = codec.decode(bodies[i], messages[i][1])
+                if expand_batches and batch.is_columnar(bodies[i]):
+                    bodies[i] = batch.to_rows(bodies[i])
+            except (ValueError, UnicodeError) as e:
+                print("[ERROR] Could not decode message: %s" % (e))
+                outcomes[i] = _UNREADABLE
+
+    deliveries = [Delivery(bodies[i], key, timestamp, tag)
+                  for i, (unused_body, unused_type, unused_encoding, key, timestamp, tag)
+                  in enumerate(messages) if outcomes[i] == _HANDLED]
+    if deliveries:
+        try:
+            handler(deliveries)
+        except Exception as e: # The handler is not known beforehand
+            print("[ERROR] Batch handler failed: %s" % (e))
+            outcomes = [_FAILED if outcome == _HANDLED else outcome for outcome in outcomes]
+    return outcomes
+
+
 class PikaAsyncConsumer(object):
     """
     The primary entry point for routing incoming messages to the proper handler.
     """
 
     def __init__(self, rabbitmq_url, exchange_name, queue_name, message_handler,
-                 exchange_type="direct", routing_key="#"):
+                 exchange_type="direct", routing_key="#", decode=False, expand_batches=False,
+                 prefetch_count=100, ack_batch=50, ack_interval=0.1, requeue_on_error=True,
+                 dead_letter_exchange=None, dispatch="inline", max_workers=4,
+                 max_in_flight=None, poll_interval=0.01, batch_size=None, batch_interval=0.1,
+                 chunk_timeout=30.0, chunk_memory=64 * 2**20):
         """
         Create a new instance of Streamer.
 
@@ -25,15 +149,108 @@ class PikaAsyncConsumer(object):
         Keyword Arguments:
         exchange_type -- one of 'direct', 'topic', 'fanout', 'headers'
                          (default 'direct')
-        routing_keys -- the routing key that this consumer listens for
-                        (default '#', receives all messages)
+        routing_key -- the binding key of queue_name; more queues and
+                       bindings, each with its own handler, can be added
+                       with add_binding (default '#', receives all
+                       messages)
+        decode -- if True, decode each message with the codec announced in
+                  its content_type (see simstream.codec) and pass the
+                  decoded message to message_handler (default False)
+        expand_batches -- if True, decode each message and expand columnar
+                          batches into rows before passing it to
+                          message_handler (default False)
+        prefetch_count -- the most unacknowledged messages the server
+                          delivers at once; 0 means no limit (default 100)
+        ack_batch -- acknowledge handled messages together, with one
+                     multiple ack per ack_batch messages (default 50)
+        ack_interval -- the most seconds a handled message waits to be
+                        acknowledged (default 0.1)
+        requeue_on_error -- if True, messages whose handler raised are
+                            requeued; otherwise they are rejected
+                            (default True)
+        dead_letter_exchange -- an exchange that receives rejected
+                                messages; the queue is declared with it as
+                                its x-dead-letter-exchange and failed
+                                messages are never requeued (default None)
+
+        dispatch -- 'inline' to handle messages on the ioloop thread, or
+                    'thread' or 'process' to handle them on a worker pool;
+                    messages with the same routing key are still handled
+                    in order, one at a time (default 'inline')
+        max_workers -- the size of the worker pool (default 4)
+        max_in_flight -- the most messages dispatched but not yet handled;
+                         consumption pauses at this limit and resumes
+                         once half of them are done (default
+                         prefetch_count, or 1000 if that is 0)
+        poll_interval -- seconds between checks for finished messages
+                         while any are in flight (default 0.01)
+        batch_size -- if set, each handler is called once per batch of up
+                      to batch_size messages with a list of Delivery
+                      tuples; each handler's batches run one at a time,
+                      in order (default None)
+        batch_interval -- the most seconds a message waits for its batch
+                          to fill (default 0.1)
+        chunk_timeout -- seconds a chunked message (see simstream.chunking)
+                         waits for its next chunk before it is dropped
+                         (default 30.0)
+        chunk_memory -- the most bytes held for incomplete chunked
+                        messages; the oldest are dropped beyond it
+                        (default 64 MiB)
+
+        Messages that cannot be decompressed or decoded are always
+        rejected without requeueing, since they would fail again. With
+        'process' dispatch, message_handler must be picklable.
+
+        Chunked messages are reassembled before they are handled. Each
+        chunk is acknowledged as it arrives, so that a message with more
+        chunks than prefetch_count can complete; a reassembled message
+        whose handler fails is therefore not redelivered.
+
+        Raises:
+        ValueError if dispatch is not one of 'inline', 'thread' or
+        'process'
         """
+        if dispatch not in DISPATCH_MODES:
+            raise ValueError("Unknown dispatch mode %s" % (dispatch))
         self._connection = None
         self._channel = None
         self._shut_down = False
-        self._consumer_tag = None
+        self._consumer_tags = []   # Tags of the active basic_consume calls
+        self._consumer_queues = {} # consumer tag -> queue name
         self._url = rabbitmq_url
-        self._message_handler = message_handler
+        self._decode = decode or expand_batches
+        self._expand_batches = expand_batches
+        self._prefetch_count = prefetch_count
+        self._ack_batch = ack_batch
+        self._ack_interval = ack_interval
+        self._requeue_on_error = requeue_on_error and dead_letter_exchange is None
+        self._dead_letter_exchange = dead_letter_exchange
+        self._outstanding = set() # Delivery tags received but not yet handled
+        self._handled = []        # Delivery tags handled but not yet acked
+        self._ack_timer = None
+        self._epoch = 0           # Incremented whenever delivery tags are invalidated
+        self.stats = {"acked": 0, "rejected": 0}
+        self.reassembler = chunking.Reassembler(timeout=chunk_timeout, max_bytes=chunk_memory)
+
+        self._dispatch = dispatch
+        self._pool = None
+        if dispatch == "thread":
+            self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        elif dispatch == "process":
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+        if max_in_flight is None:
+            max_in_flight = prefetch_count or 1000
+        self._max_in_flight = max_in_flight
+        self._poll_interval = poll_interval
+        self._key_queues = {}     # routing key -> deque of messages waiting for that key
+        self._finished = deque()  # Filled by worker threads, drained on the ioloop
+        self._in_flight = 0
+        self._poll_timer = None
+        self._paused = False
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._batches = {}        # handler -> messages waiting for that handler
+        self._batch_timer = None
 
         # The following are necessary to guarantee that both the RabbitMQ
         # server and Streamer know where to look for messages. These names will
@@ -41,8 +258,55 @@ class PikaAsyncConsumer(object):
         # else on a per-job basis.
         self._exchange = exchange_name
         self._exchange_type = exchange_type
-        self._queue = queue_name
-        self._routing_key = routing_key
+        self._subscriptions = {}  # queue name -> RoutingTable of its bindings
+        self._setup = deque()     # (queue name, binding key or None) left to declare
+        self._setting_up = False
+        self._declared = False
+        self.add_binding(queue_name, routing_key, message_handler)
+
+    def add_binding(self, queue_name, binding_key, message_handler):
+        """
+        Bind a queue to the exchange and handle the messages routed to it
+        by this binding with their own handler. Every queue and binding
+        shares this consumer's connection and channel. A message whose
+        routing key matches several bindings of its queue is passed to
+        each of their handlers; one that matches none is passed to the
+        queue's first handler.
+
+        If the consumer is running, this must be called on its ioloop
+        thread (e.g. from a handler with 'inline' dispatch).
+
+        Arguments:
+        queue_name -- name of RabbitMQ queue to join
+        binding_key -- the routing key or topic pattern to bind with
+        message_handler -- the function called with each matching message
+        """
+        new_queue = queue_name not in self._subscriptions
+        if new_queue:
+            self._subscriptions[queue_name] = RoutingTable(self._exchange_type)
+        self._subscriptions[queue_name].add(binding_key, message_handler)
+        if self._setting_up or self._declared: # Declare it on the open channel
+            if new_queue:
+                self._setup.append((queue_name, None))
+            self._setup.append((queue_name, binding_key))
+            if not self._setting_up:
+                self._setting_up = True
+                self._setup_next(None)
+
+    def remove_binding(self, queue_name, binding_key):
+        """
+        Unbind a queue from the exchange and forget the binding's handler.
+        The queue keeps being consumed from. If the consumer is running,
+        this must be called on its ioloop thread.
+
+        Arguments:
+        queue_name -- name of RabbitMQ queue
+        binding_key -- the routing key or topic pattern it was bound with
+        """
+        self._subscriptions[queue_name].remove(binding_key)
+        if self._channel is not None:
+            self._channel.queue_unbind(queue=queue_name, exchange=self._exchange,
+                                       routing_key=binding_key)
 
     def connect(self):
         """
@@ -75,7 +339,10 @@ class PikaAsyncConsumer(object):
         text -- response body from the RabbitMQ server
         """
         self._channel = None
+        self._reset_acks()
         if self._shut_down:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
             self._connection.ioloop.stop()
         else:
             self._connection.add_timeout(5, self.reconnect)
@@ -113,6 +380,8 @@ class PikaAsyncConsumer(object):
         code -- response code from the RabbitMQ server
         text -- response body from the RabbitMQ server
         """
+        self._channel = None
+        self._reset_acks() # Delivery tags are per channel
         self._connection.close()
 
     def declare_exchange(self):
@@ -133,29 +402,94 @@ class PikaAsyncConsumer(object):
 
     def declare_queue(self):
         """
-        Set up the queue that will route messages to this consumer. Each
-        RabbitMQ queue can be defined with routing keys to use only one
-        queue for multiple jobs.
-        """
-        self._channel.queue_declare(self.declare_queue_success,
-                                    self._queue)
+        Set up the queues that will route messages to this consumer. Each
+        RabbitMQ queue can be bound with several routing keys to use only
+        one queue for multiple jobs. Queues are declared and bound one
+        after another, then consumption begins.
+        """
+        self._setup = deque()
+        self._setting_up = True
+        self._declared = False
+        for queue_name, table in self._subscriptions.items():
+            self._setup.append((queue_name, None))
+            for binding_key, unused_handler in table.bindings:
+                self._setup.append((queue_name, binding_key))
+        self._setup_next(None)
 
     def declare_queue_success(self, method_frame):
         """
         Actions to perform on successful queue declaration.
         """
-        self._channel.queue_bind(self.munch,
-                                 self._queue,
-                                 self._exchange,
-                                 self._routing_key
-                                )
+        self._setup_next(method_frame)
+
+    def _setup_next(self, unused_frame):
+        """
+        Run the next queue declaration or binding, or begin consuming once
+        all are done.
+        """
+        if not self._setup:
+            self._setting_up = False
+            if not self._declared:
+                self._declared = True
+                self.munch(None)
+            elif not self._paused: # Bindings added while consuming
+                self._consume()
+            return
+        queue_name, binding_key = self._setup.popleft()
+        if binding_key is None:
+            arguments = None
+            if self._dead_letter_exchange is not None:
+                arguments = {"x-dead-letter-exchange": self._dead_letter_exchange}
+            self._channel.queue_declare(self.declare_queue_success,
+                                        queue_name,
+                                        arguments=arguments)
+        else:
+            self._channel.queue_bind(self._setup_next,
+                                     queue_name,
+                                     self._exchange,
+                                     binding_key)
 
     def munch(self, unused):
+        """
+        Limit unacknowledged deliveries, then begin consuming.
+        """
+        self._channel.basic_qos(self.start_consuming, prefetch_count=self._prefetch_count)
+
+    def start_consuming(self, unused_frame):
         """
         Begin consuming messages from the Airavata API server.
         """
         self._channel.add_on_cancel_callback(self.cancel_channel)
-        self._consumer_tag = self._channel.basic_consume(self._process_message)
+        self._paused = False
+        self._consume()
+
+    def _consume(self):
+        """
+        Register this consumer with the server for every queue not yet
+        being consumed from.
+        """
+        consuming = set(self._consumer_queues[tag] for tag in self._consumer_tags)
+        for queue_name in self._subscriptions:
+            if queue_name not in consuming:
+                consumer_tag = self._channel.basic_consume(self._process_message,
+                                                           queue=queue_name)
+                self._consumer_tags.append(consumer_tag)
+                self._consumer_queues[consumer_tag] = queue_name
+
+    def _cancel(self, callback=None):
+        """
+        Cancel every basic_consume, calling callback once the last one is
+        cancelled.
+
+        Keyword arguments:
+        callback -- a function to call with the final Basic.CancelOk frame
+                    (default None)
+        """
+        tags, self._consumer_tags = self._consumer_tags, []
+        for i, consumer_tag in enumerate(tags):
+            self._channel.basic_cancel(callback if i == len(tags) - 1 else None, consumer_tag)
+        if not tags and callback is not None:
+            callback()
 
     def cancel_channel(self, method_frame):
         if self._channel is not None:
@@ -163,7 +497,8 @@ class PikaAsyncConsumer(object):
 
     def _process_message(self, ch, method, properties, body):
         """
-        Receive and verify a message, then pass it to the router.
+        Receive a message and handle it, inline or on the worker pool,
+        alone or as part of a batch.
 
         Arguments:
         ch -- the channel that routed the message
@@ -172,17 +507,278 @@ class PikaAsyncConsumer(object):
         body -- the message
         """
         print("Received Message: %s" % body)
-        self._message_handler(body)
-        #self._channel.basic_ack(delivery_tag=method.delivery_tag)
+        self._outstanding.add(method.delivery_tag)
+        table = self._subscriptions.get(self._consumer_queues.get(method.consumer_tag))
+        handler = None
+        if table is not None and table.bindings:
+            # Messages published to the queue directly, or through a stale
+            # binding on a durable queue, go to the queue's first handler
+            handler = table.lookup(method.routing_key) or table.bindings[0][1]
+        if handler is None:
+            print("[ERROR] No handler for routing key %s" % (method.routing_key))
+            self._finish(method.delivery_tag, self._epoch, _UNREADABLE)
+            return
+
+        delivery_tag = method.delivery_tag
+        content_type = properties.content_type
+        content_encoding = properties.content_encoding
+        if content_type == chunking.CONTENT_TYPE:
+            try:
+                message = self.reassembler.add(body)
+            except ValueError as e:
+                print("[ERROR] Could not read chunk: %s" % (e))
+                self._finish(delivery_tag, self._epoch, _UNREADABLE)
+                return
+            self._finish(delivery_tag, self._epoch, _HANDLED)
+            if message is None:
+                return
+            body, content_type, content_encoding = message
+            delivery_tag = None # Its chunks are already acknowledged
+
+        if self._batch_size:
+            timestamp = getattr(properties, "timestamp", None) or time.time()
+            messages = self._batches.setdefault(handler, [])
+            messages.append((body, content_type, content_encoding,
+                             method.routing_key, timestamp, delivery_tag))
+            if len(messages) >= self._batch_size:
+                del self._batches[handler]
+                self._handle_messages(handler, messages)
+            elif self._batch_timer is None:
+                self._batch_timer = self._connection.add_timeout(self._batch_interval,
+                                                                 self._on_batch_timer)
+            return
+
+        self._handle(method.routing_key, [delivery_tag], _handle_message,
+                     (handler, body, content_type, content_encoding,
+                      self._decode, self._expand_batches))
+
+    def _on_batch_timer(self):
+        self._batch_timer = None
+        self._flush_batch()
+
+    def _flush_batch(self):
+        """
+        Hand the messages collected so far to their batch handlers.
+        """
+        if self._batch_timer is not None:
+            self._connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        batches, self._batches = self._batches, {}
+        for handler, messages in batches.items():
+            self._handle_messages(handler, messages)
+
+    def _handle_messages(self, handler, messages):
+        """
+        Hand a batch to its handler. Batches are ordered by handler, so
+        each handler's batches run one at a time.
+
+        Arguments:
+        handler -- the batch handler
+        messages -- the messages, as built by _process_message
+        """
+        self._handle(handler, [message[-1] for message in messages], _handle_batch,
+                     (handler, messages, self._decode, self._expand_batches))
+
+    def _handle(self, key, delivery_tags, function, args):
+        """
+        Run a handling function inline, or queue it on the worker pool
+        behind earlier work with the same key.
+
+        Arguments:
+        key -- the routing key (or batch handler) to keep in order
+        delivery_tags -- the delivery tags of the messages being handled
+        function -- _handle_message or _handle_batch
+        args -- the arguments to function
+        """
+        if self._pool is None:
+            self._finish_all(delivery_tags, self._epoch, function(*args))
+            return
+
+        self._in_flight += len(delivery_tags)
+        if key in self._key_queues: # Wait behind earlier work with this key
+            self._key_queues[key].append((delivery_tags, function, args))
+        else:
+            self._key_queues[key] = deque()
+            self._submit(key, delivery_tags, function, args)
+        if self._in_flight >= self._max_in_flight and not self._paused:
+            self._paused = True
+            self._cancel()
+        if self._poll_timer is None:
+            self._poll_timer = self._connection.add_timeout(self._poll_interval,
+                                                            self._poll_finished)
+
+    def _submit(self, key, delivery_tags, function, args):
+        """
+        Hand work to the worker pool.
+
+        Arguments:
+        key -- the routing key (or batch handler) the work is ordered by
+        delivery_tags -- the delivery tags of the messages being handled
+        function -- _handle_message or _handle_batch
+        args -- the arguments to function
+        """
+        epoch = self._epoch
+        future = self._pool.submit(function, *args)
+        future.add_done_callback(
+            lambda future: self._finished.append((key, delivery_tags, epoch, future)))
+
+    def _poll_finished(self):
+        """
+        Acknowledge messages the workers have finished, start the next
+        work for each key, and resume consuming if paused.
+        """
+        self._poll_timer = None
+        while self._finished:
+            key, delivery_tags, epoch, future = self._finished.popleft()
+            try:
+                outcomes = future.result()
+            except Exception as e: # e.g. the handler could not be pickled
+                print("[ERROR] Could not dispatch message: %s" % (e))
+                outcomes = _FAILED
+            if epoch == self._epoch:
+                self._in_flight -= len(delivery_tags)
+            self._finish_all(delivery_tags, epoch, outcomes)
+            waiting = self._key_queues.get(key)
+            if waiting:
+                self._submit(key, *waiting.popleft())
+            elif waiting is not None:
+                del self._key_queues[key]
+
+        if (self._paused and self._in_flight <= self._max_in_flight // 2 and
+                self._channel is not None):
+            self._paused = False
+            self._consume()
+        if self._key_queues:
+            self._poll_timer = self._connection.add_timeout(self._poll_interval,
+                                                            self._poll_finished)
+
+    def _finish_all(self, delivery_tags, epoch, outcomes):
+        """
+        Acknowledge or reject handled messages.
+
+        Arguments:
+        delivery_tags -- the messages' delivery tags
+        epoch -- the value of self._epoch when the messages were received
+        outcomes -- a list of outcomes, one per message, or one outcome for
+                    all of them
+        """
+        if not isinstance(outcomes, list):
+            outcomes = [outcomes] * len(delivery_tags)
+        for delivery_tag, outcome in zip(delivery_tags, outcomes):
+            self._finish(delivery_tag, epoch, outcome)
+
+    def _finish(self, delivery_tag, epoch, outcome):
+        """
+        Acknowledge or reject a message once it has been handled.
+
+        Arguments:
+        delivery_tag -- the message's delivery tag, or None for a
+                        reassembled message
+        epoch -- the value of self._epoch when the message was received
+        outcome -- the result of _handle_message
+        """
+        if delivery_tag is None: # A reassembled message; its chunks were acknowledged
+            return
+        if epoch != self._epoch: # The channel closed; the server redelivers it
+            return
+        self._outstanding.discard(delivery_tag)
+        if outcome == _HANDLED:
+            self._ack(delivery_tag)
+        elif outcome == _UNREADABLE:
+            self._reject(delivery_tag, requeue=False)
+        else:
+            self._reject(delivery_tag, requeue=self._requeue_on_error)
+
+    def _ack(self, delivery_tag):
+        """
+        Acknowledge a handled message, batching acks into one multiple ack
+        per ack_batch messages or ack_interval seconds.
+
+        Arguments:
+        delivery_tag -- the message's delivery tag
+        """
+        self._handled.append(delivery_tag)
+        if len(self._handled) >= self._ack_batch:
+            self._flush_acks()
+        elif self._ack_timer is None:
+            self._ack_timer = self._connection.add_timeout(self._ack_interval,
+                                                           self._on_ack_timer)
+
+    def _on_ack_timer(self):
+        self._ack_timer = None
+        self._flush_acks()
+
+    def _flush_acks(self):
+        """
+        Acknowledge every handled message. Messages below the oldest one
+        still being handled are covered by one multiple ack; with worker
+        dispatch, messages finished out of order are acked individually.
+        """
+        if self._ack_timer is not None:
+            self._connection.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if self._handled and self._channel is not None:
+            floor = min(self._outstanding) if self._outstanding else None
+            below = [tag for tag in self._handled if floor is None or tag < floor]
+            if below:
+                self._channel.basic_ack(delivery_tag=max(below), multiple=True)
+            for tag in self._handled:
+                if floor is not None and tag > floor:
+                    self._channel.basic_ack(delivery_tag=tag, multiple=False)
+            self.stats["acked"] += len(self._handled)
+        self._handled = []
+
+    def _reject(self, delivery_tag, requeue):
+        """
+        Negatively acknowledge one message. Without requeueing, the server
+        dead-letters it if the queue has a dead letter exchange and drops it
+        otherwise.
+
+        Arguments:
+        delivery_tag -- the message's delivery tag
+        requeue -- whether the server should redeliver the message
+        """
+        if self._channel is not None:
+            self._channel.basic_nack(delivery_tag=delivery_tag, multiple=False,
+                                     requeue=requeue)
+            self.stats["rejected"] += 1
+
+    def _reset_acks(self):
+        """
+        Forget pending acks and consumer registrations after their channel
+        closed; the server redelivers the unacknowledged messages.
+        Messages still on the worker pool are finished but not
+        acknowledged.
+        """
+        if self._ack_timer is not None:
+            self._connection.remove_timeout(self._ack_timer)
+            self._ack_timer = None
+        if self._batch_timer is not None:
+            self._connection.remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        self._handled = []
+        self._batches = {}
+        self._consumer_tags = []
+        self._consumer_queues = {}
+        self._setup.clear()
+        self._setting_up = False
+        self._declared = False
+        self._outstanding.clear()
+        self._epoch += 1
+        self._in_flight = 0
+        for waiting in self._key_queues.values():
+            waiting.clear()
 
     def stop_consuming(self):
         """
         Stop the consumer if active.
         """
         if self._channel:
-            self._channel.basic_cancel(self.close_channel, self._consumer_tag)
+            self._flush_batch()
+            self._flush_acks()
+            self._cancel(self.close_channel)
 
-    def close_channel(self):
+    def close_channel(self, unused_frame=None):
         """
         Close the channel to shut down the consumer and connection.
         """
@@ -200,4 +796,5 @@ class PikaAsyncConsumer(object):
         Stop an active connection with the RabbitMQ server.
         """
         self._closing = True
+        self._shut_down = True
         self.stop_consuming()
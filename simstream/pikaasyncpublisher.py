@@ -0,0 +1,394 @@
+"""
+Utilities for publishing data from a background thread.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+import time
+
+import pika
+
+from .backoff import Backoff
+
+
+POLICIES = ("block", "drop_newest", "drop_oldest")
+
+# Extra seconds shutdown() waits for the thread to close its connection
+# after the shutdown timeout has expired
+_SHUTDOWN_GRACE = 1.0
+
+
+class PikaAsyncPublisher(Thread):
+    """Publishes queued messages from a dedicated I/O thread.
+
+    Callers hand messages to publish(), which returns as soon as the message
+    is queued. The thread owns a SelectConnection and drains the bounded
+    queue from its ioloop, so a slow broker never blocks the caller unless
+    the queue is full and the policy is 'block'.
+
+    In confirm mode the channel uses publisher confirms. Up to window
+    messages may be awaiting confirmation at once, so publishing stays
+    pipelined. Messages that are nacked, or still unconfirmed when the
+    connection drops, are queued again ahead of new messages and retried
+    up to max_retries times.
+
+    Lost connections are reopened after an exponential backoff with
+    jitter; messages keep queueing (subject to the policy) meanwhile.
+
+    Instance variables:
+    maxsize -- the maximum number of queued messages
+    policy -- what to do when the queue is full: 'block' the caller,
+              'drop_newest' (discard the new message) or 'drop_oldest'
+              (discard the oldest queued message)
+    confirm -- whether publisher confirms are enabled
+    window -- the maximum number of unconfirmed messages in flight
+    max_retries -- the number of times a message is retried before it is
+                   dropped
+    backoff -- the Backoff pacing reconnect attempts and measuring outages
+    stats -- a dict of counters: 'published', 'dropped', 'blocked',
+             'max_depth', 'confirmed', 'nacked' and 'retried'
+
+    Public methods:
+    depth -- get the number of queued messages
+    in_flight -- get the number of unconfirmed messages
+    publish -- queue a message
+    shutdown -- publish queued messages until a timeout, then close the
+                connection and return the rest
+    """
+
+    def __init__(self, rabbitmq_url, exchange, exchange_type="direct", maxsize=1000,
+                 policy="block", poll_interval=0.01, confirm=False, window=100,
+                 max_retries=3, backoff=None):
+        """
+        Arguments:
+        rabbitmq_url -- the url of the RabbitMQ server to send to
+        exchange -- the name of the exchange to send to
+
+        Keyword arguments:
+        exchange_type -- one of 'direct', 'topic', 'fanout', 'headers'
+                         (default 'direct')
+        maxsize -- the maximum number of queued messages (default 1000)
+        policy -- one of 'block', 'drop_newest', 'drop_oldest'
+                  (default 'block')
+        poll_interval -- seconds between checks of an empty queue
+                         (default 0.01)
+        confirm -- if True, enable publisher confirms (default False)
+        window -- the maximum number of unconfirmed messages in flight
+                  (default 100)
+        max_retries -- the number of times a nacked or unconfirmed message
+                       is retried before it is dropped (default 3)
+        backoff -- the Backoff pacing reconnect attempts (default
+                   Backoff())
+
+        Raises:
+        ValueError if policy is not a known policy
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %s" % (policy))
+        super(PikaAsyncPublisher, self).__init__(name="simstream-publisher")
+        self.daemon = True
+        self.maxsize = maxsize
+        self.policy = policy
+        self.confirm = confirm
+        self.window = window
+        self.max_retries = max_retries
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.stats = {"published": 0, "dropped": 0, "blocked": 0, "max_depth": 0,
+                      "confirmed": 0, "nacked": 0, "retried": 0}
+        self._url = rabbitmq_url
+        self._exchange = exchange
+        self._exchange_type = exchange_type
+        self._poll_interval = poll_interval
+        self._queue = deque()
+        self._condition = Condition()
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._stopping = False
+        self._deadline = None # time.monotonic() time at which shutdown gives up
+        self._unconfirmed = OrderedDict() # delivery tag -> queued message
+        self._delivery_tag = 0
+
+    def depth(self):
+        """
+        Get the number of queued messages.
+        """
+        return len(self._queue)
+
+    def in_flight(self):
+        """
+        Get the number of messages awaiting confirmation.
+        """
+        return len(self._unconfirmed)
+
+    def publish(self, routing_key, body, properties=None, timeout=None):
+        """
+        Queue a message for publishing.
+
+        Arguments:
+        routing_key -- the routing key to publish to
+        body -- the message body
+
+        Keyword arguments:
+        properties -- the message's pika.BasicProperties (default None)
+        timeout -- seconds to wait for space under the 'block' policy;
+                   None waits indefinitely (default None)
+
+        Returns:
+        True if the message was queued, False if it was dropped
+        """
+        with self._condition:
+            if self._stopping:
+                self.stats["dropped"] += 1
+                return False
+            if len(self._queue) >= self.maxsize:
+                if self.policy == "drop_newest":
+                    self.stats["dropped"] += 1
+                    return False
+                elif self.policy == "drop_oldest":
+                    self._queue.popleft()
+                    self.stats["dropped"] += 1
+                else:
+                    self.stats["blocked"] += 1
+                    if not self._condition.wait_for(lambda: len(self._queue) < self.maxsize,
+                                                    timeout=timeout):
+                        self.stats["dropped"] += 1
+                        return False
+            self._queue.append((routing_key, body, properties, 0))
+            if len(self._queue) > self.stats["max_depth"]:
+                self.stats["max_depth"] = len(self._queue)
+            return True
+
+    def run(self):
+        """
+        Run the ioloop until shut down, reconnecting whenever the loop is
+        stopped for a lost connection. Messages still queued at shutdown
+        keep the thread reconnecting until they are published or the
+        shutdown timeout expires.
+        """
+        while True:
+            self._connection = self.connect()
+            self._connection.ioloop.start()
+            if self._finished():
+                break
+
+    def shutdown(self, timeout=None):
+        """
+        Stop accepting messages, publish everything already queued (and, in
+        confirm mode, wait for it to be confirmed), and close the
+        connection. If the queue has not drained after timeout seconds, for
+        example because the broker is unreachable, the thread gives up and
+        the remaining messages are returned instead.
+
+        Keyword arguments:
+        timeout -- seconds to wait for the queue to drain; None waits
+                   indefinitely (default None)
+
+        Returns:
+        a list of the (routing key, body, properties) messages that were
+        not published, oldest first
+        """
+        with self._condition:
+            self._stopping = True
+            if timeout is not None:
+                self._deadline = time.monotonic() + timeout
+        if self.is_alive():
+            self.join(None if timeout is None else timeout + _SHUTDOWN_GRACE)
+
+        with self._condition:
+            messages = list(self._queue)
+            self._queue.clear()
+            if not self.is_alive(): # Otherwise the ioloop still owns them
+                messages = list(self._unconfirmed.values()) + messages
+                self._unconfirmed.clear()
+        return [(routing_key, body, properties)
+                for routing_key, body, properties, unused_attempts in messages]
+
+    def _expired(self):
+        """
+        Check whether the shutdown timeout has passed.
+        """
+        return self._deadline is not None and time.monotonic() >= self._deadline
+
+    def _finished(self):
+        """
+        Check whether the thread should exit: shutting down, and either
+        nothing is left to publish or the shutdown timeout has passed.
+        """
+        return self._stopping and (not self._queue or self._expired())
+
+    def connect(self):
+        """
+        Create an asynchronous connection to the RabbitMQ server.
+        """
+        return pika.SelectConnection(pika.URLParameters(self._url),
+                                     on_open_callback=self._on_connection_open,
+                                     on_open_error_callback=self._on_connection_error,
+                                     on_close_callback=self._on_connection_close,
+                                     stop_ioloop_on_close=False)
+
+    def _on_connection_open(self, unused_connection):
+        """
+        Open a channel once the connection is established.
+
+        Arguments:
+        unused_connection -- a reference to self._connection
+        """
+        self._connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, unused_connection, error=None):
+        """
+        Retry a connection that could not be opened, unless shutting down.
+
+        Arguments:
+        unused_connection -- a reference to self._connection
+
+        Keyword arguments:
+        error -- the reason the connection failed (default None)
+        """
+        print("[ERROR] Could not connect to %s: %s" % (self._url, error))
+        self._retry_later()
+
+    def _on_connection_close(self, connection, code, text):
+        """
+        Stop the ioloop on shutdown, otherwise try to reconnect.
+
+        Arguments:
+        connection -- the connection that was closed (same as self._connection)
+        code -- response code from the RabbitMQ server
+        text -- response body from the RabbitMQ server
+        """
+        self._channel = None
+        self._ready = False
+        self._requeue_unconfirmed()
+        self._retry_later()
+
+    def _retry_later(self):
+        """
+        Stop the ioloop so that run() exits on shutdown or reconnects after
+        a backoff delay, cut short by the shutdown timeout.
+        """
+        if self._finished():
+            self._connection.ioloop.stop()
+            return
+        delay = self.backoff.failed()
+        if self._deadline is not None:
+            delay = max(min(delay, self._deadline - time.monotonic()), 0)
+        self._connection.add_timeout(delay, self._connection.ioloop.stop)
+
+    def _on_channel_open(self, channel):
+        """
+        Declare the exchange on a newly opened channel.
+
+        Arguments:
+        channel -- the newly opened channel
+        """
+        self._channel = channel
+        self._channel.add_on_close_callback(self._on_channel_close)
+        self._channel.exchange_declare(self._on_exchange_declared,
+                                       self._exchange,
+                                       self._exchange_type)
+
+    def _on_channel_close(self, channel, code, text):
+        """
+        Close the connection when the channel closes.
+
+        Arguments:
+        channel -- the channel that was closed (same as self._channel)
+        code -- response code from the RabbitMQ server
+        text -- response body from the RabbitMQ server
+        """
+        self._channel = None
+        self._ready = False
+        self._connection.close()
+
+    def _on_exchange_declared(self, unused_frame):
+        """
+        Enable confirms if requested, then start draining the queue once the
+        exchange exists.
+        """
+        if self.confirm:
+            self._delivery_tag = 0
+            self._channel.confirm_delivery(self._on_delivery_confirmation)
+        self.backoff.succeeded()
+        self._ready = True
+        self._drain()
+
+    def _on_delivery_confirmation(self, method_frame):
+        """
+        Retire acked messages from the window and requeue nacked ones.
+
+        Arguments:
+        method_frame -- the Basic.Ack or Basic.Nack frame from the server
+        """
+        method = method_frame.method
+        if method.multiple:
+            tags = [tag for tag in self._unconfirmed if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag] if method.delivery_tag in self._unconfirmed else []
+
+        messages = [self._unconfirmed.pop(tag) for tag in tags]
+        if method.NAME == "Basic.Nack":
+            self.stats["nacked"] += len(messages)
+            self._retry(messages)
+        else:
+            self.stats["confirmed"] += len(messages)
+
+    def _requeue_unconfirmed(self):
+        """
+        Retry every message still awaiting confirmation, e.g. after the
+        connection was lost.
+        """
+        messages = list(self._unconfirmed.values())
+        self._unconfirmed.clear()
+        self._retry(messages)
+
+    def _retry(self, messages):
+        """
+        Put messages back at the front of the queue, dropping any that have
+        exhausted their retries.
+
+        Arguments:
+        messages -- the queued messages to retry, oldest first
+        """
+        with self._condition:
+            for routing_key, body, properties, attempts in reversed(messages):
+                if attempts >= self.max_retries:
+                    self.stats["dropped"] += 1
+                else:
+                    self.stats["retried"] += 1
+                    self._queue.appendleft((routing_key, body, properties, attempts + 1))
+
+    def _drain(self):
+        """
+        Publish queued messages (in confirm mode, only as many as the window
+        allows), then reschedule on the ioloop.
+        """
+        if not self._ready:
+            return
+        with self._condition:
+            if self.confirm:
+                count = min(len(self._queue), max(self.window - len(self._unconfirmed), 0))
+            else:
+                count = len(self._queue)
+            messages = [self._queue.popleft() for _ in range(count)]
+            self._condition.notify_all()
+
+        for message in messages:
+            routing_key, body, properties, unused_attempts = message
+            self._channel.basic_publish(exchange=self._exchange,
+                                        routing_key=routing_key,
+                                        body=body,
+                                        properties=properties)
+            if self.confirm:
+                self._delivery_tag += 1
+                self._unconfirmed[self._delivery_tag] = message
+        self.stats["published"] += len(messages)
+
+        if self._stopping and (self._expired() or not self._queue and not self._unconfirmed):
+            self._ready = False
+            self._connection.close()
+        else:
+            self._connection.add_timeout(self._poll_interval, self._drain)
@@ -4,8 +4,17 @@ Utilties for sending data.
 Author: Jeff Kinnison (jkinniso@nd.edu)
 """
 
-import json
+from collections import deque
+import time
+
 import pika
+from pika.exceptions import AMQPError
+
+from . import chunking
+from .backoff import Backoff
+from .codec import get_codec
+from .compression import Compressor
+from .pikaasyncpublisher import PikaAsyncPublisher
 
 
 class PikaProducer(object):
@@ -13,7 +22,11 @@ class PikaProducer(object):
     Utility for sending job data to a set of endpoints.
     """
 
-    def __init__(self, rabbitmq_url, exchange, exchange_type="direct", routing_keys=[]):
+    def __init__(self, rabbitmq_url, exchange, exchange_type="direct", routing_keys=[], codec="json",
+                 compression=None, compression_threshold=1024, compression_ratio=0.9,
+                 asynchronous=False, queue_size=1000, queue_policy="block", confirm=False,
+                 confirm_window=100, max_retries=3, pool=None, retry_buffer_size=1000,
+                 backoff=None, spool=None, chunk_size=None, shutdown_timeout=10.0):
         """
         Instantiate a new PikaProducer.
 
@@ -26,31 +39,103 @@ class PikaProducer(object):
                          (default 'direct')
         routing_key -- the routing keys to the endpoints for this producer
                        (default [])
+        codec -- the name of the registered codec used to serialize data;
+                 it is announced in each message's content_type
+                 (default 'json')
+        compression -- the name of a registered compression scheme (e.g.
+                       'zlib' or 'lzma'), announced in content_encoding, or
+                       None to send uncompressed (default None)
+        compression_threshold -- the minimum message size in bytes to
+                                 compress (default 1024)
+        compression_ratio -- the largest compressed/original size ratio
+                             worth sending (default 0.9)
+        asynchronous -- if True, publish from a background I/O thread fed
+                        by a bounded queue so calls return immediately
+                        (default False)
+        queue_size -- the maximum number of messages queued for the
+                      background thread (default 1000)
+        queue_policy -- what to do when the queue is full: 'block',
+                        'drop_newest' or 'drop_oldest' (default 'block')
+        confirm -- if True, use publisher confirms and retry nacked or
+                   unconfirmed messages; implies asynchronous
+                   (default False)
+        confirm_window -- the maximum number of unconfirmed messages in
+                          flight (default 100)
+        max_retries -- the number of times a message is retried before it
+                       is dropped (default 3)
+        pool -- a ConnectionPool (e.g. simstream.connectionpool.get_pool())
+                to publish through instead of opening a dedicated
+                connection; ignored when publishing asynchronously
+                (default None)
+        retry_buffer_size -- the maximum number of messages kept while the
+                             broker is unreachable; the oldest are dropped
+                             first (default 1000)
+        backoff -- the Backoff pacing reconnect attempts (default
+                   Backoff())
+        spool -- a Spool that receives messages while the broker is
+                 unreachable, to be published later by replay() (default
+                 None)
+        chunk_size -- if set, messages larger than chunk_size bytes (after
+                      compression) are split into chunks of that size,
+                      which PikaAsyncConsumer reassembles (default None)
+        shutdown_timeout -- the most seconds shutdown() waits for the
+                            background publisher to drain its queue; the
+                            rest is spooled, or dropped without a spool
+                            (default 10.0)
+
+        Raises:
+        CodecDoesNotExistException if no codec named codec is registered
+        CompressorDoesNotExistException if compression is not registered
         """
         self._url = rabbitmq_url
         self._exchange = exchange
         self._exchange_type = exchange_type
         self._routing_keys = routing_keys
+        self.codec = get_codec(codec)
+        self.chunk_size = chunk_size
+        self.compressor = None
+        if compression is not None:
+            self.compressor = Compressor(compression,
+                                         threshold=compression_threshold,
+                                         min_ratio=compression_ratio)
 
         self._connection = None # RabbitMQ connection object
         self._channel = None    # RabbitMQ channel object
+        self.pool = pool        # Shared connections, if any
+
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.spool = spool
+        self.shutdown_timeout = shutdown_timeout
+        self.stats = {"buffered": 0, "dropped": 0}
+        self._retry_buffer = deque(maxlen=retry_buffer_size)
+        self._next_attempt = 0.0
+
+        self.publisher = None   # Background publishing thread
+        if asynchronous or confirm:
+            self.publisher = PikaAsyncPublisher(rabbitmq_url, exchange, exchange_type,
+                                                maxsize=queue_size, policy=queue_policy,
+                                                confirm=confirm, window=confirm_window,
+                                                max_retries=max_retries, backoff=self.backoff)
 
         import random
         self._name = random.randint(0,100)
 
-    def __call__(self, data):
+    def __call__(self, data, routing_keys=None):
         """
         Publish data to the RabbitMQ server.
 
         Arguments:
         data -- JSON serializable data to send
+
+        Keyword arguments:
+        routing_keys -- the routing keys to send to instead of the
+                        producer's own (default None)
         """
         print("Sending data")
-        if self._connection is None: # Start the connection if it is inactive
-            self.start()
-        else: # Serialize and send the data
-            message = self.pack_data(data)
-            self.send_data(message)
+        if self.publisher is not None or self._connection is None:
+            self.start() # Start the connection if it is inactive
+        message = self.pack_data(data) # Serialize and send the data
+        self.send_data(message, routing_keys)
 
     def add_routing_key(self, key):
         """
@@ -78,106 +163,261 @@ class PikaProducer(object):
 
     def pack_data(self, data):
         """
-        JSON-serialize the data for transport.
+        Serialize the data for transport with the producer's codec.
 
         Arguments:
-        data -- JSON-serializable data
+        data -- data serializable by the codec
         """
-        try: # Generate a JSON string from the data
-            msg = json.dumps(data)
-        except TypeError as e: # Generate and return an error if serialization fails
-            msg = json.dumps({"err": str(e)})
+        try: # Encode the data
+            msg = self.codec.encode(data)
+        except (TypeError, ValueError) as e: # Generate and return an error if serialization fails
+            msg = self.codec.encode({"err": str(e)})
         finally:
             print(msg)
             return msg
 
-    def send_data(self, data):
+    def send_data(self, data, routing_keys=None):
         """
-        Send the data to all active endpoints.
+        Send the data to all active endpoints. Without a background
+        publisher, messages that cannot be sent are kept in the retry
+        buffer and sent in order once the connection is restored. With a
+        spool, messages that cannot be sent are spooled instead.
 
         Arguments:
         data -- the message to send
-        """
-        if self._channel is not None: # Make sure the connection is active
-            for key in self._routing_keys: # Send to all endpoints
-                print(self._exchange, key, self._name)
-                self._channel.basic_publish(exchange = self._exchange,
-                                            routing_key=key,
-                                            body=data)
 
-    def start(self):
+        Keyword arguments:
+        routing_keys -- the routing keys to send to instead of the
+                        producer's own (default None)
         """
-        Open a connection if one does not exist.
+        if routing_keys is None:
+            routing_keys = self._routing_keys
+        parts = self._prepare(data)
+        if self.publisher is not None: # Hand off to the background thread
+            for key in routing_keys:
+                for body, properties in parts:
+                    if self.spool is not None and self.backoff.outage() > 0:
+                        self._spool(key, body, properties)
+                    else:
+                        self.publisher.publish(key, body, properties)
+        else:
+            messages = [(key, body, properties) for key in routing_keys
+                        for body, properties in parts]
+            for message in messages:
+                self._buffer(message)
+            if not self._flush_retry_buffer():
+                self.stats["buffered"] += min(len(messages), len(self._retry_buffer))
+                if self.spool is not None: # Keep memory bounded during long outages
+                    while self._retry_buffer:
+                        self._spool(*self._retry_buffer.popleft())
+
+    def replay(self, limit=None):
         """
-        print("Starting new connection")
-        if self._connection is None:
-            print("Creating connection object")
-            self._connection = pika.BlockingConnection(pika.URLParameters(self._url))
-            self._channel = self._connection.channel()
-            self._channel.exchange_declare(exchange=self._exchange,
-                                           type=self._exchange_type)
+        Publish spooled messages, oldest first, if the broker is reachable.
 
-    def shutdown(self):
+        Keyword arguments:
+        limit -- the most messages to publish, or None for all
+                 (default None)
+
+        Returns:
+        the number of messages published
         """
-        Close an existing connection.
+        if self.spool is None or len(self.spool) == 0:
+            return 0
+        if self.publisher is not None:
+            if self.backoff.outage() > 0:
+                return 0
+            return self.spool.replay(self._publish_spooled(self.publisher.publish), limit)
+        if not self._flush_retry_buffer():
+            return 0
+        try:
+            if self.pool is not None:
+                with self.pool.channel(self._url, self._exchange, self._exchange_type) as channel:
+                    return self.spool.replay(self._publish_spooled(self._publisher_for(channel)),
+                                             limit)
+            return self.spool.replay(self._publish_spooled(self._publisher_for(self._channel)),
+                                     limit)
+        except AMQPError as e:
+            self._on_publish_error(e)
+            return 0
+
+    def _spool(self, routing_key, body, properties):
         """
-        if self._channel is not None:
-            self._channel.close()
+        Write a message to the spool.
 
-    def _on_connection_open(self, unused_connection):
+        Arguments:
+        routing_key -- the routing key to publish to
+        body -- the message body
+        properties -- the message's pika.BasicProperties
         """
-        Create a new channel if the connection opens successful.
+        self.spool.append(routing_key, body, properties.content_type,
+                          properties.content_encoding)
+
+    def _publish_spooled(self, publish):
+        """
+        Adapt a publish function to the records replayed from the spool.
 
         Arguments:
-        unused_connection -- a reference to self._connection
+        publish -- a function taking a routing key, body and properties
         """
-        print("Connection is open")
-        self._connection.channel(on_open_callback=self._on_channel_open)
+        def publish_record(routing_key, body, content_type, content_encoding):
+            publish(routing_key, body, pika.BasicProperties(content_type=content_type,
+                                                            content_encoding=content_encoding))
+        return publish_record
 
-    def _on_connection_close(self, connection, code, text):
+    def _publisher_for(self, channel):
         """
-        Actions to take when the connection is closed for any reason.
+        Get a function publishing to the exchange on a channel.
 
         Arguments:
-        connection -- the connection that was closed (same as self._connection)
-        code -- response code from the RabbitMQ server
-        text -- response body from the RabbitMQ server
+        channel -- the channel to publish on
         """
-        print("Connection is closed")
-        self._channel = None
-        self._connection = None
-
-    def _on_channel_open(self, channel):
+        def publish(routing_key, body, properties):
+            channel.basic_publish(exchange=self._exchange,
+                                  routing_key=routing_key,
+                                  body=body,
+                                  properties=properties)
+        return publish
+
+    def _prepare(self, data):
         """
-        Actions to take when the channel opens.
+        Compress a message and split it into chunks if configured, and build
+        the properties of each part.
 
         Arguments:
-        channel -- the newly opened channel
+        data -- the message to send
+
+        Returns:
+        a list of (body, pika.BasicProperties) pairs: the message itself,
+        or its chunks in order
+        """
+        encoding = None
+        if self.compressor is not None:
+            if isinstance(data, str):
+                data = data.encode()
+            data, encoding = self.compressor.compress(data)
+        return [(body, pika.BasicProperties(content_type=content_type,
+                                            content_encoding=content_encoding))
+                for body, content_type, content_encoding
+                in chunking.split(data, self.codec.content_type, encoding, self.chunk_size)]
+
+    def start(self):
+        """
+        Open a connection if one does not exist. A failed connection attempt
+        starts an outage instead of raising; see _flush_retry_buffer.
         """
-        print("Channel is open")
-        self._channel = channel
-        self._channel.add_on_close_callback(self._on_channel_close)
-        self._declare_exchange()
+        print("Starting new connection")
+        if self.publisher is not None:
+            if self.publisher.ident is None:
+                self.publisher.start()
+        elif self.pool is None and self._connection is None: # Pooled connections open lazily
+            if self.backoff.outage() == 0 or time.monotonic() >= self._next_attempt:
+                try:
+                    self._connect()
+                except AMQPError as e:
+                    self._on_publish_error(e)
 
-    def _on_channel_close(self, channel, code, text):
+    def shutdown(self):
+        """
+        Close an existing connection. A background publisher first publishes
+        queued messages for up to shutdown_timeout seconds; any it could not
+        publish are spooled, or counted as dropped without a spool. Pooled
+        connections are left open for other producers.
         """
-        Actions to take when the channel closes for any reason.
+        if self.publisher is not None:
+            for routing_key, body, properties in self.publisher.shutdown(self.shutdown_timeout):
+                if self.spool is not None:
+                    self._spool(routing_key, body, properties)
+                else:
+                    self.stats["dropped"] += 1
+        elif self._channel is not None:
+            try:
+                self._channel.close()
+            except AMQPError:
+                pass
+        if self.spool is not None:
+            self.spool.close()
+
+    def _connect(self):
+        """
+        Open a dedicated connection and declare the exchange.
+        """
+        print("Creating connection object")
+        self._connection = pika.BlockingConnection(pika.URLParameters(self._url))
+        self._channel = self._connection.channel()
+        self._channel.exchange_declare(exchange=self._exchange,
+                                       type=self._exchange_type)
+
+    def _buffer(self, message):
+        """
+        Append a message to the retry buffer, dropping the oldest buffered
+        message if it is full.
 
         Arguments:
-        channel -- the channel that was closed (same as self._channel)
-        code -- response code from the RabbitMQ server
-        text -- response body from the RabbitMQ server
+        message -- a (routing key, body, properties) tuple
         """
-        print("Channel is closed")
-        self._connection.close()
+        if len(self._retry_buffer) == self._retry_buffer.maxlen:
+            self.stats["dropped"] += 1
+        self._retry_buffer.append(message)
 
-    def _declare_exchange(self):
+    def _flush_retry_buffer(self):
         """
-        Set up the exchange to publish to even if it already exists.
+        Publish buffered messages in order, reconnecting first if the
+        connection was lost and the backoff delay has passed.
+
+        Returns:
+        True if the buffer was emptied, False if the broker is unreachable
         """
-        print("Exchange is declared")
-        self._channel.exchange_declare(exchange=self._exchange,
-                                       type=self.exchange_type)
+        if self.backoff.outage() > 0 and time.monotonic() < self._next_attempt:
+            return False
+        try:
+            if self.pool is not None:
+                with self.pool.channel(self._url, self._exchange, self._exchange_type) as channel:
+                    self._publish_buffered(channel)
+            else:
+                if self._connection is None:
+                    self._connect()
+                self._publish_buffered(self._channel)
+        except AMQPError as e:
+            self._on_publish_error(e)
+            return False
+        self.backoff.succeeded()
+        return True
+
+    def _publish_buffered(self, channel):
+        """
+        Publish the retry buffer on a channel, removing each message only
+        once it has been handed to the broker.
+
+        Arguments:
+        channel -- the channel to publish on
+        """
+        while self._retry_buffer:
+            key, body, properties = self._retry_buffer[0]
+            print(self._exchange, key, self._name)
+            channel.basic_publish(exchange=self._exchange,
+                                  routing_key=key,
+                                  body=body,
+                                  properties=properties)
+            self._retry_buffer.popleft()
+
+    def _on_publish_error(self, error):
+        """
+        Drop a failed connection and schedule the next attempt.
+
+        Arguments:
+        error -- the AMQP error that was raised
+        """
+        delay = self.backoff.failed()
+        print("[ERROR] Lost connection to %s (%s), retrying in %.1fs" % (self._url, error, delay))
+        self._next_attempt = time.monotonic() + delay
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except AMQPError:
+                pass
+        self._connection = None
+        self._channel = None
 
 if __name__ == "__main__":
     import time
@@ -0,0 +1,318 @@
+"""
+Utilities for storing collected data.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from array import array
+from threading import Condition, Lock
+import numbers
+import time
+
+
+POLICIES = ("drop_oldest", "drop_newest", "block", "downsample")
+
+
+def _typecode(value):
+    """
+    Get the array typecode that can hold a value, or None if the value is
+    not a plain number.
+
+    Arguments:
+    value -- the value to check
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, numbers.Integral):
+        return 'q'
+    if isinstance(value, numbers.Real):
+        return 'd'
+    return None
+
+
+class RingBuffer(object):
+    """Fixed-capacity buffer that keeps the most recent data points.
+
+    Numeric points, and dicts whose values are all numeric, are stored in
+    preallocated typed arrays (one per field). Anything else falls back to a
+    preallocated list of objects.
+
+    What happens when the buffer is full depends on its policy:
+    'drop_oldest' overwrites the oldest point, 'drop_newest' discards the
+    new point, 'block' makes put() wait until the buffer is drained, and
+    'downsample' thins the stored points to every k-th one (always keeping
+    the newest) to make room, so the buffer still spans the whole period
+    since the last drain at a lower resolution.
+
+    Instance variables:
+    capacity -- the maximum number of stored data points
+    policy -- the full-buffer policy
+    downsample -- the thinning factor k for the 'downsample' policy
+    timeout -- the most seconds put() waits under the 'block' policy
+               before discarding the new point, or None to wait
+               indefinitely
+    overwritten -- the number of points discarded because the buffer was full
+    dropped -- the number of points lost to any policy, including
+               overwritten points
+    downsampled -- the number of points removed by thinning
+    blocked -- the number of times put() had to wait for space
+    oldest -- the time.monotonic() time of the first point stored since the
+              last drain, or None if the buffer is empty
+
+    Public methods:
+    put -- store a data point
+    drain -- remove and return every stored point, oldest first
+    drain_columns -- remove and return every stored point in columnar form
+    """
+
+    def __init__(self, capacity, policy="drop_oldest", downsample=2, timeout=None):
+        """
+        Arguments:
+        capacity -- the maximum number of stored data points
+
+        Keyword arguments:
+        policy -- one of 'drop_oldest', 'drop_newest', 'block' or
+                  'downsample' (default 'drop_oldest')
+        downsample -- keep every k-th point when thinning; at least 2
+                      (default 2)
+        timeout -- the most seconds put() waits for space under the 'block'
+                   policy; None waits indefinitely (default None)
+
+        Raises:
+        ValueError if capacity is less than 1, policy is unknown, or
+        downsample is less than 2
+        """
+        if capacity < 1:
+            raise ValueError("RingBuffer capacity must be at least 1")
+        if policy not in POLICIES:
+            raise ValueError("Unknown buffer policy %s" % (policy))
+        if downsample < 2:
+            raise ValueError("RingBuffer downsample factor must be at least 2")
+        self.capacity = capacity
+        self.policy = policy
+        self.downsample = downsample
+        self.timeout = timeout
+        self.overwritten = 0
+        self.dropped = 0
+        self.downsampled = 0
+        self.blocked = 0
+        self.oldest = None
+        self._lock = Lock()
+        self._not_full = Condition(self._lock)
+        self._start = 0
+        self._size = 0
+        self._fields = None   # None for scalars, a tuple of keys for dicts
+        self._columns = None  # One typed array per field, or None
+        self._objects = None  # Object storage once the data is not numeric
+
+    def __len__(self):
+        return self._size
+
+    def put(self, value):
+        """
+        Store a data point, applying the buffer's policy if it is full.
+
+        Arguments:
+        value -- the data point to store
+
+        Returns:
+        True if the point was stored, False if it was discarded
+        """
+        with self._lock:
+            if self._size >= self.capacity:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                elif self.policy == "block":
+                    self.blocked += 1
+                    if not self._not_full.wait_for(lambda: self._size < self.capacity,
+                                                   timeout=self.timeout):
+                        self.dropped += 1
+                        return False
+                elif self.policy == "downsample":
+                    self._thin()
+
+            if self._columns is None and self._objects is None:
+                self._allocate(value)
+
+            if self._size == 0:
+                self.oldest = time.monotonic()
+            if self._size < self.capacity:
+                index = (self._start + self._size) % self.capacity
+                self._size += 1
+            else:
+                index = self._start
+                self._start = (self._start + 1) % self.capacity
+                self.overwritten += 1
+                self.dropped += 1
+
+            if self._columns is not None and not self._store_typed(index, value):
+                index = self._to_objects()
+            if self._objects is not None:
+                self._objects[index] = value
+            return True
+
+    def drain(self):
+        """
+        Remove and return every stored point as one list, oldest first.
+        """
+        with self._lock:
+            if self._columns is not None:
+                points = self._typed_points()
+            else:
+                points = self._take_objects()
+            self._reset()
+            return points
+
+    def drain_columns(self):
+        """
+        Remove and return every stored point in columnar form, oldest first.
+
+        Returns:
+        a dict of typed arrays if the points are dicts of numbers, a typed
+        array if the points are numbers, otherwise a list of points
+        """
+        with self._lock:
+            if self._columns is not None:
+                end = self._start + self._size
+                columns = [self._slice(column, end) for column in self._columns]
+                drained = columns[0] if self._fields is None else dict(zip(self._fields, columns))
+            else:
+                drained = self._take_objects()
+            self._reset()
+            return drained
+
+    def _reset(self):
+        """
+        Mark the buffer empty and wake any blocked put().
+        """
+        self._start = 0
+        self._size = 0
+        self.oldest = None
+        self._not_full.notify_all()
+
+    def _thin(self):
+        """
+        Keep every k-th stored point, counting back from the newest, and
+        compact them to the start of the storage.
+        """
+        end = self._start + self._size
+        first = (self._size - 1) % self.downsample
+        if self._columns is not None:
+            for i, column in enumerate(self._columns):
+                kept = self._slice(column, end)[first::self.downsample]
+                self._columns[i] = array(column.typecode, [0]) * self.capacity
+                self._columns[i][:len(kept)] = kept
+        else:
+            kept = self._slice(self._objects, end)[first::self.downsample]
+            self._objects = kept + [None] * (self.capacity - len(kept))
+        self.downsampled += self._size - len(kept)
+        self._start = 0
+        self._size = len(kept)
+
+    def _take_objects(self):
+        """
+        Remove the stored points from object storage, oldest first.
+        """
+        if self._objects is None:
+            return []
+        end = self._start + self._size
+        points = self._slice(self._objects, end)
+        for i in range(self._start, end):
+            self._objects[i % self.capacity] = None
+        return points
+
+    def _slice(self, storage, end):
+        """
+        Get the stored region of a column as one contiguous sequence.
+
+        Arguments:
+        storage -- the column to slice
+        end -- the unwrapped index one past the newest point
+        """
+        if end <= self.capacity:
+            return storage[self._start:end]
+        return storage[self._start:] + storage[:end - self.capacity]
+
+    def _allocate(self, value):
+        """
+        Choose typed or object storage based on the first data point.
+
+        Arguments:
+        value -- the first data point
+        """
+        if isinstance(value, dict) and len(value) > 0:
+            fields = tuple(value)
+            typecodes = [_typecode(value[key]) for key in fields]
+        else:
+            fields = None
+            typecodes = [_typecode(value)]
+
+        if None in typecodes:
+            self._objects = [None] * self.capacity
+        else:
+            self._fields = fields
+            self._columns = [array(code, [0]) * self.capacity for code in typecodes]
+
+    def _store_typed(self, index, value):
+        """
+        Write a data point into the typed columns, promoting integer columns
+        to floating point when needed.
+
+        Arguments:
+        index -- the slot to write to
+        value -- the data point
+
+        Returns:
+        False if the point does not fit the typed layout
+        """
+        if self._fields is None:
+            values = (value,)
+        elif isinstance(value, dict) and len(value) == len(self._fields):
+            try:
+                values = tuple(value[key] for key in self._fields)
+            except KeyError:
+                return False
+        else:
+            return False
+
+        for i, item in enumerate(values):
+            code = _typecode(item)
+            if code is None:
+                return False
+            column = self._columns[i]
+            if code == 'd' and column.typecode == 'q':
+                column = self._columns[i] = array('d', column)
+            try:
+                column[index] = item
+            except OverflowError:
+                return False
+        return True
+
+    def _to_objects(self):
+        """
+        Move every stored point into object storage, leaving the newest slot
+        for the caller to fill.
+
+        Returns:
+        the index of the newest slot
+        """
+        self._size -= 1
+        points = self._typed_points()
+        self._objects = [None] * self.capacity
+        self._objects[:len(points)] = points
+        self._columns = None
+        self._fields = None
+        self._start = 0
+        self._size = len(points) + 1
+        return len(points)
+
+    def _typed_points(self):
+        """
+        Rebuild the stored points, oldest first, from the typed columns.
+        """
+        end = self._start + self._size
+        columns = [self._slice(column, end).tolist() for column in self._columns]
+        if self._fields is None:
+            return columns[0]
+        return [dict(zip(self._fields, row)) for row in zip(*columns)]
@@ -0,0 +1,151 @@
+"""
+Utilities for dispatching consumed messages to handlers by routing key.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import re
+
+
+def compile_binding(binding_key, exchange_type="topic"):
+    """
+    Compile a binding key into a function that tests routing keys the way
+    the broker matches them.
+
+    Topic bindings are compiled to a regular expression in which '*'
+    matches exactly one word and '#' matches zero or more words. Direct
+    bindings match only their own key, and fanout and headers bindings
+    match every message.
+
+    Arguments:
+    binding_key -- the key the queue is bound with
+
+    Keyword arguments:
+    exchange_type -- the type of the exchange (default 'topic')
+
+    Returns:
+    a function taking a routing key and returning True if it matches
+    """
+    if exchange_type in ("fanout", "headers"):
+        return lambda routing_key: True
+    if exchange_type != "topic":
+        return lambda routing_key: routing_key == binding_key
+
+    # Matched against '.' + routing_key so that every word, including the
+    # first, is preceded by a separator and '#' can match zero words.
+    parts = []
+    for word in binding_key.split("."):
+        if word == "#":
+            parts.append(r"(?:\.[^.]*)*")
+        elif word == "*":
+            parts.append(r"\.[^.]*")
+        else:
+            parts.append(r"\." + re.escape(word))
+    pattern = re.compile("".join(parts) + r"\Z")
+    return lambda routing_key: pattern.match("." + routing_key) is not None
+
+
+class _Fanout(object):
+    """Calls several handlers with the same message, for routing keys that
+    match more than one binding. Module-level so that it can be pickled
+    for worker processes."""
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+    def __call__(self, message):
+        for handler in self.handlers:
+            handler(message)
+
+
+class RoutingTable(object):
+    """Maps routing keys to the handlers of the bindings they match.
+
+    Bindings are compiled when added, and the handler chosen for each
+    routing key is cached, so steady-state dispatch is a single dict
+    lookup however many bindings there are.
+
+    Instance variables:
+    exchange_type -- the type of the exchange the bindings are on
+    bindings -- a list of (binding key, handler) pairs, in the order added
+
+    Public methods:
+    add -- add a binding and its handler
+    remove -- remove a binding
+    lookup -- get the handler for a routing key
+    """
+
+    def __init__(self, exchange_type="topic", cache_size=4096):
+        """
+        Keyword arguments:
+        exchange_type -- one of 'direct', 'topic', 'fanout', 'headers'
+                         (default 'topic')
+        cache_size -- the most routing keys whose handlers are cached
+                      (default 4096)
+        """
+        self.exchange_type = exchange_type
+        self.bindings = []
+        self._cache_size = cache_size
+        self._compiled = []  # (matcher, handler) for each binding
+        self._cache = {}     # routing key -> handler or None
+        self._fanouts = {}   # tuple of handlers -> _Fanout
+
+    def add(self, binding_key, handler):
+        """
+        Add a binding. A routing key that matches several bindings is
+        passed to each of their handlers, in the order they were added.
+
+        Arguments:
+        binding_key -- the key the queue is bound with
+        handler -- the function called with each matching message
+        """
+        self.bindings.append((binding_key, handler))
+        self._compile()
+
+    def remove(self, binding_key):
+        """
+        Remove every handler added for a binding key.
+
+        Arguments:
+        binding_key -- the key the queue is bound with
+        """
+        self.bindings = [binding for binding in self.bindings if binding[0] != binding_key]
+        self._compile()
+
+    def lookup(self, routing_key):
+        """
+        Get the handler for a routing key.
+
+        Arguments:
+        routing_key -- the message's routing key
+
+        Returns:
+        the handler, or None if no binding matches
+        """
+        try:
+            return self._cache[routing_key]
+        except KeyError:
+            pass
+        handlers = tuple(dict.fromkeys(handler for matches, handler in self._compiled
+                                       if matches(routing_key)))
+        if not handlers:
+            handler = None
+        elif len(handlers) == 1:
+            handler = handlers[0]
+        else:
+            if handlers not in self._fanouts:
+                self._fanouts[handlers] = _Fanout(handlers)
+            handler = self._fanouts[handlers]
+        if len(self._cache) >= self._cache_size:
+            self._cache.clear()
+        self._cache[routing_key] = handler
+        return handler
+
+    def _compile(self):
+        """
+        Recompile the bindings and forget cached lookups after a change.
+        """
+        self._compiled = [(compile_binding(binding_key, self.exchange_type), handler)
+                          for binding_key, handler in self.bindings]
+        self._cache = {}
+        self._fanouts = {}
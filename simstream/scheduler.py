@@ -0,0 +1,406 @@
+"""
+Utilities for scheduling data collection.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Thread, Condition
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+
+class CollectionScheduler(object):
+    """Runs DataCollectors from a single timer heap on a bounded worker pool.
+
+    Every scheduled collector lives in one heap ordered by its next planned
+    run time. A single timer thread sleeps until the earliest deadline, pops
+    every collector due on that tick and hands them to the worker pool, so
+    the number of threads does not grow with the number of collectors.
+
+    Collectors with executor='process' are still dispatched from a worker
+    thread, but their callbacks run in a persistent ProcessPoolExecutor that
+    is created the first time one is needed.
+
+    Instance variables:
+    max_workers -- the maximum number of callbacks run concurrently
+    process_workers -- the number of worker processes for process-executed
+                       collectors
+    tick -- the resolution (in seconds) used to merge nearby wakeups
+
+    Public methods:
+    add -- schedule a collector
+    remove -- unschedule a collector
+    start -- start the timer thread and worker pool
+    stop -- stop the timer thread and wait for running callbacks
+    """
+
+    def __init__(self, max_workers=4, tick=0.01, process_workers=None):
+        """
+        Keyword arguments:
+        max_workers -- the maximum number of callbacks run concurrently
+                       (default 4)
+        tick -- the resolution (in seconds) of the timer; wakeups that land
+                on the same tick are handled together (default 0.01)
+        process_workers -- the number of worker processes; None uses the
+                           number of CPUs (default None)
+        """
+        self.max_workers = max_workers
+        self.process_workers = process_workers
+        self.tick = tick
+        self._heap = []
+        self._entries = {}
+        self._running = set()
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._thread = None
+        self._pool = None
+        self._process_pool = None
+        self._active = False
+
+    def add(self, collector):
+        """
+        Schedule a collector to run every collector.interval seconds.
+
+        Adding a collector that is already scheduled has no effect.
+
+        Arguments:
+        collector -- the DataCollector to schedule
+        """
+        with self._condition:
+            if collector.name in self._entries:
+                return
+            due = self._align(time.monotonic() + collector.interval)
+            entry = [due, next(self._counter), collector]
+            self._entries[collector.name] = entry
+            heapq.heappush(self._heap, entry)
+            self._condition.notify()
+
+    def remove(self, name):
+        """
+        Unschedule a collector. Its entry is dropped lazily from the heap.
+
+        Arguments:
+        name -- the name of the collector to unschedule
+        """
+        with self._condition:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                entry[-1] = None
+                self._condition.notify()
+
+    def start(self):
+        """
+        Start the timer thread and worker pool.
+        """
+        with self._condition:
+            if self._active:
+                return
+            self._active = True
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._thread = Thread(target=self._run, name="simstream-scheduler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stop scheduling new runs and wait for running callbacks to finish.
+        """
+        with self._condition:
+            if not self._active:
+                return
+            self._active = False
+            self._condition.notify()
+        self._thread.join()
+        self._pool.shutdown(wait=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=True)
+        self._thread = None
+        self._pool = None
+        self._process_pool = None
+
+    def _get_process_pool(self):
+        """
+        Get the shared process pool, creating it on first use.
+        """
+        with self._condition:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+            return self._process_pool
+
+    def _align(self, due):
+        """
+        Round a deadline up to the next tick so that nearby wakeups coincide.
+
+        Arguments:
+        due -- the deadline in time.monotonic() seconds
+        """
+        return math.ceil(due / self.tick) * self.tick
+
+    def _run(self):
+        """
+        Wait for the earliest deadline and dispatch every collector due on it.
+        """
+        with self._condition:
+            while self._active:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                if self._heap[0][0] > now:
+                    self._condition.wait(timeout=self._heap[0][0] - now)
+                    continue
+
+                # Drain everything due on this tick in one wakeup
+                while self._heap and self._heap[0][0] <= now:
+                    entry = heapq.heappop(self._heap)
+                    collector = entry[-1]
+                    if collector is None: # Removed while waiting
+                        continue
+                    self._dispatch(collector)
+                    entry[0] = self._next_due(entry[0], collector.interval, now)
+                    entry[1] = next(self._counter)
+                    heapq.heappush(self._heap, entry)
+
+    def _next_due(self, planned, interval, now):
+        """
+        Compute the next run time from the planned time instead of the
+        time the last run finished, skipping any runs that were missed.
+
+        Arguments:
+        planned -- the time the collector was planned to run
+        interval -- the collector's interval in seconds
+        now -- the current time
+        """
+        missed = int((now - planned) // interval) if interval > 0 else 0
+        return self._align(planned + (missed + 1) * max(interval, self.tick))
+
+    def _dispatch(self, collector):
+        """
+        Hand a collector to the worker pool unless its last run is still
+        in progress, including a timed-out run still holding a worker
+        process.
+
+        Arguments:
+        collector -- the DataCollector to run
+        """
+        if collector.name in self._running or collector.busy():
+            return
+        self._running.add(collector.name)
+        self._pool.submit(self._collect, collector)
+
+    def _collect(self, collector):
+        """
+        Run a collector on a worker thread.
+
+        Arguments:
+        collector -- the DataCollector to run
+        """
+        try:
+            if collector.executor == "process":
+                collector.run(process_pool=self._get_process_pool())
+            else:
+                collector.run()
+        finally:
+            with self._condition:
+                self._running.discard(collector.name)
+
+
+class AsyncCollectionScheduler(object):
+    """Runs DataCollectors as timers on a single asyncio event loop.
+
+    Coroutine callbacks are awaited on the loop. Synchronous callbacks are
+    handed to a bounded thread pool (or the process pool for collectors with
+    executor='process') through loop.run_in_executor, so I/O-bound
+    collectors cost a timer each rather than a thread each.
+
+    Instance variables:
+    max_workers -- the maximum number of synchronous callbacks run
+                   concurrently
+    process_workers -- the number of worker processes for process-executed
+                       collectors
+
+    Public methods:
+    add -- schedule a collector
+    remove -- unschedule a collector
+    run -- run the event loop in the calling thread until stopped
+    start -- run the event loop in a new thread
+    stop -- stop the event loop and wait for running callbacks
+    """
+
+    def __init__(self, max_workers=4, process_workers=None):
+        """
+        Keyword arguments:
+        max_workers -- the maximum number of synchronous callbacks run
+                       concurrently (default 4)
+        process_workers -- the number of worker processes; None uses the
+                           number of CPUs (default None)
+        """
+        self.max_workers = max_workers
+        self.process_workers = process_workers
+        self._collectors = {}
+        self._timers = {}
+        self._running = set()
+        self._loop = None
+        self._stopped = None
+        self._thread = None
+        self._pool = None
+        self._process_pool = None
+
+    def add(self, collector):
+        """
+        Schedule a collector to run every collector.interval seconds.
+
+        Adding a collector that is already scheduled has no effect.
+
+        Arguments:
+        collector -- the DataCollector to schedule
+        """
+        if collector.name in self._collectors:
+            return
+        self._collectors[collector.name] = collector
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule_first, collector)
+
+    def remove(self, name):
+        """
+        Unschedule a collector.
+
+        Arguments:
+        name -- the name of the collector to unschedule
+        """
+        if self._collectors.pop(name, None) is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel, name)
+
+    def run(self, main=None):
+        """
+        Run the event loop in the calling thread until stop() is called.
+
+        Keyword arguments:
+        main -- an optional coroutine to run alongside the collectors, e.g.
+                a reporter's flush loop (default None)
+        """
+        loop = asyncio.new_event_loop()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            loop.run_until_complete(self._main(loop, main))
+        finally:
+            self._loop = None
+            self._pool.shutdown(wait=True)
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=True)
+            self._pool = None
+            self._process_pool = None
+            loop.close()
+
+    def start(self):
+        """
+        Run the event loop in a new thread.
+        """
+        if self._thread is not None:
+            return
+        self._thread = Thread(target=self.run, name="simstream-scheduler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the event loop. Waits for the loop's thread if it was started
+        with start().
+        """
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    async def _main(self, loop, main):
+        """
+        Schedule every collector and wait to be stopped.
+
+        Arguments:
+        loop -- the running event loop
+        main -- an optional coroutine to run alongside the collectors
+        """
+        self._stopped = asyncio.Event()
+        self._loop = loop
+        for name in list(self._collectors):
+            self._schedule_first(self._collectors[name])
+
+        if main is not None:
+            loop.create_task(main)
+        await self._stopped.wait()
+
+        for name in list(self._timers):
+            self._cancel(name)
+        pending = [t for t in asyncio.all_tasks(loop) if t is not asyncio.current_task()]
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _schedule_first(self, collector):
+        """
+        Arm the first timer for a collector.
+
+        Arguments:
+        collector -- the DataCollector to schedule
+        """
+        if collector.name in self._timers:
+            return
+        self._schedule(collector, self._loop.time() + collector.interval)
+
+    def _schedule(self, collector, planned):
+        """
+        Arm a timer for a collector at a planned loop time.
+
+        Arguments:
+        collector -- the DataCollector to schedule
+        planned -- the loop time at which the collector should run
+        """
+        self._timers[collector.name] = self._loop.call_at(planned, self._fire, collector, planned)
+
+    def _cancel(self, name):
+        """
+        Cancel a collector's pending timer.
+
+        Arguments:
+        name -- the name of the collector
+        """
+        timer = self._timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _fire(self, collector, planned):
+        """
+        Start a collector's run and re-arm its timer from the planned time,
+        skipping any runs that were missed.
+
+        Arguments:
+        collector -- the DataCollector to run
+        planned -- the loop time the collector was planned to run
+        """
+        if self._collectors.get(collector.name) is not collector:
+            return
+        now = self._loop.time()
+        missed = int((now - planned) // collector.interval) if collector.interval > 0 else 0
+        self._schedule(collector, planned + (missed + 1) * collector.interval)
+
+        if collector.name in self._running or collector.busy():
+            return
+        self._running.add(collector.name)
+        process_pool = self._get_process_pool() if collector.executor == "process" else None
+        task = self._loop.create_task(collector.run_async(self._pool, process_pool))
+        task.add_done_callback(lambda t: self._running.discard(collector.name))
+
+    def _get_process_pool(self):
+        """
+        Get the shared process pool, creating it on first use.
+        """
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(max_workers=self.process_workers)
+        return self._process_pool
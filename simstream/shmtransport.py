@@ -0,0 +1,581 @@
+"""
+Utilities for streaming between processes on the same node through
+shared memory instead of a broker.
+
+A URL of the form shm://<name>?size=<bytes> names a ring buffer in a
+multiprocessing.shared_memory segment with one producer and one
+consumer. Messages keep their routing key, content type and encoding,
+so collectors and handlers work unchanged; DataReporter selects this
+transport for shm:// URLs, and consumer_for_url does the same for
+consumers. Bodies are 8-byte aligned within the segment, so the binary
+codec decodes arrays as views over shared memory without copying them.
+
+The ring is lock-free. The producer only ever advances the write index
+and the consumer the read index, each stored on its own cache line. A
+consumer with nothing to read sleeps on a named pipe that the producer
+writes a byte to after publishing.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import errno
+import os
+import select
+import struct
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError: # Python < 3.8
+    shared_memory = None
+
+from . import chunking
+from .pikaasyncconsumer import _HANDLED, PikaAsyncConsumer, _handle_message
+from .pikaproducer import PikaProducer
+from .routing import RoutingTable
+
+
+SCHEME = "shm"
+FULL_POLICIES = ("drop_newest", "block")
+
+_MAGIC = b"SSRING01"
+_INDEX = struct.Struct("<Q")
+_WRITE_OFFSET = 0       # Producer's write index, on its own cache line
+_READ_OFFSET = 64       # Consumer's read index, on its own cache line
+_WAITING_OFFSET = 128   # Set while the consumer sleeps on the wakeup pipe
+_CAPACITY_OFFSET = 136
+_MAGIC_OFFSET = 144     # Written last by the creator, once the header is valid
+_DATA_OFFSET = 192
+_SIZES = struct.Struct("<II")     # record size, body length
+_RECORD = struct.Struct("<IIHBB") # _SIZES, then key, type and encoding lengths
+_WRAP = 0xFFFFFFFF                # Body length marking the unused end of the ring
+
+_created = set() # Names of the segments this process created
+
+
+def is_shm_url(url):
+    """
+    Check whether a URL selects the shared-memory transport.
+
+    Arguments:
+    url -- a broker or shm:// URL
+    """
+    return urlparse(url).scheme == SCHEME
+
+
+def consumer_for_url(url, exchange_name, queue_name, message_handler, **kwargs):
+    """
+    Create the consumer for a URL: a SharedMemoryConsumer for shm:// URLs
+    and a PikaAsyncConsumer otherwise.
+
+    Arguments:
+    url -- a broker or shm:// URL
+    exchange_name -- name of RabbitMQ exchange to join
+    queue_name -- name of RabbitMQ queue to join
+    message_handler -- the function called with each message
+
+    Keyword arguments are passed to the consumer.
+    """
+    if is_shm_url(url):
+        return SharedMemoryConsumer(url, exchange_name, queue_name, message_handler, **kwargs)
+    return PikaAsyncConsumer(url, exchange_name, queue_name, message_handler, **kwargs)
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class SharedMemoryRing(object):
+    """A single-producer, single-consumer ring of messages in shared memory.
+
+    Whichever side opens the ring first creates the segment and unlinks it
+    when closed. Records are stored contiguously: one that does not fit
+    before the end of the ring is written at its start, and the space
+    skipped is marked as a wrap record.
+
+    The indices are published with plain 8-byte stores; this relies on the
+    stores being seen in program order, as on x86. The consumer also
+    wakes every poll interval, so a missed wakeup only adds latency.
+
+    Instance variables:
+    name -- the name of the shared memory segment
+    capacity -- the size in bytes of the ring's data area
+
+    Public methods:
+    put -- append a message (producer)
+    poll -- handle every message that has been appended (consumer)
+    wait -- sleep until a message is appended or a timeout passes
+            (consumer)
+    wake -- wake a sleeping consumer
+    close -- detach from the segment
+    """
+
+    def __init__(self, name, size=64 * 2**20):
+        """
+        Open a ring, creating it if it does not exist.
+
+        Arguments:
+        name -- the name of the shared memory segment
+
+        Keyword arguments:
+        size -- the size in bytes of the data area when creating the ring,
+                rounded down to a power of two (default 64 MiB)
+
+        Raises:
+        RuntimeError if multiprocessing.shared_memory is unavailable
+        """
+        if shared_memory is None:
+            raise RuntimeError("The shared memory transport requires Python >= 3.8")
+        self.name = name
+        capacity = 1 << (max(size, 4096).bit_length() - 1)
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True,
+                                                   size=_DATA_OFFSET + capacity)
+            self._owner = True
+            _created.add(name)
+            self._buf = self._shm.buf
+            _INDEX.pack_into(self._buf, _CAPACITY_OFFSET, capacity)
+            self._buf[_MAGIC_OFFSET:_MAGIC_OFFSET + len(_MAGIC)] = _MAGIC
+        except FileExistsError:
+            self._shm = self._attach(name)
+            self._owner = False
+            self._buf = self._shm.buf
+            deadline = time.monotonic() + 5
+            while bytes(self._buf[_MAGIC_OFFSET:_MAGIC_OFFSET + len(_MAGIC)]) != _MAGIC:
+                if time.monotonic() > deadline:
+                    raise RuntimeError("Shared memory segment %s is not a ring" % (name))
+                time.sleep(0.001)
+        self.capacity = _INDEX.unpack_from(self._buf, _CAPACITY_OFFSET)[0]
+        self._mask = self.capacity - 1
+        self._write = _INDEX.unpack_from(self._buf, _WRITE_OFFSET)[0]
+        self._read = _INDEX.unpack_from(self._buf, _READ_OFFSET)[0]
+
+        self._pipe_path = os.path.join(tempfile.gettempdir(), "simstream-%s.wake" % (name))
+        self._reader = None    # The consumer's end of the wakeup pipe
+        self._keepalive = None # A write end held by the consumer
+        self._writer = None    # The producer's end, opened once a consumer exists
+
+    @staticmethod
+    def _attach(name):
+        """
+        Attach to an existing segment without letting this process's
+        resource tracker unlink it at exit.
+
+        Arguments:
+        name -- the name of the shared memory segment
+        """
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name, track=False)
+        segment = shared_memory.SharedMemory(name)
+        if name not in _created: # Otherwise the creator's registration is shared
+            resource_tracker.unregister(segment._name, "shared_memory")
+        return segment
+
+    def put(self, routing_key, body, content_type=None, content_encoding=None):
+        """
+        Append a message if there is room for it.
+
+        Arguments:
+        routing_key -- the message's routing key
+        body -- the message body
+
+        Keyword arguments:
+        content_type -- the message's content_type (default None)
+        content_encoding -- the message's content_encoding (default None)
+
+        Returns:
+        True if the message was appended, False if the ring is full
+
+        Raises:
+        ValueError if the message is larger than the ring
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        key, ctype, encoding = (value.encode() if value else b""
+                                for value in (routing_key, content_type, content_encoding))
+        body_offset = _align(_RECORD.size + len(key) + len(ctype) + len(encoding))
+        size = _align(body_offset + len(body))
+        if size > self.capacity:
+            raise ValueError("Message of %d bytes does not fit in the ring" % (len(body)))
+
+        position = self._write & self._mask
+        tail = self.capacity - position
+        needed = size + (tail if tail < size else 0)
+        read = _INDEX.unpack_from(self._buf, _READ_OFFSET)[0]
+        if self.capacity - (self._write - read) < needed:
+            return False
+
+        start = _DATA_OFFSET + position
+        if tail < size: # Skip to the start of the ring
+            _SIZES.pack_into(self._buf, start, tail, _WRAP)
+            self._write += tail
+            start = _DATA_OFFSET
+        _RECORD.pack_into(self._buf, start, size, len(body), len(key), len(ctype), len(encoding))
+        fields = key + ctype + encoding
+        self._buf[start + _RECORD.size:start + _RECORD.size + len(fields)] = fields
+        self._buf[start + body_offset:start + body_offset + len(body)] = body
+        self._write += size
+        _INDEX.pack_into(self._buf, _WRITE_OFFSET, self._write)
+        if self._buf[_WAITING_OFFSET]:
+            self.wake()
+        return True
+
+    def poll(self, handler, limit=None):
+        """
+        Call handler with each message appended since the last poll. The
+        body is a memoryview over shared memory that is only valid until
+        handler returns; anything kept must be copied.
+
+        Arguments:
+        handler -- a function taking a routing key, body, content type and
+                   content encoding
+
+        Keyword arguments:
+        limit -- the most messages to handle, or None for all (default None)
+
+        Returns:
+        the number of messages handled
+        """
+        handled = 0
+        write = _INDEX.unpack_from(self._buf, _WRITE_OFFSET)[0]
+        while self._read < write and (limit is None or handled < limit):
+            start = _DATA_OFFSET + (self._read & self._mask)
+            size, body_length = _SIZES.unpack_from(self._buf, start)
+            if body_length != _WRAP:
+                unused_sizes, unused_length, key_length, ctype_length, encoding_length = \
+                    _RECORD.unpack_from(self._buf, start)
+                position = start + _RECORD.size
+                fields = []
+                for length in (key_length, ctype_length, encoding_length):
+                    fields.append(bytes(self._buf[position:position + length]).decode() or None)
+                    position += length
+                body_start = start + _align(_RECORD.size + key_length + ctype_length +
+                                            encoding_length)
+                body = self._buf[body_start:body_start + body_length]
+                try:
+                    handler(fields[0] or "", body, fields[1], fields[2])
+                finally:
+                    body.release()
+                handled += 1
+            self._read += size
+            _INDEX.pack_into(self._buf, _READ_OFFSET, self._read)
+        return handled
+
+    def wait(self, timeout):
+        """
+        Sleep until the producer appends a message or timeout seconds pass.
+
+        Arguments:
+        timeout -- the most seconds to sleep
+        """
+        if self._reader is None:
+            self._open_reader()
+        self._buf[_WAITING_OFFSET] = 1
+        try:
+            if _INDEX.unpack_from(self._buf, _WRITE_OFFSET)[0] != self._read:
+                return
+            select.select([self._reader], [], [], timeout)
+            try:
+                while os.read(self._reader, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        finally:
+            self._buf[_WAITING_OFFSET] = 0
+
+    def wake(self):
+        """
+        Wake the consumer if it is sleeping in wait().
+        """
+        if self._writer is None:
+            try:
+                self._writer = os.open(self._pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError: # No consumer has opened the pipe yet
+                return
+        try:
+            os.write(self._writer, b"\0")
+        except BlockingIOError: # The pipe is full, so the consumer is awake
+            pass
+        except OSError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            os.close(self._writer)
+            self._writer = None
+
+    def close(self):
+        """
+        Detach from the segment, unlinking it if this side created it.
+        """
+        for fd in (self._reader, self._keepalive, self._writer):
+            if fd is not None:
+                os.close(fd)
+        self._reader = self._keepalive = self._writer = None
+        self._buf = None
+        try:
+            self._shm.close()
+        except BufferError: # A handler kept a view; the mapping lasts until exit
+            pass
+        if self._owner:
+            self._shm.unlink()
+            _created.discard(self.name)
+
+    def _open_reader(self):
+        """
+        Create and open the wakeup pipe. The consumer also holds a write end
+        so that the pipe never reports end of file while no producer has it
+        open.
+        """
+        try:
+            os.mkfifo(self._pipe_path)
+        except FileExistsError:
+            pass
+        self._reader = os.open(self._pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+        self._keepalive = os.open(self._pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+
+
+def _parse_url(url):
+    """
+    Get the segment name and size from a shm:// URL.
+
+    Arguments:
+    url -- a URL of the form shm://<name>?size=<bytes>
+    """
+    parsed = urlparse(url)
+    name = parsed.netloc or parsed.path.strip("/")
+    if not name:
+        raise ValueError("No shared memory name in %s" % (url))
+    size = parse_qs(parsed.query).get("size")
+    return name, int(size[0]) if size else 64 * 2**20
+
+
+class SharedMemoryProducer(PikaProducer):
+    """Publishes to a shared-memory ring instead of a broker.
+
+    The producer is created with the same arguments as PikaProducer and
+    serializes, compresses and chunks messages the same way. Options that
+    only apply to a broker (asynchronous publishing, confirms, pools and
+    spools) are not used.
+    """
+
+    def __init__(self, url, exchange, exchange_type="direct", routing_keys=[], codec="json",
+                 compression=None, compression_threshold=1024, compression_ratio=0.9,
+                 full_policy="drop_newest", block_timeout=None, poll_interval=0.001,
+                 chunk_size=None):
+        """
+        Arguments:
+        url -- a URL of the form shm://<name>?size=<bytes>
+        exchange -- the name of the exchange; kept for compatibility
+
+        Keyword arguments:
+        exchange_type, routing_keys, codec, compression,
+        compression_threshold, compression_ratio and chunk_size are as for
+        PikaProducer.
+        full_policy -- what to do when the ring is full: 'drop_newest' or
+                       'block' (default 'drop_newest')
+        block_timeout -- with 'block', the most seconds to wait for room
+                         before dropping the message, or None to wait
+                         forever (default None)
+        poll_interval -- with 'block', seconds between checks for room
+                         (default 0.001)
+
+        Raises:
+        ValueError if the URL has no name or full_policy is unknown
+        """
+        if full_policy not in FULL_POLICIES:
+            raise ValueError("Unknown full policy %s" % (full_policy))
+        super(SharedMemoryProducer, self).__init__(
+            url, exchange, exchange_type=exchange_type, routing_keys=routing_keys,
+            codec=codec, compression=compression,
+            compression_threshold=compression_threshold,
+            compression_ratio=compression_ratio, chunk_size=chunk_size)
+        self._name, self._size = _parse_url(url)
+        self.full_policy = full_policy
+        self.block_timeout = block_timeout
+        self.poll_interval = poll_interval
+        self.ring = None
+
+    def start(self):
+        """
+        Open the ring if it is not open.
+        """
+        if self.ring is None:
+            self.ring = SharedMemoryRing(self._name, self._size)
+
+    def send_data(self, data, routing_keys=None):
+        """
+        Append the data to the ring once per routing key, dropping it or
+        waiting for room if the ring is full.
+
+        Arguments:
+        data -- the message to send
+
+        Keyword arguments:
+        routing_keys -- the routing keys to send to instead of the
+                        producer's own (default None)
+        """
+        self.start()
+        if routing_keys is None:
+            routing_keys = self._routing_keys
+        for key in routing_keys:
+            for body, properties in self._prepare(data):
+                if not self._put(key, body, properties):
+                    self.stats["dropped"] += 1
+
+    def replay(self, limit=None):
+        """
+        Nothing is ever spooled, so there is nothing to replay.
+        """
+        return 0
+
+    def shutdown(self):
+        """
+        Close the ring.
+        """
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def _put(self, routing_key, body, properties):
+        """
+        Append one message, applying the full policy.
+
+        Returns:
+        True if the message was appended
+        """
+        deadline = None
+        if self.block_timeout is not None:
+            deadline = time.monotonic() + self.block_timeout
+        while not self.ring.put(routing_key, body, properties.content_type,
+                                properties.content_encoding):
+            if self.full_policy != "block" or (deadline is not None and
+                                               time.monotonic() >= deadline):
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+
+class SharedMemoryConsumer(object):
+    """Consumes messages from a shared-memory ring on the calling thread.
+
+    The consumer takes the same leading arguments as PikaAsyncConsumer.
+    The ring plays the part of the queue: messages are routed to handlers
+    by matching their routing keys against the bindings, and messages that
+    match no binding are skipped. Handlers run inline.
+
+    Without decode, handlers receive a copy of each body as bytes, as from
+    a broker. With decode, messages are decoded straight from shared
+    memory, so arrays sent with the binary codec arrive as views over the
+    ring without being copied. Those views are only valid until the
+    handler returns; anything kept must be copied.
+    """
+
+    def __init__(self, url, exchange_name, queue_name, message_handler,
+                 exchange_type="direct", routing_key="#", decode=False, expand_batches=False,
+                 poll_interval=0.1, chunk_timeout=30.0, chunk_memory=64 * 2**20,
+                 **broker_options):
+        """
+        Arguments:
+        url -- a URL of the form shm://<name>?size=<bytes>
+        exchange_name -- the name of the exchange; kept for compatibility
+        queue_name -- the name of the queue; kept for compatibility
+        message_handler -- the function called with each matching message
+
+        Keyword arguments:
+        exchange_type, routing_key, decode, expand_batches, chunk_timeout
+        and chunk_memory are as for PikaAsyncConsumer.
+        poll_interval -- the most seconds between checks of the ring when
+                         no wakeup arrives (default 0.1)
+
+        Other PikaAsyncConsumer options apply only to a broker and are
+        ignored.
+
+        Raises:
+        ValueError if the URL has no name
+        """
+        self._name, self._size = _parse_url(url)
+        self._routes = RoutingTable(exchange_type)
+        self._routes.add(routing_key, message_handler)
+        self._decode = decode or expand_batches
+        self._expand_batches = expand_batches
+        self._poll_interval = poll_interval
+        self.reassembler = chunking.Reassembler(timeout=chunk_timeout, max_bytes=chunk_memory)
+        self.stats = {"handled": 0, "skipped": 0, "failed": 0}
+        self.ring = None
+        self._shut_down = False
+
+    def add_binding(self, queue_name, binding_key, message_handler):
+        """
+        Handle messages whose routing keys match another binding key.
+
+        Arguments:
+        queue_name -- the name of the queue; kept for compatibility
+        binding_key -- the routing key or topic pattern to match
+        message_handler -- the function called with each matching message
+        """
+        self._routes.add(binding_key, message_handler)
+
+    def remove_binding(self, queue_name, binding_key):
+        """
+        Stop handling messages for a binding key.
+
+        Arguments:
+        queue_name -- the name of the queue; kept for compatibility
+        binding_key -- the routing key or topic pattern to forget
+        """
+        self._routes.remove(binding_key)
+
+    def start(self):
+        """
+        Open the ring and handle messages until stop() is called.
+        """
+        self._shut_down = False
+        if self.ring is None:
+            self.ring = SharedMemoryRing(self._name, self._size)
+        try:
+            while not self._shut_down:
+                if not self.ring.poll(self._process_message):
+                    self.ring.wait(self._poll_interval)
+        finally:
+            self.ring.close()
+            self.ring = None
+
+    def stop(self):
+        """
+        Stop consuming; start() returns after its current message.
+        """
+        self._shut_down = True
+        if self.ring is not None:
+            self.ring.wake()
+
+    def _process_message(self, routing_key, body, content_type, content_encoding):
+        """
+        Route one message to its handler.
+
+        Arguments:
+        routing_key -- the message's routing key
+        body -- a memoryview of the message body in shared memory
+        content_type -- the message's content_type
+        content_encoding -- the message's content_encoding
+        """
+        handler = self._routes.lookup(routing_key)
+        if handler is None:
+            self.stats["skipped"] += 1
+            return
+        if content_type == chunking.CONTENT_TYPE:
+            try:
+                message = self.reassembler.add(body)
+            except ValueError as e:
+                print("[ERROR] Could not read chunk: %s" % (e))
+                self.stats["failed"] += 1
+                return
+            if message is None:
+                return
+            body, content_type, content_encoding = message
+        if not self._decode: # Handlers expect bytes, as from a broker
+            body = bytes(body)
+        outcome = _handle_message(handler, body, content_type, content_encoding,
+                                  self._decode, self._expand_batches)
+        self.stats["handled" if outcome == _HANDLED else "failed"] += 1
@@ -0,0 +1,309 @@
+"""
+Utilities for spooling messages to disk while the broker is unreachable.
+
+A spool is a directory of fixed-size, memory-mapped segment files that
+form one append-only log. Each record is stored as its length and CRC-32
+followed by the routing key, content type, content encoding and body, so
+a torn write at the end of a segment is detected and ignored on reopen.
+The replay position is kept in a small cursor file. Replay is
+at-least-once: records replayed since the cursor was last saved may be
+replayed again after a crash.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+import mmap
+import os
+import struct
+from threading import Lock
+import zlib
+
+
+_RECORD_HEADER = struct.Struct("<II")  # payload length, CRC-32 of the payload
+_FIELDS_HEADER = struct.Struct("<HBB") # routing key, content type and encoding lengths
+_CURSOR = struct.Struct("<QQ")         # segment number, offset
+_SEGMENT_SUFFIX = ".seg"
+
+
+class Spool(object):
+    """An on-disk, size-capped log of messages awaiting publication.
+
+    Instance variables:
+    directory -- the directory holding the segment files
+    segment_size -- the size in bytes of each segment file
+    max_bytes -- the largest total size of the segment files; the oldest
+                 segment is evicted when it is exceeded
+    stats -- a dict of counters: 'spooled', 'replayed' and 'evicted'
+
+    Public methods:
+    append -- add a message to the end of the log
+    replay -- publish messages from the start of the log
+    close -- sync the log to disk and release its files
+    """
+
+    def __init__(self, directory, segment_size=16 * 2**20, max_bytes=256 * 2**20):
+        """
+        Open a spool, recovering any messages left by a previous run.
+
+        Arguments:
+        directory -- the directory to keep the segment files in; it is
+                     created if needed
+
+        Keyword arguments:
+        segment_size -- the size in bytes of each segment file
+                        (default 16 MiB)
+        max_bytes -- the largest total size of the segment files
+                     (default 256 MiB)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.stats = {"spooled": 0, "replayed": 0, "evicted": 0}
+        self._lock = Lock()
+        self._maps = {}      # segment number -> (file, mmap)
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)])
+                                for name in os.listdir(directory)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._sizes = {number: os.path.getsize(self._path(number)) for number in self._segments}
+        self._read_segment, self._read_offset = self._load_cursor()
+        for number in [number for number in self._segments if number < self._read_segment]:
+            self._remove(number)
+
+        self._count = 0
+        self._write_offset = 0
+        for number in self._segments:
+            offset = self._read_offset if number == self._read_segment else 0
+            for offset in self._offsets(self._map(number), offset):
+                self._count += 1
+            self._write_offset = offset
+
+    def __len__(self):
+        return self._count
+
+    def append(self, routing_key, body, content_type=None, content_encoding=None):
+        """
+        Add a message to the end of the log, evicting the oldest segment if
+        the spool is over its size cap.
+
+        Arguments:
+        routing_key -- the routing key to publish the message to
+        body -- the message body
+
+        Keyword arguments:
+        content_type -- the message's content_type (default None)
+        content_encoding -- the message's content_encoding (default None)
+        """
+        if isinstance(body, str):
+            body = body.encode()
+        key, ctype, encoding = (value.encode() if value else b""
+                                for value in (routing_key, content_type, content_encoding))
+        payload = b"".join((_FIELDS_HEADER.pack(len(key), len(ctype), len(encoding)),
+                            key, ctype, encoding, body))
+        record = _RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._lock:
+            if (not self._segments or
+                    self._write_offset + len(record) > self._sizes[self._segments[-1]]):
+                self._rotate(len(record))
+            unused_file, segment = self._map(self._segments[-1])
+            segment[self._write_offset:self._write_offset + len(record)] = record
+            self._write_offset += len(record)
+            self._count += 1
+            self.stats["spooled"] += 1
+            self._evict()
+
+    def replay(self, publish, limit=None):
+        """
+        Publish messages from the start of the log, oldest first. A message
+        is removed from the log only once publish returns; if publish
+        raises, replay stops and the exception propagates.
+
+        Arguments:
+        publish -- a function taking a routing key, body, content type and
+                   content encoding
+
+        Keyword arguments:
+        limit -- the most messages to replay, or None for all (default None)
+
+        Returns:
+        the number of messages replayed
+        """
+        replayed = 0
+        with self._lock:
+            try:
+                while self._count > 0 and (limit is None or replayed < limit):
+                    segment = self._map(self._read_segment)
+                    record = self._read(segment, self._read_offset)
+                    if record is None: # End of a finished segment
+                        if self._read_segment == self._segments[-1]:
+                            break
+                        self._remove(self._read_segment)
+                        self._read_segment, self._read_offset = self._segments[0], 0
+                        continue
+                    next_offset, routing_key, body, content_type, content_encoding = record
+                    publish(routing_key, body, content_type, content_encoding)
+                    self._read_offset = next_offset
+                    self._count -= 1
+                    replayed += 1
+                if self._count == 0 and self._segments:
+                    for number in self._segments[:-1]:
+                        self._remove(number)
+                    self._read_segment, self._read_offset = self._segments[0], self._write_offset
+            finally:
+                self.stats["replayed"] += replayed
+                if replayed:
+                    self._save_cursor()
+        return replayed
+
+    def close(self):
+        """
+        Sync the log to disk and release its files.
+        """
+        with self._lock:
+            self._save_cursor()
+            for number in list(self._maps):
+                self._unmap(number)
+
+    def _path(self, number):
+        return os.path.join(self.directory, "%016d%s" % (number, _SEGMENT_SUFFIX))
+
+    def _map(self, number):
+        """
+        Get the (file, mmap) pair for a segment, mapping it if necessary.
+
+        Arguments:
+        number -- the segment number
+        """
+        if number not in self._maps:
+            segment_file = open(self._path(number), "r+b")
+            self._maps[number] = (segment_file, mmap.mmap(segment_file.fileno(), 0))
+        return self._maps[number]
+
+    def _unmap(self, number):
+        """
+        Flush and close a segment's mapping.
+
+        Arguments:
+        number -- the segment number
+        """
+        segment_file, segment = self._maps.pop(number)
+        segment.flush()
+        segment.close()
+        segment_file.close()
+
+    def _offsets(self, mapped, offset):
+        """
+        Yield the end offset of each intact record from offset onward.
+
+        Arguments:
+        mapped -- a (file, mmap) pair
+        offset -- the offset of the first record
+        """
+        while True:
+            record = self._read(mapped, offset)
+            if record is None:
+                return
+            offset = record[0]
+            yield offset
+
+    def _read(self, mapped, offset):
+        """
+        Read the record at offset.
+
+        Arguments:
+        mapped -- a (file, mmap) pair
+        offset -- the offset of the record
+
+        Returns:
+        a tuple of the next record's offset, the routing key, body, content
+        type and content encoding, or None at the end of the segment
+        """
+        unused_file, segment = mapped
+        if offset + _RECORD_HEADER.size > len(segment):
+            return None
+        length, crc = _RECORD_HEADER.unpack_from(segment, offset)
+        start = offset + _RECORD_HEADER.size
+        end = start + length
+        if length < _FIELDS_HEADER.size or end > len(segment):
+            return None
+        payload = segment[start:end]
+        if zlib.crc32(payload) != crc:
+            return None
+
+        key_length, ctype_length, encoding_length = _FIELDS_HEADER.unpack_from(payload)
+        position = _FIELDS_HEADER.size
+        fields = []
+        for length in (key_length, ctype_length, encoding_length):
+            fields.append(payload[position:position + length].decode() or None)
+            position += length
+        return end, fields[0] or "", payload[position:], fields[1], fields[2]
+
+    def _rotate(self, record_size):
+        """
+        Start a new segment large enough for a record.
+
+        Arguments:
+        record_size -- the size in bytes of the record to be written
+        """
+        if self._segments:
+            self._maps[self._segments[-1]][1].flush()
+        number = self._segments[-1] + 1 if self._segments else 0
+        size = max(self.segment_size, record_size)
+        with open(self._path(number), "wb") as segment_file:
+            segment_file.truncate(size)
+        self._segments.append(number)
+        self._sizes[number] = size
+        self._write_offset = 0
+        if len(self._segments) == 1:
+            self._read_segment, self._read_offset = number, 0
+
+    def _evict(self):
+        """
+        Remove the oldest segments until the spool fits within max_bytes,
+        always keeping the segment being written.
+        """
+        while sum(self._sizes.values()) > self.max_bytes and len(self._segments) > 1:
+            number = self._segments[0]
+            offset = self._read_offset if number == self._read_segment else 0
+            evicted = sum(1 for unused_offset in self._offsets(self._map(number), offset))
+            self._count -= evicted
+            self.stats["evicted"] += evicted
+            self._remove(number)
+            if number == self._read_segment:
+                self._read_segment, self._read_offset = self._segments[0], 0
+
+    def _remove(self, number):
+        """
+        Delete a segment file.
+
+        Arguments:
+        number -- the segment number
+        """
+        if number in self._maps:
+            self._unmap(number)
+        os.remove(self._path(number))
+        self._segments.remove(number)
+        del self._sizes[number]
+
+    def _load_cursor(self):
+        """
+        Read the saved replay position, defaulting to the first segment.
+        """
+        try:
+            with open(os.path.join(self.directory, "cursor"), "rb") as cursor_file:
+                number, offset = _CURSOR.unpack(cursor_file.read(_CURSOR.size))
+        except (OSError, struct.error):
+            number, offset = (self._segments[0] if self._segments else 0), 0
+        if number not in self._segments:
+            number, offset = (self._segments[0] if self._segments else 0), 0
+        return number, offset
+
+    def _save_cursor(self):
+        """
+        Atomically save the replay position.
+        """
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "wb") as cursor_file:
+            cursor_file.write(_CURSOR.pack(self._read_segment, self._read_offset))
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,377 @@
+"""
+Utilities for compressing numeric time series.
+
+Implements the delta-of-delta and XOR float encodings described for
+Facebook's Gorilla time series database. Integer columns (e.g. timestamps
+in integer milliseconds, RSS in kilobytes) are stored as delta-of-deltas,
+which cost one bit per point at a regular interval. Float columns are
+stored as the XOR of consecutive values, which costs one bit per repeated
+value and only the changed bits otherwise.
+
+Author: Jeff Kinnison (jkinniso@nd.edu)
+"""
+
+from array import array
+import numbers
+import struct
+
+from . import batch
+from .codec import BinaryCodec, register_codec
+
+
+_BLOCK_HEADER = struct.Struct("<IB")
+_DOUBLE = struct.Struct("<d")
+_UINT64 = struct.Struct("<Q")
+_MASK64 = (1 << 64) - 1
+
+# Delta-of-delta buckets: (prefix, prefix bits, value bits)
+_DOD_BUCKETS = ((0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12))
+
+# Integers beyond this cannot overflow a 64-bit delta-of-delta
+_INT_LIMIT = 1 << 61
+
+
+class BitWriter(object):
+    """Packs variable-width values into bytes, most significant bit first."""
+
+    def __init__(self):
+        self._out = bytearray()
+        self._acc = 0
+        self._nbits = 0
+
+    def write(self, value, nbits):
+        """
+        Append the low nbits bits of value.
+
+        Arguments:
+        value -- a non-negative integer
+        nbits -- the number of bits to write
+        """
+        self._acc = (self._acc << nbits) | value
+        self._nbits += nbits
+        if self._nbits >= 64:
+            spare = self._nbits % 8
+            self._out += (self._acc >> spare).to_bytes(self._nbits // 8, "big")
+            self._acc &= (1 << spare) - 1
+            self._nbits = spare
+
+    def getvalue(self):
+        """
+        Get the written bits, zero-padded to a whole byte.
+        """
+        padding = -self._nbits % 8
+        tail = (self._acc << padding).to_bytes((self._nbits + padding) // 8, "big")
+        return bytes(self._out) + tail
+
+
+class BitReader(object):
+    """Reads variable-width values written by BitWriter."""
+
+    def __init__(self, data, offset=0):
+        """
+        Arguments:
+        data -- the bytes to read
+
+        Keyword arguments:
+        offset -- the byte offset at which the bits start (default 0)
+        """
+        self._data = data
+        self._pos = offset * 8
+
+    def read(self, nbits):
+        """
+        Read the next nbits bits as a non-negative integer.
+
+        Arguments:
+        nbits -- the number of bits to read
+        """
+        start = self._pos >> 3
+        end = (self._pos + nbits + 7) >> 3
+        if end > len(self._data):
+            raise ValueError("Time series block is truncated")
+        chunk = int.from_bytes(self._data[start:end], "big")
+        spare = end * 8 - self._pos - nbits
+        self._pos += nbits
+        return (chunk >> spare) & ((1 << nbits) - 1)
+
+
+def _column_kind(column):
+    """
+    Get the encoding for a column: b'i' for integers, b'f' for floats, or
+    None if the column cannot be encoded.
+
+    Arguments:
+    column -- an array.array or a list of values
+    """
+    if isinstance(column, array):
+        if column.typecode in "fd":
+            return b"f"
+        if column.typecode == "u":
+            return None
+        return b"i" if all(-_INT_LIMIT < value < _INT_LIMIT for value in column) else None
+    kind = b"i"
+    for value in column:
+        if isinstance(value, bool) or not isinstance(value, numbers.Real):
+            return None
+        if not isinstance(value, numbers.Integral):
+            kind = b"f"
+        elif not -_INT_LIMIT < value < _INT_LIMIT:
+            return None
+    return kind
+
+
+def _write_ints(writer, values):
+    """
+    Write integers as the first value followed by delta-of-deltas.
+
+    Arguments:
+    writer -- the BitWriter
+    values -- the integers to write
+    """
+    previous = int(values[0])
+    delta = 0
+    writer.write(previous & _MASK64, 64)
+    for value in values[1:]:
+        value = int(value)
+        dod = (value - previous) - delta
+        delta = value - previous
+        previous = value
+        if dod == 0:
+            writer.write(0, 1)
+            continue
+        for prefix, prefix_bits, value_bits in _DOD_BUCKETS:
+            bias = (1 << (value_bits - 1)) - 1
+            if -bias <= dod <= bias + 1:
+                writer.write(prefix, prefix_bits)
+                writer.write(dod + bias, value_bits)
+                break
+        else:
+            writer.write(0b1111, 4)
+            writer.write(dod & _MASK64, 64)
+
+
+def _read_ints(reader, count):
+    """
+    Read integers written by _write_ints.
+
+    Arguments:
+    reader -- the BitReader
+    count -- the number of integers to read
+    """
+    values = array("q", [0]) * count
+    previous = _signed(reader.read(64))
+    values[0] = previous
+    delta = 0
+    for i in range(1, count):
+        if reader.read(1) == 0:
+            dod = 0
+        else:
+            # Each further 1 bit moves to the next, wider bucket
+            for unused_prefix, unused_prefix_bits, value_bits in _DOD_BUCKETS:
+                if reader.read(1) == 0:
+                    dod = reader.read(value_bits) - ((1 << (value_bits - 1)) - 1)
+                    break
+            else:
+                dod = _signed(reader.read(64))
+        delta += dod
+        previous += delta
+        values[i] = previous
+    return values
+
+
+def _signed(value):
+    """
+    Interpret a 64-bit unsigned integer as two's complement.
+
+    Arguments:
+    value -- the unsigned integer
+    """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def _write_floats(writer, values):
+    """
+    Write floats as the first value followed by XORs with the previous
+    value.
+
+    Arguments:
+    writer -- the BitWriter
+    values -- the floats to write
+    """
+    previous = _bits(values[0])
+    writer.write(previous, 64)
+    leading, trailing = -1, -1
+    for value in values[1:]:
+        bits = _bits(value)
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        new_leading = min(64 - xor.bit_length(), 31)
+        new_trailing = (xor & -xor).bit_length() - 1
+        if leading >= 0 and new_leading >= leading and new_trailing >= trailing:
+            # Reuse the previous window of meaningful bits
+            writer.write(0b10, 2)
+            writer.write(xor >> trailing, 64 - leading - trailing)
+        else:
+            leading, trailing = new_leading, new_trailing
+            significant = 64 - leading - trailing
+            writer.write(0b11, 2)
+            writer.write(leading, 5)
+            writer.write(significant & 63, 6)
+            writer.write(xor >> trailing, significant)
+
+
+def _read_floats(reader, count):
+    """
+    Read floats written by _write_floats.
+
+    Arguments:
+    reader -- the BitReader
+    count -- the number of floats to read
+    """
+    values = array("d", [0.0]) * count
+    previous = reader.read(64)
+    values[0] = _float(previous)
+    leading, trailing = 0, 0
+    for i in range(1, count):
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                significant = reader.read(6) or 64
+                trailing = 64 - leading - significant
+            previous ^= reader.read(64 - leading - trailing) << trailing
+        values[i] = _float(previous)
+    return values
+
+
+def _bits(value):
+    return _UINT64.unpack(_DOUBLE.pack(value))[0]
+
+
+def _float(bits):
+    return _DOUBLE.unpack(_UINT64.pack(bits))[0]
+
+
+def encode_block(columns):
+    """
+    Compress equal-length numeric columns into one block.
+
+    Arguments:
+    columns -- a list of array.array instances or lists of numbers
+
+    Returns:
+    the encoded block as bytes
+
+    Raises:
+    ValueError if a column is not numeric or the lengths differ
+    """
+    count = len(columns[0]) if columns else 0
+    kinds = []
+    for column in columns:
+        kind = _column_kind(column)
+        if kind is None or len(column) != count:
+            raise ValueError("Time series columns must be numeric and of equal length")
+        kinds.append(kind)
+
+    writer = BitWriter()
+    if count > 0:
+        for kind, column in zip(kinds, columns):
+            if kind == b"i":
+                _write_ints(writer, column)
+            else:
+                _write_floats(writer, [float(value) for value in column])
+    return _BLOCK_HEADER.pack(count, len(columns)) + b"".join(kinds) + writer.getvalue()
+
+
+def decode_block(block):
+    """
+    Decompress a block produced by encode_block.
+
+    Arguments:
+    block -- the encoded block
+
+    Returns:
+    a list of array.array columns ('q' for integers, 'd' for floats)
+    """
+    block = bytes(block)
+    count, ncolumns = _BLOCK_HEADER.unpack_from(block)
+    offset = _BLOCK_HEADER.size
+    kinds = [block[offset + i:offset + i + 1] for i in range(ncolumns)]
+    reader = BitReader(block, offset + ncolumns)
+    columns = []
+    for kind in kinds:
+        if count == 0:
+            columns.append(array("q" if kind == b"i" else "d"))
+        elif kind == b"i":
+            columns.append(_read_ints(reader, count))
+        else:
+            columns.append(_read_floats(reader, count))
+    return columns
+
+
+class TimeSeriesCodec(BinaryCodec):
+    """Binary codec that stores numeric columnar batches as Gorilla blocks.
+
+    Each collector batch of a columnar message whose columns (or values)
+    are all numeric becomes one block; everything else is encoded exactly
+    as by the binary codec. Decoding restores the columns as typed arrays.
+    """
+
+    name = "timeseries"
+    content_type = "application/x-simstream-timeseries"
+    codec_id = 2
+
+    def encode(self, data):
+        if batch.is_columnar(data):
+            data = batch.pack({name: self._compress(collector_batch)
+                               for name, collector_batch in data["collectors"].items()})
+        return super(TimeSeriesCodec, self).encode(data)
+
+    def decode(self, body):
+        data = super(TimeSeriesCodec, self).decode(body)
+        if batch.is_columnar(data):
+            for name, collector_batch in data["collectors"].items():
+                if "block" in collector_batch:
+                    data["collectors"][name] = self._expand(collector_batch)
+        return data
+
+    def _compress(self, collector_batch):
+        """
+        Replace a batch's numeric columns with a block, if possible.
+
+        Arguments:
+        collector_batch -- one collector's columnar batch
+        """
+        if collector_batch["n"] == 0:
+            return collector_batch
+        if "columns" in collector_batch:
+            fields = list(collector_batch["columns"])
+            columns = [collector_batch["columns"][key] for key in fields]
+        else:
+            fields = None
+            columns = [collector_batch["values"]]
+        if any(_column_kind(column) is None for column in columns):
+            return collector_batch
+
+        compressed = {"n": collector_batch["n"], "block": encode_block(columns)}
+        if fields is not None:
+            compressed["fields"] = fields
+        return compressed
+
+    def _expand(self, collector_batch):
+        """
+        Restore a batch's columns from its block.
+
+        Arguments:
+        collector_batch -- one collector's compressed batch
+        """
+        columns = decode_block(collector_batch["block"])
+        if "fields" in collector_batch:
+            return {"n": collector_batch["n"],
+                    "columns": dict(zip(collector_batch["fields"], columns))}
+        return {"n": collector_batch["n"], "values": columns[0]}
+
+
+register_codec(TimeSeriesCodec())
@@ -0,0 +1,56 @@
+import time
+import unittest
+
+from simstream.aggregate import Aggregator
+from simstream.datareporter import DataReporter
+
+
+class RecordingProducer(object):
+    """Stands in for PikaProducer and records what would be published."""
+
+    def __init__(self):
+        self.spool = None
+        self.sent = []
+        self.closed = False
+
+    def __call__(self, data, routing_keys=None):
+        self.sent.append((data, routing_keys))
+
+    def shutdown(self):
+        self.closed = True
+
+
+class TestDataReporterStop(unittest.TestCase):
+
+    def test_stop_publishes_partial_aggregate_window(self):
+        reporter = DataReporter("amqp://localhost", "simstream", interval=3600)
+        reporter.producer = RecordingProducer()
+        reporter.add_collector("value", callback=lambda: 1.0, interval=0.01,
+                               aggregator=Aggregator(3600))
+        reporter.start()
+        time.sleep(0.2)
+        reporter.stop()
+        reporter.join()
+
+        self.assertTrue(reporter.producer.closed)
+        self.assertEqual(reporter.flush_triggers["stop"], 1)
+        summaries = [point for data, unused_keys in reporter.producer.sent
+                     for point in data.get("value", [])]
+        self.assertEqual(len(summaries), 1)
+        self.assertGreater(summaries[0]["n"], 1)
+        self.assertEqual(summaries[0]["mean"], 1.0)
+
+    def test_stop_without_data_does_not_publish(self):
+        reporter = DataReporter("amqp://localhost", "simstream", interval=3600)
+        reporter.producer = RecordingProducer()
+        reporter.add_collector("value", callback=lambda: 1.0, interval=3600)
+        reporter.start()
+        reporter.stop()
+        reporter.join()
+
+        self.assertEqual(reporter.producer.sent, [])
+        self.assertTrue(reporter.producer.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()